@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import itertools
+import operator
 import time
 
 from abc import abstractproperty
@@ -7,6 +9,8 @@ from threading import current_thread
 from gevent import GreenletExit
 
 from amplify.agent.common.context import context
+from amplify.agent.pipelines.file import FileTail, SharedFileTail
+from amplify.agent.pipelines.syslog import SyslogTail
 
 __author__ = "Mike Belov"
 __copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
@@ -277,3 +281,84 @@ class AbstractMetricsCollector(AbstractCollector):
     def collect(self, *args, **kwargs):
         self.status_update()
         super(AbstractMetricsCollector, self).collect(*args, **kwargs)
+
+
+class AbstractLogsCollector(AbstractCollector):
+    """
+    Log collector with a time budget per collect cycle.
+
+    When a cycle runs out of time_budget (seconds), the collector stops at the current line and keeps the iterator
+    over the rest of the tail.  The next cycle starts right after other greenlets had a chance to run and continues
+    from the same line, so a burst of log lines is processed in slices instead of one long cycle.
+    """
+
+    # lines between checks of the time budget
+    budget_check_lines = 100
+
+    def __init__(self, time_budget=0, **kwargs):
+        super(AbstractLogsCollector, self).__init__(**kwargs)
+        self.time_budget = time_budget
+        self.deadline = None
+        self.iterator = None  # iterator over lines of the tail in the current cycle
+        self.pending = None  # (line, iterator) left by the previous cycle
+
+    def lines(self):
+        """
+        Starts a cycle
+
+        :return: iterator over new lines of the tail (or over the lines left by the previous cycle), iter() of it
+                 returns the iterator itself, so it can be looped over without another pass over the tail
+        """
+        self.deadline = time.time() + self.time_budget if self.time_budget else None
+        pending, self.pending = self.pending, None
+        if pending is None:
+            self.iterator = iter(self.tail)
+            return self.iterator
+
+        line, self.iterator = pending
+        return itertools.chain((line,), self.iterator)
+
+    def defer(self, line):
+        """
+        Leaves the current line and the rest of the lines to the next cycle if the time budget is spent.
+        Must not be called for the first line of a cycle.
+
+        :param line: str current line
+        :return: bool True if the cycle should stop
+        """
+        if self.deadline is None or time.time() < self.deadline:
+            return False
+
+        self.object.statsd.incr('controller.agent.log.deferred_lines', 1 + operator.length_hint(self.iterator))
+        self.pending = line, self.iterator
+        return True
+
+    def report_backlog(self):
+        """
+        controller.agent.log.skipped_bytes
+        controller.agent.log.backlog_bytes
+        controller.agent.syslog.received
+        controller.agent.syslog.dropped
+        controller.agent.syslog.truncated
+        controller.agent.syslog.overflowed
+        """
+        if isinstance(self.tail, SyslogTail):
+            for counter, value in self.tail.take_counters().items():
+                if value is not None:
+                    self.object.statsd.incr('controller.agent.syslog.%s' % counter, value)
+            return
+
+        if isinstance(self.tail, (FileTail, SharedFileTail)):
+            # the backlog that the tail had to skip
+            self.object.statsd.incr('controller.agent.log.skipped_bytes', self.tail.skipped_bytes)
+            self.tail.skipped_bytes = 0
+
+            # the backlog that is left for the next cycles
+            if self.time_budget:
+                self.object.statsd.average('controller.agent.log.backlog_bytes', self.tail.backlog())
+
+    def _sleep(self):
+        if self.pending is not None:
+            time.sleep(0.001)  # just yield to other greenlets, there are lines left
+        else:
+            super(AbstractLogsCollector, self)._sleep()
@@ -1,11 +1,16 @@
 # -*- coding: utf-8 -*-
+import math
+import operator
 import time
 
-from amplify.agent.collectors.abstract import AbstractCollector
+from amplify.agent.collectors.abstract import AbstractLogsCollector
 from amplify.agent.common.context import context
+from amplify.agent.data.statsd import StatsdBatch
 from amplify.agent.pipelines.abstract import Pipeline
+from amplify.agent.pipelines.file import FileTail, SharedFileTail
+from amplify.agent.pipelines.pool import PoolTail
+from amplify.agent.objects.nginx.filters import FilterMatcher
 from amplify.agent.objects.nginx.log.access import NginxAccessLogParser
-import copy
 
 
 __author__ = "Mike Belov"
@@ -15,7 +20,20 @@ __maintainer__ = "Mike Belov"
 __email__ = "dedm@nginx.com"
 
 
-class NginxAccessLogsCollector(AbstractCollector):
+DEFAULT_BATCH_SIZE = 1000
+
+
+def values_getter(indexes):
+    """
+    :param indexes: () of record indexes
+    :return: function that returns a tuple of record values at the indexes
+    """
+    if len(indexes) > 1:
+        return operator.itemgetter(*indexes)
+    return lambda record: tuple(record[i] for i in indexes)
+
+
+class NginxAccessLogsCollector(AbstractLogsCollector):
     short_name = 'nginx_alog'
 
     counters = {
@@ -79,16 +97,49 @@ class NginxAccessLogsCollector(AbstractCollector):
         'updating',
     )
 
-    def __init__(self, log_format=None, tail=None, **kwargs):
+    # log variables read by every metric method ("upstream_*" stands for all of them, any upstream variable
+    # marks a request that went to an upstream)
+    method_keys = {
+        'http_method': ('request_method',),
+        'http_status': ('status',),
+        'http_version': ('server_protocol',),
+        'request_length': ('request_length',),
+        'body_bytes_sent': ('body_bytes_sent',),
+        'bytes_sent': ('bytes_sent',),
+        'gzip_ration': ('gzip_ratio',),
+        'request_time': ('request_time',),
+        'upstreams': ('upstream_*',),
+        'upstream_counters': ('upstream_*',),
+        'upstream_values': ('upstream_*',),
+    }
+
+    # counters of these methods depend only on categorical values of a record (see count_combinations)
+    categorical_methods = ('http_method', 'http_status', 'http_version', 'upstream_counters')
+
+    def __init__(self, log_format=None, tail=None, batch_size=DEFAULT_BATCH_SIZE, sample_rate=1, cpu_budget=0,
+                 aggregate=False, **kwargs):
         super(NginxAccessLogsCollector, self).__init__(**kwargs)
-        self.parser = NginxAccessLogParser(log_format)
-        self.num_of_lines_in_log_format = self.parser.raw_format.count('\n')+1
         self.tail = tail
         # syslog tails names are "<type>:<name>"
         self.name = tail.name.split(':')[-1] if isinstance(tail, Pipeline) \
             else None
         self.filters = []
 
+        # only every sample_rate-th record is parsed and counters are scaled back by sample_rate (timers and
+        # averages keep the sampled values), with cpu_budget (seconds) the rate is adapted after every cycle to keep
+        # CPU time of the next one within the budget
+        self.min_sample_rate = max(int(sample_rate), 1)
+        self.sample_rate = self.min_sample_rate
+        self.cpu_budget = cpu_budget
+        self.sampling = self.sample_rate > 1 or bool(self.cpu_budget)
+        self.records = 0
+
+        # per-line metrics are accumulated in a local batch and flushed to the object statsd once per
+        # batch_size lines (0 means that every line goes to the object statsd directly unless lines are sampled)
+        self.batch_size = batch_size
+        self.batched = bool(self.batch_size) or self.sampling
+        self.statsd = StatsdBatch() if self.batched else self.object.statsd
+
         # skip empty filters and filters for other log file
         for log_filter in self.object.filters:
             if log_filter.empty:
@@ -97,17 +148,186 @@ class NginxAccessLogsCollector(AbstractCollector):
                 continue
             self.filters.append(log_filter)
 
-        self.register(
-            self.http_method,
-            self.http_status,
-            self.http_version,
-            self.request_length,
-            self.body_bytes_sent,
-            self.bytes_sent,
-            self.gzip_ration,
-            self.request_time,
-            self.upstreams,
+        # with aggregate, records are counted by their categorical values (method, status, protocol, upstream and
+        # cache statuses) and counters of categorical_methods are incremented once per distinct combination at the
+        # end of a cycle, only numeric values are collected for every record
+        self.aggregate = aggregate
+        self.combinations = {}
+        if self.aggregate:
+            self.categorical = tuple(getattr(self, name) for name in self.categorical_methods)
+            self.register(
+                self.request_length,
+                self.body_bytes_sent,
+                self.bytes_sent,
+                self.gzip_ration,
+                self.request_time,
+                self.upstream_values,
+            )
+        else:
+            self.categorical = ()
+            self.register(
+                self.http_method,
+                self.http_status,
+                self.http_version,
+                self.request_length,
+                self.body_bytes_sent,
+                self.bytes_sent,
+                self.gzip_ration,
+                self.request_time,
+                self.upstreams,
+            )
+
+        # don't slice and cast values that no metric or filter reads (like http_user_agent usually),
+        # values read only by filters are cast only when filters are checked
+        metric_keys = self.metric_keys()
+        filter_keys = set(key for log_filter in self.filters for key in log_filter.data)
+        if metric_keys is None:
+            demanded_keys, lazy_keys = None, None
+        else:
+            prefixes = tuple(key[:-1] for key in metric_keys if key.endswith('*'))
+            demanded_keys = metric_keys | filter_keys
+            lazy_keys = set(
+                key for key in filter_keys - metric_keys if not (prefixes and key.startswith(prefixes))
+            )
+        self.parser = NginxAccessLogParser(log_format, demanded_keys=demanded_keys, lazy_keys=lazy_keys)
+        self.malformed_index = self.parser.field_index['malformed']
+        self.num_of_lines_in_log_format = self.parser.raw_format.count('\n')+1
+
+        # file tails return whole records of multiline formats, lines of other tails are grouped here
+        if isinstance(tail, (FileTail, SharedFileTail)) and tail.lines_per_record == self.num_of_lines_in_log_format:
+            self.lines_per_item = 1
+        else:
+            self.lines_per_item = self.num_of_lines_in_log_format
+
+        # positions of the values in records returned by the compiled parser (None if not in format)
+        index = self.parser.field_index
+        self.request_method_index = index.get('request_method')
+        self.status_index = index.get('status')
+        self.server_protocol_index = index.get('server_protocol')
+        self.request_length_index = index.get('request_length')
+        self.body_bytes_sent_index = index.get('body_bytes_sent')
+        self.bytes_sent_index = index.get('bytes_sent')
+        self.gzip_ratio_index = index.get('gzip_ratio')
+        self.request_time_index = index.get('request_time')
+        self.upstream_status_index = index.get('upstream_status')
+        self.upstream_response_length_index = index.get('upstream_response_length')
+        self.upstream_cache_status_index = index.get('upstream_cache_status')
+        self.upstream_indexes = tuple(i for field, i in index.items() if field.startswith('upstream'))
+        self.upstream_values_getter = values_getter(self.upstream_indexes)
+        self.category_values_getter = values_getter(tuple(i for i in (
+            self.request_method_index, self.status_index, self.server_protocol_index, self.upstream_cache_status_index
+        ) if i is not None))
+        self.upstream_time_indexes = tuple(
+            (metric_name, index[key_name]) for metric_name, key_name in (
+                ('nginx.upstream.connect.time', 'upstream_connect_time'),
+                ('nginx.upstream.response.time', 'upstream_response_time'),
+                ('nginx.upstream.header.time', 'upstream_header_time'),
+            ) if key_name in index
+        )
+
+        # metric names of the most common values, so that per-line work is a dict lookup
+        self.method_metrics = {}
+        for method in self.valid_http_methods:
+            self.method_metrics[method] = self.method_metrics[method.upper()] = 'nginx.http.method.%s' % method
+        self.status_metrics = dict(
+            (str(status), self.status_metric_names(str(status))) for status in range(100, 600)
+        )
+        self.version_metrics = dict(
+            (proto, self.version_metric_name(proto)) for proto in (
+                'HTTP/0.9', 'HTTP/1.0', 'HTTP/1.1', 'HTTP/2.0', 'HTTP/2', 'HTTP/3.0', 'HTTP/3'
+            )
+        )
+        self.cache_metrics = {'-': None}
+        for cache_status in self.valid_cache_statuses:
+            metric_name = 'nginx.cache.%s' % cache_status
+            self.cache_metrics[cache_status] = self.cache_metrics[cache_status.upper()] = metric_name
+        self.upstream_status_metrics = dict(
+            (str(status), 'nginx.upstream.status.%sxx' % str(status)[0]) for status in range(100, 600)
         )
+        # all filters are matched at once, against values of the keys they check
+        self.filter_matcher = FilterMatcher(self.filters)
+        self.filter_keys = tuple(set(key for log_filter in self.filters for key in log_filter.data))
+
+        self.filter_metric_names = dict(
+            (log_filter, '%s||%s' % (log_filter.metric, log_filter.filter_rule_id)) for log_filter in self.filters
+        )
+
+        # median, max, pctl95 and count of timers are created in statsd.flush(), so filters on them are counted
+        # with the timer itself, e.g. a filter on nginx.upstream.response.time.median as
+        # nginx.upstream.response.time||<filter id>
+        # parent metric -> {filter: full metric name}
+        self.parent_filter_metric_names = {}
+        for parent_metric in ('nginx.http.request.time',) + tuple(name for name, _ in self.upstream_time_indexes):
+            self.parent_filter_metric_names[parent_metric] = dict(
+                (log_filter, '%s||%s' % (parent_metric, log_filter.filter_rule_id))
+                for log_filter in self.filters if parent_metric in log_filter.metric
+            )
+
+    def metric_keys(self):
+        """
+        Returns log variables read by the registered metric methods
+
+        :return: set of keys or None if some method doesn't declare its keys (so all are needed)
+        """
+        keys = set()
+        for method in self.methods.union(self.categorical):
+            method_keys = self.method_keys.get(method.__name__)
+            if method_keys is None:
+                return None
+            keys.update(method_keys)
+        return keys
+
+    @staticmethod
+    def status_metric_names(http_status):
+        """
+        Returns names of the metrics to increment for an HTTP status
+
+        :param http_status: str
+        :return: () of metric names
+        """
+        metric_names = []
+
+        # add separate metrics for specific 4xx and 5xx codes
+        if http_status.startswith('4'):
+            if http_status in ('403', '404'):
+                metric_names.append('nginx.http.status.%s' % http_status)
+        elif http_status.startswith('5'):
+            if http_status in ('500', '502', '503', '504'):
+                metric_names.append('nginx.http.status.%s' % http_status)
+
+        metric_names.append('nginx.http.status.%sxx' % http_status[0])
+
+        if http_status == '499':
+            metric_names.append('nginx.http.status.discarded')
+
+        return tuple(metric_names)
+
+    @staticmethod
+    def version_metric_name(proto):
+        """
+        Returns name of the metric to increment for a server protocol
+
+        :param proto: str
+        :return: str metric name or None for non HTTP protocols
+        """
+        if not proto.startswith('HTTP'):
+            return None
+
+        version = proto.split('/')[-1]
+
+        # Ordered roughly by expected popularity to reduce number of calls to `startswith`
+        if version.startswith('1.1'):
+            suffix = '1_1'
+        elif version.startswith('2.0'):
+            suffix = '2'
+        elif version.startswith('1.0'):
+            suffix = '1_0'
+        elif version.startswith('0.9'):
+            suffix = '0_9'
+        else:
+            suffix = version.replace('.', '_')
+
+        return 'nginx.http.v%s' % suffix
 
     def init_counters(self, counters=None):
         for counter, key in self.counters.items():
@@ -123,50 +343,145 @@ class NginxAccessLogsCollector(AbstractCollector):
     def collect(self):
         self.init_counters()  # set all counters to 0
 
+        # the log is tailed, parsed and aggregated by a worker process
+        if isinstance(self.tail, PoolTail):
+            try:
+                self.tail.collect().flush(self.object.statsd)
+            except:
+                context.log.error('failed to collect metrics of %s from log worker' % self.tail.name)
+                context.log.debug('additional info:', exc_info=True)
+            return
+
         count = 0
         multiline_record = []
-        for line in self.tail:
+        sample_rate = self.sample_rate
+        sampled = records = 0
+        cpu_start = time.process_time()
+        lines = self.lines()
+        lines_per_item = self.lines_per_item
+        budget_check_lines = self.budget_check_lines * lines_per_item
+        for line in lines:
+            # stop at a record boundary if the cycle is out of its time budget
+            if self.deadline and count and count % budget_check_lines == 0 and self.defer(line):
+                break
             count += 1
 
             # release GIL every 1000 of lines
-            if count % (1000 * self.num_of_lines_in_log_format) == 0:
+            if count % (1000 * lines_per_item) == 0:
                 time.sleep(0.001)
 
+            if self.batch_size and count % self.batch_size == 0:
+                self.statsd.flush(self.object.statsd, scale=sample_rate)
+
             # handle multiline log formats
-            if self.num_of_lines_in_log_format > 1:
+            if lines_per_item > 1:
                 multiline_record.append(line)
-                if len(multiline_record) < self.num_of_lines_in_log_format:
+                if len(multiline_record) < lines_per_item:
                     continue
                 else:
                     line = '\n'.join(multiline_record)
                     multiline_record = []
 
+            if self.sampling:
+                records += 1
+                self.records += 1  # not reset between cycles, so the sampled phase of periodic patterns shifts
+                if self.records % sample_rate:
+                    continue
+                sampled += 1
+
             try:
-                parsed = self.parser.parse(line)
+                record = self.parser.parse_record(line)
             except:
                 context.log.debug('could not parse line %r' % line, exc_info=True)
-                parsed = None
+                continue
 
-            if not parsed:
+            if record is None:
+                context.log.debug('could not parse line %r with format %r' % (line, self.parser.raw_format))
                 continue
 
-            if parsed['malformed']:
+            if record[self.malformed_index]:
                 self.request_malformed()
             else:
                 # try to match custom filters and collect log metrics with them
-                matched_filters = [filter for filter in self.filters if filter.match(parsed)]
-                super(NginxAccessLogsCollector, self).collect(parsed, matched_filters)
+                if self.filters:
+                    parsed = self.parser.record_to_dict(record, self.filter_keys)
+                    matched_filters = self.filter_matcher.match(parsed)
+                else:
+                    matched_filters = None
+                if self.aggregate:
+                    self.count_combination(record, matched_filters)
+                super(NginxAccessLogsCollector, self).collect(record, matched_filters)
+
+        if self.aggregate:
+            self.count_combinations()
+
+        if self.batched:
+            self.statsd.flush(self.object.statsd, scale=sample_rate)
+
+        if self.sampling:
+            self.update_sample_rate(records, sampled, time.process_time() - cpu_start)
+
+        self.report_backlog()
 
         tail_name = self.tail.name if isinstance(self.tail, Pipeline) else 'list'
         context.log.debug('%s processed %s lines from %s' % (self.object.definition_hash, count, tail_name))
 
+    def count_combination(self, record, matched_filters):
+        """
+        Counts a record by its categorical values and matched filters
+
+        :param record: () of parsed line
+        :param matched_filters: [] of matched filters
+        """
+        key = self.category_values_getter(record)
+        if self.upstream_status_index is not None and record[self.upstream_status_index] is not None:
+            key += tuple(record[self.upstream_status_index])
+        if self.upstream_indexes:
+            key += (self.went_upstream(record),)
+        if matched_filters:
+            key += tuple(matched_filters)
+
+        combination = self.combinations.get(key)
+        if combination is None:
+            self.combinations[key] = [record, matched_filters, 1]
+        else:
+            combination[2] += 1
+
+    def count_combinations(self):
+        """
+        Increments counters of categorical methods once per distinct combination of the counted records
+        """
+        for record, matched_filters, count in self.combinations.values():
+            for method in self.categorical:
+                try:
+                    method(record, matched_filters, count)
+                except Exception as e:
+                    self.handle_exception(method, e)
+        self.combinations = {}
+
+    def update_sample_rate(self, records, sampled, cpu_time):
+        """
+        Reports the effective sampling rate of a cycle and adapts the rate to the CPU budget
+
+        :param records: int number of records in the cycle
+        :param sampled: int number of parsed records
+        :param cpu_time: float CPU time of the cycle in seconds
+        """
+        if records:
+            self.object.statsd.average('controller.agent.log.sample_rate', float(sampled) / records)
+
+        if self.cpu_budget:
+            # the cost of a cycle is roughly proportional to the number of parsed records
+            rate = int(math.ceil(self.sample_rate * cpu_time / self.cpu_budget))
+            self.sample_rate = max(self.min_sample_rate, rate)
+
     def request_malformed(self):
         """
         nginx.http.request.malformed
         """
-        self.object.statsd.incr('nginx.http.request.malformed')
+        self.statsd.incr('nginx.http.request.malformed')
 
-    def http_method(self, data, matched_filters=None):
+    def http_method(self, record, matched_filters=None, count=1):
         """
         nginx.http.method.head
         nginx.http.method.get
@@ -176,18 +491,21 @@ class NginxAccessLogsCollector(AbstractCollector):
         nginx.http.method.options
         nginx.http.method.other
 
-        :param data: {} of parsed line
+        :param record: () of parsed line
         :param matched_filters: [] of matched filters
+        :param count: int number of records with the same values
         """
-        if 'request_method' in data:
-            method = data['request_method'].lower()
-            method = method if method in self.valid_http_methods else 'other'
-            metric_name = 'nginx.http.method.%s' % method
-            self.object.statsd.incr(metric_name)
+        if self.request_method_index is not None and record[self.request_method_index] is not None:
+            method = record[self.request_method_index]
+            metric_name = self.method_metrics.get(method)
+            if metric_name is None:
+                method = method.lower()
+                metric_name = 'nginx.http.method.%s' % (method if method in self.valid_http_methods else 'other')
+            self.statsd.incr(metric_name, count)
             if matched_filters:
-                self.count_custom_filter(matched_filters, metric_name, 1, self.object.statsd.incr)
+                self.count_custom_filter(matched_filters, metric_name, count, self.statsd.incr)
 
-    def http_status(self, data, matched_filters=None):
+    def http_status(self, record, matched_filters=None, count=1):
         """
         nginx.http.status.1xx
         nginx.http.status.2xx
@@ -202,121 +520,97 @@ class NginxAccessLogsCollector(AbstractCollector):
         nginx.http.status.504
         nginx.http.status.discarded
 
-        :param data: {} of parsed line
+        :param record: () of parsed line
         :param matched_filters: [] of matched filters
+        :param count: int number of records with the same values
         """
-        if 'status' in data:
-            metrics_to_populate = []
-            http_status = data['status']
-
-            # add separate metrics for specific 4xx and 5xx codes
-            if http_status.startswith('4'):
-                if http_status in ('403', '404'):
-                    metrics_to_populate.append('nginx.http.status.%s' % http_status)
-            elif http_status.startswith('5'):
-                if http_status in ('500', '502', '503', '504'):
-                    metrics_to_populate.append('nginx.http.status.%s' % http_status)
-
-            metrics_to_populate.append('nginx.http.status.%sxx' % http_status[0])
-
-            for metric_name in metrics_to_populate:
-                self.object.statsd.incr(metric_name)
+        if self.status_index is not None:
+            http_status = record[self.status_index]
+            metric_names = self.status_metrics.get(http_status)
+            if metric_names is None:
+                metric_names = self.status_metric_names(http_status)
+
+            for metric_name in metric_names:
+                self.statsd.incr(metric_name, count)
                 if matched_filters:
-                    self.count_custom_filter(matched_filters, metric_name, 1, self.object.statsd.incr)
-
-                if data['status'] == '499':
-                    metric_name = 'nginx.http.status.discarded'
-                    self.object.statsd.incr(metric_name)
-                    if matched_filters:
-                        self.count_custom_filter(matched_filters, metric_name, 1, self.object.statsd.incr)
+                    self.count_custom_filter(matched_filters, metric_name, count, self.statsd.incr)
 
-    def http_version(self, data, matched_filters=None):
+    def http_version(self, record, matched_filters=None, count=1):
         """
         nginx.http.v0_9
         nginx.http.v1_0
         nginx.http.v1_1
         nginx.http.v2
 
-        :param data: {} of parsed line
+        :param record: () of parsed line
         :param matched_filters: [] of matched filters
+        :param count: int number of records with the same values
         """
-        if 'server_protocol' in data:
-            proto = data['server_protocol']
-            if not proto.startswith('HTTP'):
-                return
-
-            version = proto.split('/')[-1]
-
-            # Ordered roughly by expected popularity to reduce number of calls to `startswith`
-            if version.startswith('1.1'):
-                suffix = '1_1'
-            elif version.startswith('2.0'):
-                suffix = '2'
-            elif version.startswith('1.0'):
-                suffix = '1_0'
-            elif version.startswith('0.9'):
-                suffix = '0_9'
+        if self.server_protocol_index is not None and record[self.server_protocol_index] is not None:
+            proto = record[self.server_protocol_index]
+            if proto in self.version_metrics:
+                metric_name = self.version_metrics[proto]
             else:
-                suffix = version.replace('.', '_')
+                metric_name = self.version_metric_name(proto)
 
-            metric_name = 'nginx.http.v%s' % suffix
-            self.object.statsd.incr(metric_name)
-            if matched_filters:
-                self.count_custom_filter(matched_filters, metric_name, 1, self.object.statsd.incr)
+            if metric_name is not None:
+                self.statsd.incr(metric_name, count)
+                if matched_filters:
+                    self.count_custom_filter(matched_filters, metric_name, count, self.statsd.incr)
 
-    def request_length(self, data, matched_filters=None):
+    def request_length(self, record, matched_filters=None):
         """
         nginx.http.request.length
 
-        :param data: {} of parsed line
+        :param record: () of parsed line
         :param matched_filters: [] of matched filters
         """
-        if 'request_length' in data:
-            metric_name, value = 'nginx.http.request.length', data['request_length']
-            self.object.statsd.average(metric_name, value)
+        if self.request_length_index is not None:
+            metric_name, value = 'nginx.http.request.length', record[self.request_length_index]
+            self.statsd.average(metric_name, value)
             if matched_filters:
-                self.count_custom_filter(matched_filters, metric_name, value, self.object.statsd.average)
+                self.count_custom_filter(matched_filters, metric_name, value, self.statsd.average)
 
-    def body_bytes_sent(self, data, matched_filters=None):
+    def body_bytes_sent(self, record, matched_filters=None):
         """
         nginx.http.request.body_bytes_sent
 
-        :param data: {} of parsed line
+        :param record: () of parsed line
         :param matched_filters: [] of matched filters
         """
-        if 'body_bytes_sent' in data:
-            metric_name, value = 'nginx.http.request.body_bytes_sent', data['body_bytes_sent']
-            self.object.statsd.incr(metric_name, value)
+        if self.body_bytes_sent_index is not None:
+            metric_name, value = 'nginx.http.request.body_bytes_sent', record[self.body_bytes_sent_index]
+            self.statsd.incr(metric_name, value)
             if matched_filters:
-                self.count_custom_filter(matched_filters, metric_name, value, self.object.statsd.incr)
+                self.count_custom_filter(matched_filters, metric_name, value, self.statsd.incr)
 
-    def bytes_sent(self, data, matched_filters=None):
+    def bytes_sent(self, record, matched_filters=None):
         """
         nginx.http.request.bytes_sent
 
-        :param data: {} of parsed line
+        :param record: () of parsed line
         :param matched_filters: [] of matched filters
         """
-        if 'bytes_sent' in data:
-            metric_name, value = 'nginx.http.request.bytes_sent', data['bytes_sent']
-            self.object.statsd.incr(metric_name, value)
+        if self.bytes_sent_index is not None:
+            metric_name, value = 'nginx.http.request.bytes_sent', record[self.bytes_sent_index]
+            self.statsd.incr(metric_name, value)
             if matched_filters:
-                self.count_custom_filter(matched_filters, metric_name, value, self.object.statsd.incr)
+                self.count_custom_filter(matched_filters, metric_name, value, self.statsd.incr)
 
-    def gzip_ration(self, data, matched_filters=None):
+    def gzip_ration(self, record, matched_filters=None):
         """
         nginx.http.gzip.ratio
 
-        :param data: {} of parsed line
+        :param record: () of parsed line
         :param matched_filters: [] of matched filters
         """
-        if 'gzip_ratio' in data:
-            metric_name, value = 'nginx.http.gzip.ratio', data['gzip_ratio']
-            self.object.statsd.average(metric_name, value)
+        if self.gzip_ratio_index is not None:
+            metric_name, value = 'nginx.http.gzip.ratio', record[self.gzip_ratio_index]
+            self.statsd.average(metric_name, value)
             if matched_filters:
-                self.count_custom_filter(matched_filters, metric_name, value, self.object.statsd.average)
+                self.count_custom_filter(matched_filters, metric_name, value, self.statsd.average)
 
-    def request_time(self, data, matched_filters=None):
+    def request_time(self, record, matched_filters=None):
         """
         nginx.http.request.time
         nginx.http.request.time.median
@@ -324,18 +618,16 @@ class NginxAccessLogsCollector(AbstractCollector):
         nginx.http.request.time.pctl95
         nginx.http.request.time.count
 
-        :param data: {} of parsed line
+        :param record: () of parsed line
         :param matched_filters: [] of matched filters
         """
-        if 'request_time' in data:
-            metric_name, value = 'nginx.http.request.time', sum(data['request_time'])
-            self.object.statsd.timer(metric_name, value)
+        if self.request_time_index is not None and record[self.request_time_index] is not None:
+            metric_name, value = 'nginx.http.request.time', sum(record[self.request_time_index])
+            self.statsd.timer(metric_name, value)
             if matched_filters:
-                self.count_custom_filter(self.create_parent_filters(matched_filters, parent_metric=metric_name),
-                                         metric_name, value,
-                                         self.object.statsd.timer)
+                self.count_parent_filters(matched_filters, metric_name, value, self.statsd.timer)
 
-    def upstreams(self, data, matched_filters=None):
+    def upstreams(self, record, matched_filters=None):
         """
         nginx.cache.bypass
         nginx.cache.expired
@@ -368,39 +660,95 @@ class NginxAccessLogsCollector(AbstractCollector):
         nginx.upstream.status.5xx
         nginx.upstream.response.length
 
-        :param data: {} of parsed line
+        :param record: () of parsed line
         :param matched_filters: [] of matched filters
         """
-        if not any(key.startswith('upstream') and data[key] not in ('-', '') for key in data):
-            return
+        upstream_response = self.upstream_counters(record, matched_filters)
+        if upstream_response is not None:
+            self.upstream_values(record, matched_filters, upstream_response)
+
+    def went_upstream(self, record):
+        """
+        :param record: () of parsed line
+        :return: bool True if any upstream variable of the record is set
+        """
+        values = self.upstream_values_getter(record)
+        return values.count(None) + values.count('-') + values.count('') < len(values)
+
+    def upstream_counters(self, record, matched_filters=None, count=1):
+        """
+        Counters of upstreams() that depend only on upstream and cache statuses
+
+        :param record: () of parsed line
+        :param matched_filters: [] of matched filters
+        :param count: int number of records with the same values
+        :return: bool True if the upstream responded with 2xx or 3xx, None if the request didn't go upstream
+        """
+        if not self.went_upstream(record):
+            return None
 
-        # counters
         upstream_response = False
-        if 'upstream_status' in data:
-            for status in data['upstream_status']:  # upstream_status is parsed as a list
+        if self.upstream_status_index is not None:
+            for status in record[self.upstream_status_index]:  # upstream_status is parsed as a list
                 if status.isdigit():
-                    suffix = '%sxx' % status[0]
-                    metric_name = 'nginx.upstream.status.%s' % suffix
-                    upstream_response = True if suffix in ('2xx', '3xx') else False   # Set flag for upstream length processing
-                    self.object.statsd.incr(metric_name)
+                    metric_name = self.upstream_status_metrics.get(status) or 'nginx.upstream.status.%sxx' % status[0]
+                    upstream_response = status[0] in '23'  # Set flag for upstream length processing
+                    self.statsd.incr(metric_name, count)
                     if matched_filters:
-                        self.count_custom_filter(matched_filters, metric_name, 1, self.object.statsd.incr)
+                        self.count_custom_filter(matched_filters, metric_name, count, self.statsd.incr)
+
+        # cache
+        if self.upstream_cache_status_index is not None:
+            cache_status = record[self.upstream_cache_status_index]
+            if cache_status in self.cache_metrics:
+                metric_name = self.cache_metrics[cache_status]
+            else:
+                cache_status_lower = cache_status.lower()
+                metric_name = 'nginx.cache.%s' % cache_status_lower \
+                    if cache_status_lower in self.valid_cache_statuses else None
+
+            if metric_name is not None:
+                self.statsd.incr(metric_name, count)
+                if matched_filters:
+                    self.count_custom_filter(matched_filters, metric_name, count, self.statsd.incr)
+
+        # log total upstream requests
+        metric_name = 'nginx.upstream.request.count'
+        self.statsd.incr(metric_name, count)
+        if matched_filters:
+            self.count_custom_filter(matched_filters, metric_name, count, self.statsd.incr)
+
+        return upstream_response
+
+    def upstream_values(self, record, matched_filters=None, upstream_response=None):
+        """
+        Numeric metrics of upstreams()
 
-        if upstream_response and 'upstream_response_length' in data:
-            metric_name, value = 'nginx.upstream.response.length', data['upstream_response_length']
-            self.object.statsd.average(metric_name, value)
+        :param record: () of parsed line
+        :param matched_filters: [] of matched filters
+        :param upstream_response: bool result of upstream_counters() or None if it wasn't called for the record
+        """
+        if upstream_response is None:
+            if not self.went_upstream(record):
+                return
+
+            upstream_response = False
+            if self.upstream_status_index is not None:
+                for status in record[self.upstream_status_index]:
+                    if status.isdigit():
+                        upstream_response = status[0] in '23'
+
+        if upstream_response and self.upstream_response_length_index is not None:
+            metric_name, value = 'nginx.upstream.response.length', record[self.upstream_response_length_index]
+            self.statsd.average(metric_name, value)
             if matched_filters:
-                self.count_custom_filter(matched_filters, metric_name, value, self.object.statsd.average)
+                self.count_custom_filter(matched_filters, metric_name, value, self.statsd.average)
 
         # gauges
         upstream_switches = None
-        for metric_name, key_name in {
-            'nginx.upstream.connect.time': 'upstream_connect_time',
-            'nginx.upstream.response.time': 'upstream_response_time',
-            'nginx.upstream.header.time': 'upstream_header_time'
-        }.items():
-            if key_name in data:
-                values = data[key_name]
+        for metric_name, index in self.upstream_time_indexes:
+            values = record[index]
+            if values is not None:
 
                 # set upstream switches one time
                 if len(values) > 1 and upstream_switches is None:
@@ -408,56 +756,32 @@ class NginxAccessLogsCollector(AbstractCollector):
 
                 # store all values
                 value = sum(values)
-                self.object.statsd.timer(metric_name, value)
+                self.statsd.timer(metric_name, value)
                 if matched_filters:
-                    self.count_custom_filter(self.create_parent_filters(matched_filters, parent_metric=metric_name),
-                                             metric_name,
-                                             value, self.object.statsd.timer)
+                    self.count_parent_filters(matched_filters, metric_name, value, self.statsd.timer)
 
         # log upstream switches
         metric_name, value = 'nginx.upstream.next.count', 0 if upstream_switches is None else upstream_switches
-        self.object.statsd.incr(metric_name, value)
+        self.statsd.incr(metric_name, value)
         if matched_filters:
-            self.count_custom_filter(matched_filters, metric_name, value, self.object.statsd.incr)
+            self.count_custom_filter(matched_filters, metric_name, value, self.statsd.incr)
 
-        # cache
-        if 'upstream_cache_status' in data:
-            cache_status = data['upstream_cache_status']
-            cache_status_lower = cache_status.lower()
-            if cache_status_lower in self.valid_cache_statuses:
-                metric_name = 'nginx.cache.%s' % cache_status_lower
-                self.object.statsd.incr(metric_name)
-                if matched_filters:
-                    self.count_custom_filter(matched_filters, metric_name, 1, self.object.statsd.incr)
-
-        # log total upstream requests
-        metric_name = 'nginx.upstream.request.count'
-        self.object.statsd.incr(metric_name)
-        if matched_filters:
-            self.count_custom_filter(matched_filters, metric_name, 1, self.object.statsd.incr)
-
-    @staticmethod
-    def create_parent_filters(original_filters, parent_metric):
+    def count_parent_filters(self, matched_filters, parent_metric, value, method):
         """
-        median, max, pctl95, and count are created in statsd.flush().  So if a
-        filter on nginx.upstream.response.time.median is created, the filter metric
-        should be truncated to nginx.upstream.response.time
+        Collect custom metric for filters on a timer and its median, max, pctl95 and count
 
-        :param original_filters:
-        :param truncated_metric:
-        :return:
+        :param matched_filters: [] of matched filters
+        :param parent_metric: str timer metric name
+        :param value: int/float value
+        :param method: function to call
         """
-        parent_filters = []
-        for original_filter in original_filters:
-            if parent_metric not in original_filter.metric:
-                continue
-            parent_filter = copy.deepcopy(original_filter)
-            parent_filter.metric = parent_metric
-            parent_filters.append(parent_filter)
-        return parent_filters
+        full_metric_names = self.parent_filter_metric_names[parent_metric]
+        for log_filter in matched_filters:
+            full_metric_name = full_metric_names.get(log_filter)
+            if full_metric_name is not None:
+                method(full_metric_name, value)
 
-    @staticmethod
-    def count_custom_filter(matched_filters, metric_name, value, method):
+    def count_custom_filter(self, matched_filters, metric_name, value, method):
         """
         Collect custom metric
 
@@ -469,5 +793,7 @@ class NginxAccessLogsCollector(AbstractCollector):
         """
         for log_filter in matched_filters:
             if log_filter.metric == metric_name:
-                full_metric_name = '%s||%s' % (log_filter.metric, log_filter.filter_rule_id)
+                full_metric_name = self.filter_metric_names.get(log_filter)
+                if full_metric_name is None:
+                    full_metric_name = '%s||%s' % (log_filter.metric, log_filter.filter_rule_id)
                 method(full_metric_name, value)
@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
-from amplify.agent.collectors.abstract import AbstractCollector
-from amplify.agent.objects.nginx.log.error import NginxErrorLogParser
+import re
+import time
+from collections import deque
+
+from amplify.agent.collectors.abstract import AbstractLogsCollector
+from amplify.agent.objects.nginx.log.error import NginxErrorLogParser, upstream_address
 
 from amplify.agent.common.context import context
+from amplify.agent.data.eventd import WARNING
 from amplify.agent.pipelines.abstract import Pipeline
 from amplify.agent.pipelines.file import FileTail
 from amplify.agent.objects.nginx.config.config import ERROR_LOG_LEVELS
@@ -14,7 +19,11 @@ __maintainer__ = "Mike Belov"
 __email__ = "dedm@nginx.com"
 
 
-class NginxErrorLogsCollector(AbstractCollector):
+# characters of an address that can't be a part of a metric name (dots would be taken as name separators)
+address_re = re.compile(r'[^0-9A-Za-z_-]')
+
+
+class NginxErrorLogsCollector(AbstractLogsCollector):
     short_name = 'nginx_elog'
 
     zero_counters = (
@@ -24,7 +33,20 @@ class NginxErrorLogsCollector(AbstractCollector):
         'nginx.upstream.response.failed',
     )
 
-    def __init__(self, filename=None, level=None, log_format=None, tail=None, **kwargs):
+    # lines of these levels are counted as nginx.errorlog.<level>
+    counted_levels = ('emerg', 'alert', 'crit', 'error', 'warn')
+
+    # lines of these levels are errors for burst detection
+    burst_levels = ('emerg', 'alert', 'crit', 'error')
+
+    # a burst needs at least this many errors in the window
+    burst_min_errors = 10
+
+    # weight of one interval in the baseline error rate (longer cycles weigh more)
+    baseline_weight = 0.1
+
+    def __init__(self, filename=None, level=None, log_format=None, tail=None, max_upstreams=0, max_clients=0,
+                 burst_window=0, burst_factor=0, **kwargs):
         super(NginxErrorLogsCollector, self).__init__(**kwargs)
         self.filename = filename
         self.level = level
@@ -32,14 +54,53 @@ class NginxErrorLogsCollector(AbstractCollector):
         self.tail = tail if tail is not None else FileTail(filename)
         self.register(self.error_log_parsed)
 
+        # errors are also counted per upstream address and per client address of the line, up to max_upstreams and
+        # max_clients distinct addresses per statsd flush (errors of the others are counted as "other")
+        self.max_upstreams = max_upstreams
+        self.max_clients = max_clients
+        self.upstreams = set()
+        self.clients = set()
+        self.addresses_flush = None  # statsd flush count when the address sets were reset
+        if self.max_upstreams or self.max_clients:
+            self.register(self.error_breakdown)
+
+        # error bursts: the error rate of the last burst_window seconds is compared to the baseline rate (moving average
+        # of previous cycles), a burst starts when it is burst_factor times higher.  Only per cycle counts are kept,
+        # a cycle split by the time budget is counted once when all of its slices are done.
+        self.burst_window = burst_window
+        self.burst_factor = burst_factor
+        self.burst_errors = 0  # errors of the slices of the current cycle
+        self.cycles = deque()  # (duration, errors) of the cycles in the window
+        self.baseline = None
+        self.bursting = False
+        self.last_collect = None
+
     def collect(self):
         # If log_level is <= warn (e.g. debug, info, notice, warn)
         if ERROR_LOG_LEVELS.index(self.level) <= 3:
             self.init_counters()  # set all error counters to 0
 
+        # the address caps apply per statsd flush (not per cycle, which can be split by the time budget),
+        # so addresses that are gone don't hold places forever
+        flushes = getattr(self.object.statsd, 'flushes', None)
+        if flushes != self.addresses_flush:
+            self.upstreams.clear()
+            self.clients.clear()
+            self.addresses_flush = flushes
+
+        levels = dict.fromkeys(self.counted_levels, 0)
         count = 0
-        for line in self.tail:
+        lines = self.lines()
+        for line in lines:
+            # stop if the cycle is out of its time budget
+            if self.deadline and count and count % self.budget_check_lines == 0 and self.defer(line):
+                break
             count += 1
+
+            level = self.parser.parse_level(line)
+            if level in levels:
+                levels[level] += 1
+
             try:
                 error = self.parser.parse(line)
             except:
@@ -47,10 +108,108 @@ class NginxErrorLogsCollector(AbstractCollector):
                 error = None
 
             if error:
-                super(NginxErrorLogsCollector, self).collect(error)
+                super(NginxErrorLogsCollector, self).collect(error, line)
+
+        for level, level_count in levels.items():
+            if level_count:
+                self.object.statsd.incr('nginx.errorlog.%s' % level, level_count)
+
+        if self.burst_window and self.burst_factor:
+            self.burst_errors += sum(levels[level] for level in self.burst_levels)
+            if self.pending is None:
+                self.detect_burst(self.burst_errors)
+                self.burst_errors = 0
+
+        self.report_backlog()
 
-        tail_name = self.tail.name if isinstance(self.tail, Pipeline) else 'list'
-        context.log.debug('%s processed %s lines from %s' % (self.object.definition_hash, count, tail_name))
+        context.log.debug('%s processed %s lines from %s' % (self.object.definition_hash, count, self.tail_name))
 
-    def error_log_parsed(self, error):
+    def error_log_parsed(self, error, line=None):
         self.object.statsd.incr(error)
+
+    def detect_burst(self, errors, now=None):
+        """
+        Sends a warning event when the error rate over the window gets burst_factor times higher than the baseline
+
+        :param errors: int number of errors in this cycle
+        :param now: float timestamp of the cycle end (current time if not set)
+        """
+        now = now or time.time()
+        duration = now - self.last_collect if self.last_collect else self.interval
+        self.last_collect = now
+        if duration <= 0:
+            return
+
+        cycles = self.cycles
+        cycles.append((duration, errors))
+        window_duration = sum(cycle_duration for cycle_duration, _ in cycles)
+        while len(cycles) > 1 and window_duration - cycles[0][0] >= self.burst_window:
+            window_duration -= cycles.popleft()[0]
+
+        window_errors = sum(cycle_errors for _, cycle_errors in cycles)
+        rate = window_errors / window_duration
+
+        if self.baseline is not None:
+            threshold = self.baseline * self.burst_factor
+            if window_errors >= self.burst_min_errors and rate > threshold:
+                if not self.bursting:
+                    self.bursting = True
+                    self.object.eventd.event(
+                        level=WARNING,
+                        message='nginx error log %s: burst of %d errors in %ds (%.2f/s, baseline %.2f/s)' % (
+                            self.tail_name, window_errors, window_duration, rate, self.baseline
+                        )
+                    )
+            elif rate <= threshold:
+                self.bursting = False
+
+        cycle_rate = errors / duration
+        if self.baseline is None:
+            self.baseline = cycle_rate
+        else:
+            weight = self.baseline_weight
+            if self.interval:
+                weight = min(1.0, weight * duration / self.interval)
+            self.baseline += weight * (cycle_rate - self.baseline)
+
+    @property
+    def tail_name(self):
+        return self.tail.name if isinstance(self.tail, Pipeline) else 'list'
+
+    def error_breakdown(self, error, line):
+        """
+        <error>.upstream.<address>
+        <error>.client.<address>
+
+        Addresses are written with underscores instead of dots and colons (10.0.0.1:80 -> 10_0_0_1_80).
+
+        :param error: str error metric name
+        :param line: str error log line
+        """
+        fields = self.parser.parse_fields(line)
+        if fields is None:
+            return
+
+        if self.max_upstreams and fields.get('upstream'):
+            address = self.capped(self.upstreams, upstream_address(fields['upstream']), self.max_upstreams)
+            self.object.statsd.incr('%s.upstream.%s' % (error, address_re.sub('_', address)))
+
+        if self.max_clients and fields.get('client'):
+            address = self.capped(self.clients, fields['client'], self.max_clients)
+            self.object.statsd.incr('%s.client.%s' % (error, address_re.sub('_', address)))
+
+    @staticmethod
+    def capped(seen, value, limit):
+        """
+        Returns the value if it's one of the first limit distinct values or "other"
+
+        :param seen: set of values seen so far
+        :param value: str
+        :param limit: int
+        :return: str
+        """
+        if value not in seen:
+            if len(seen) >= limit:
+                return 'other'
+            seen.add(value)
+        return value
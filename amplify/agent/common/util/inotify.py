@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+
+
+__author__ = "GetPageSpeed"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__license__ = ""
+__maintainer__ = "GetPageSpeed"
+__email__ = "info@getpagespeed.com"
+
+
+# event masks from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify(object):
+    """
+    Minimal non-blocking inotify binding based on ctypes (Linux only).
+
+    Raises OSError on init if inotify is not available.
+    """
+
+    def __init__(self):
+        library = ctypes.util.find_library('c') or 'libc.so.6'
+        self._libc = ctypes.CDLL(library, use_errno=True)
+
+        for function in ('inotify_init1', 'inotify_add_watch', 'inotify_rm_watch'):
+            if not hasattr(self._libc, function):
+                raise OSError(errno.ENOSYS, '%s is not available' % function)
+
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def add_watch(self, path, mask):
+        """
+        :param path: str path of a file or directory
+        :param mask: int events to watch
+        :return: int watch descriptor
+        """
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """
+        Reads all pending events without blocking
+
+        :return: [] of (wd, mask, name) tuples
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                events.append((wd, mask, name))
+
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
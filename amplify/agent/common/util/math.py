@@ -27,3 +27,49 @@ def median(lst, presorted=False):
         return sorted_lst[n//2]
     else:
         return sum(sorted_lst[n//2-1:n//2+1])/2.0
+
+
+def select(values, ranks):
+    """
+    Returns values of given 0-based ranks (positions in the sorted sequence) without sorting the whole sequence.
+    Uses quickselect that only descends into partitions that contain some of the requested ranks.
+
+    :param values: list/array of float/int numbers
+    :param ranks: iterable of int ranks
+    :return: dict rank -> value
+    """
+    result = {}
+    stack = [(values, 0, sorted(set(ranks)))]
+
+    while stack:
+        values, offset, wanted = stack.pop()
+
+        # small partitions are cheaper to sort
+        if len(values) <= 64:
+            sorted_values = sorted(values)
+            for rank in wanted:
+                result[rank] = sorted_values[rank - offset]
+            continue
+
+        pivot = sorted((values[0], values[len(values) >> 1], values[-1]))[1]  # median of three
+        lows = [x for x in values if x < pivot]
+        highs = [x for x in values if x > pivot]
+
+        lows_end = offset + len(lows)
+        highs_start = offset + len(values) - len(highs)
+
+        lows_wanted, highs_wanted = [], []
+        for rank in wanted:
+            if rank < lows_end:
+                lows_wanted.append(rank)
+            elif rank >= highs_start:
+                highs_wanted.append(rank)
+            else:
+                result[rank] = pivot
+
+        if lows_wanted:
+            stack.append((lows, offset, lows_wanted))
+        if highs_wanted:
+            stack.append((highs, highs_start, highs_wanted))
+
+    return result
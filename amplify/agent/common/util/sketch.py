@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import math
+
+
+__author__ = "GetPageSpeed"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__license__ = ""
+__maintainer__ = "GetPageSpeed"
+__email__ = "info@getpagespeed.com"
+
+
+class DDSketch(object):
+    """
+    Streaming quantile sketch with bounded memory and relative error guarantee (DDSketch).
+
+    Values are counted in logarithmically sized buckets, so any quantile returned is within
+    relative_accuracy of the exact one.  count, sum, min and max are tracked exactly.
+
+    Based on "DDSketch: A Fast and Fully-Mergeable Quantile Sketch with Relative-Error Guarantees"
+    Charles Masson, Jee E. Rim, Homin K. Lee (2019)
+    """
+
+    # values below this are counted as zeroes
+    min_indexable_value = 1e-9
+
+    def __init__(self, relative_accuracy=0.01, max_buckets=2048):
+        """
+        :param relative_accuracy: float relative error of returned quantiles (0 < relative_accuracy < 1)
+        :param max_buckets: int maximum number of buckets, lowest buckets are collapsed when it's exceeded
+        """
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def __len__(self):
+        return self.count
+
+    def add(self, value):
+        if self.count:
+            if value < self.min:
+                self.min = value
+            elif value > self.max:
+                self.max = value
+        else:
+            self.min = self.max = value
+
+        self.count += 1
+        self.sum += value
+
+        if value < self.min_indexable_value:
+            self.zero_count += 1
+            return
+
+        key = int(math.ceil(math.log(value) / self.log_gamma))
+        buckets = self.buckets
+        if key in buckets:
+            buckets[key] += 1
+        else:
+            buckets[key] = 1
+            if len(buckets) > self.max_buckets:
+                self._collapse()
+
+    def extend(self, values):
+        for value in values:
+            self.add(value)
+
+    def _collapse(self):
+        """
+        Merges the two lowest buckets, so only the accuracy of the lowest quantiles suffers
+        """
+        lowest, second = sorted(self.buckets)[:2]
+        self.buckets[second] += self.buckets.pop(lowest)
+
+    def value(self, rank):
+        """
+        Returns approximate value of given 0-based rank (position in the sorted sequence of added values)
+
+        :param rank: int
+        :return: float
+        """
+        if not self.count:
+            return None
+
+        if rank < self.zero_count:
+            return self.min
+
+        cumulative = self.zero_count
+        for key in sorted(self.buckets):
+            cumulative += self.buckets[key]
+            if cumulative > rank:
+                value = 2.0 * self.gamma ** key / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+
+        return self.max
+
+    def quantile(self, q):
+        """
+        Returns approximate q-quantile
+
+        :param q: float 0 <= q <= 1
+        :return: float
+        """
+        return self.value(int(q * (self.count - 1)))
@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
-import copy
 import time
 
-from amplify.agent.common.util.math import median
+from amplify.agent.common.util.math import select
+from amplify.agent.common.util.sketch import DDSketch
+from array import array
 from collections import defaultdict
 
 __author__ = "Mike Belov"
@@ -13,7 +14,7 @@ __email__ = "dedm@nginx.com"
 
 
 class StatsdClient(object):
-    def __init__(self, address=None, port=None, interval=None, object=None):
+    def __init__(self, address=None, port=None, interval=None, object=None, sketch_accuracy=None):
         # Import context as a class object to avoid circular import on statsd.  This could be refactored later.
         from amplify.agent.common.context import context
         self.context = context
@@ -24,6 +25,35 @@ class StatsdClient(object):
         self.interval = interval
         self.current = defaultdict(dict)
         self.delivery = defaultdict(dict)
+        self.flushes = 0  # number of flushes so far, lets writers tell flush periods apart
+
+        # if set, nginx.*.time timers are stored in DDSketch with this relative accuracy instead of all samples
+        self.sketch_accuracy = sketch_accuracy
+        self._sketched_metrics = {}
+
+    def is_sketched(self, metric_name):
+        """
+        Checks if timer values of a metric should go to a sketch
+
+        :param metric_name: metric name (with or without filter suffix)
+        :return: bool
+        """
+        if not self.sketch_accuracy:
+            return False
+
+        sketched = self._sketched_metrics.get(metric_name)
+        if sketched is None:
+            base_name = metric_name.split('||', 1)[0]
+            sketched = self._sketched_metrics[metric_name] = \
+                base_name.startswith('nginx.') and base_name.endswith('.time')
+        return sketched
+
+    def _sketch(self, metric_name):
+        sketches = self.current['sketch']
+        if metric_name in sketches:
+            return sketches[metric_name]
+        sketch = sketches[metric_name] = DDSketch(relative_accuracy=self.sketch_accuracy)
+        return sketch
 
     def latest(self, metric_name, value, stamp=None):
         """
@@ -48,7 +78,7 @@ class StatsdClient(object):
         if metric_name in self.current['average']:
             self.current['average'][metric_name].append(value)
         else:
-            self.current['average'][metric_name] = [value]
+            self.current['average'][metric_name] = array('d', (value,))
 
     def timer(self, metric_name, value):
         """
@@ -57,16 +87,50 @@ class StatsdClient(object):
         The algorithm is as follows:
 
         Collect all the data samples for a period of time (commonly a day, a week, or a month).
-        Sort the data set by value from highest to lowest and discard the highest 5% of the sorted samples.
+        Discard the highest 5% of the samples.
         The next highest sample is the 95th percentile value for the data set.
 
+        Samples are stored as array('d') to avoid keeping a boxed float per value.
+
         :param metric_name: metric name
         :param value: metric value
         """
+        if self.sketch_accuracy and self.is_sketched(metric_name):
+            self._sketch(metric_name).add(value)
+            return
+
         if metric_name in self.current['timer']:
             self.current['timer'][metric_name].append(value)
         else:
-            self.current['timer'][metric_name] = [value]
+            self.current['timer'][metric_name] = array('d', (value,))
+
+    def average_values(self, metric_name, values):
+        """
+        Same as average but for several values at once
+
+        :param metric_name: metric name
+        :param values: list of metric values
+        """
+        if metric_name in self.current['average']:
+            self.current['average'][metric_name].extend(values)
+        else:
+            self.current['average'][metric_name] = array('d', values)
+
+    def timer_values(self, metric_name, values):
+        """
+        Same as timer but for several values at once
+
+        :param metric_name: metric name
+        :param values: list of metric values
+        """
+        if self.sketch_accuracy and self.is_sketched(metric_name):
+            self._sketch(metric_name).extend(values)
+            return
+
+        if metric_name in self.current['timer']:
+            self.current['timer'][metric_name].extend(values)
+        else:
+            self.current['timer'][metric_name] = array('d', values)
 
     def incr(self, metric_name, value=None, rate=None, stamp=None):
         """
@@ -139,31 +203,46 @@ class StatsdClient(object):
             self.current['gauge'][metric_name] = [(timestamp, value)]
 
     def flush(self):
+        self.flushes += 1
         if not self.current:
             return {'object': self.object.definition}
 
         results = {}
-        delivery = copy.deepcopy(self.current)
-        self.current = defaultdict(dict)
+        # nothing references the old values after the swap, so they can be read without copying
+        delivery, self.current = self.current, defaultdict(dict)
 
         # histogram
-        if 'timer' in delivery:
+        if 'timer' in delivery or 'sketch' in delivery:
             timers = {}
             timestamp = int(time.time())
             for metric_name, metric_values in delivery['timer'].items():
                 if len(metric_values):
-                    metric_values.sort()
                     length = len(metric_values)
-                    timers['G|%s' % metric_name] = [[timestamp, sum(metric_values) / float(length)]]
-                    filter_suffix = ""
-                    filter_suffix_index = metric_name.find("||")
-                    if filter_suffix_index > 0:
-                        filter_suffix = metric_name[filter_suffix_index:]
-                        metric_name = metric_name[:filter_suffix_index]
-                    timers['C|%s.count%s' % (metric_name, filter_suffix)] = [[timestamp, length]]
-                    timers['G|%s.max%s' % (metric_name, filter_suffix)] = [[timestamp, metric_values[-1]]]
-                    timers['G|%s.median%s' % (metric_name, filter_suffix)] = [[timestamp, median(metric_values, presorted=True)]]
-                    timers['G|%s.pctl95%s' % (metric_name, filter_suffix)] = [[timestamp, metric_values[-int(round(length * .05))]]]
+                    median_ranks, pctl95_rank = self._timer_ranks(length)
+
+                    # find the needed order statistics with selection instead of sorting all the values
+                    ranked = select(metric_values, median_ranks + (pctl95_rank,))
+
+                    self._timer_results(
+                        timers, timestamp, metric_name,
+                        length=length,
+                        total=sum(metric_values),
+                        max_value=max(metric_values),
+                        median_values=[ranked[rank] for rank in median_ranks],
+                        pctl95=ranked[pctl95_rank]
+                    )
+
+            for metric_name, sketch in delivery['sketch'].items():
+                if len(sketch):
+                    median_ranks, pctl95_rank = self._timer_ranks(sketch.count)
+                    self._timer_results(
+                        timers, timestamp, metric_name,
+                        length=sketch.count,
+                        total=sketch.sum,
+                        max_value=sketch.max,
+                        median_values=[sketch.value(rank) for rank in median_ranks],
+                        pctl95=sketch.value(pctl95_rank)
+                    )
             results['timer'] = timers
 
         # counters
@@ -207,6 +286,95 @@ class StatsdClient(object):
             results['average'] = averages
 
         return {
-            'metrics': copy.deepcopy(results),
+            'metrics': results,
             'object': self.object.definition
         }
+
+    @staticmethod
+    def _timer_ranks(length):
+        """
+        Returns 0-based ranks of the values needed for timer median and pctl95
+
+        :param length: int number of values
+        :return: (), int median ranks and pctl95 rank
+        """
+        middle = length // 2
+        median_ranks = (middle,) if length % 2 else (middle - 1, middle)
+        pctl95_rank = (length - int(round(length * .05))) % length
+        return median_ranks, pctl95_rank
+
+    @staticmethod
+    def _timer_results(timers, timestamp, metric_name, length, total, max_value, median_values, pctl95):
+        timers['G|%s' % metric_name] = [[timestamp, total / float(length)]]
+        filter_suffix = ""
+        filter_suffix_index = metric_name.find("||")
+        if filter_suffix_index > 0:
+            filter_suffix = metric_name[filter_suffix_index:]
+            metric_name = metric_name[:filter_suffix_index]
+        timers['C|%s.count%s' % (metric_name, filter_suffix)] = [[timestamp, length]]
+        timers['G|%s.max%s' % (metric_name, filter_suffix)] = [[timestamp, max_value]]
+        timers['G|%s.median%s' % (metric_name, filter_suffix)] = [[timestamp, sum(median_values) / float(len(median_values))]]
+        timers['G|%s.pctl95%s' % (metric_name, filter_suffix)] = [[timestamp, pctl95]]
+
+
+class StatsdBatch(object):
+    """
+    Local accumulator with the incr/average/timer interface of StatsdClient.
+
+    Hot paths (like access log parsing) can write to a batch instead of the object's StatsdClient and then
+    flush it once per chunk of lines, which makes one StatsdClient call per metric instead of one per line.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.averages = {}  # metric name -> array('d')
+        self.timers = {}  # metric name -> array('d')
+        self.flushes = 0
+
+    def __len__(self):
+        return len(self.counters) + len(self.averages) + len(self.timers)
+
+    def incr(self, metric_name, value=None):
+        if value is None:
+            value = 1
+        elif value < 0:
+            return  # StatsdClient.incr skips negative deltas too
+
+        counters = self.counters
+        if metric_name in counters:
+            counters[metric_name] += value
+        else:
+            counters[metric_name] = value
+
+    def average(self, metric_name, value):
+        averages = self.averages
+        if metric_name in averages:
+            averages[metric_name].append(value)
+        else:
+            averages[metric_name] = array('d', (value,))
+
+    def timer(self, metric_name, value):
+        timers = self.timers
+        if metric_name in timers:
+            timers[metric_name].append(value)
+        else:
+            timers[metric_name] = array('d', (value,))
+
+    def flush(self, statsd, scale=1):
+        """
+        Sends everything accumulated so far to a StatsdClient and resets the batch
+
+        :param statsd: StatsdClient
+        :param scale: int factor for counters (for batches of sampled lines)
+        """
+        for metric_name, value in self.counters.items():
+            statsd.incr(metric_name, value * scale)
+        for metric_name, values in self.averages.items():
+            statsd.average_values(metric_name, values)
+        for metric_name, values in self.timers.items():
+            statsd.timer_values(metric_name, values)
+
+        self.counters = {}
+        self.averages = {}
+        self.timers = {}
+        self.flushes += 1
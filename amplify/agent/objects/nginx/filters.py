@@ -88,3 +88,116 @@ class Filter(object):
             return True
         else:
             return False
+
+
+# regex patterns without these characters match literally (a prefix of a value, as re.match isn't anchored at the end)
+REGEX_SPECIAL_CHARS = re.compile(r'[.^$*+?{}\[\]\\|()]')
+
+
+class FilterMatcher(object):
+    """
+    Matches parsed lines against a set of filters at once, with the same result as Filter.match of every filter.
+
+    Conditions of all filters are grouped by key and every distinct condition is checked once per line:
+        * values of invalid regexes (which are compared as strings) are looked up in a dict
+        * literal regexes match a prefix, so they are looked up in dicts by value prefixes of their lengths
+        * other regexes of a key are combined into one pattern of optional lookaheads with a named group
+          per regex, so one re.match call tells which of them match
+
+    Every condition (and presence of every key) is a bit of a mask, a filter matches if all bits of its
+    conditions are set and none of the bits of its negated conditions are.
+    """
+
+    def __init__(self, filters):
+        self.filters = list(filters)
+        bits = {}  # condition -> bit
+
+        def bit_of(condition):
+            if condition not in bits:
+                bits[condition] = 1 << len(bits)
+            return bits[condition]
+
+        key_conditions = {}  # key -> {condition: filter value}
+        self.plan = []  # (filter, required bits, forbidden bits)
+        for log_filter in self.filters:
+            required = forbidden = 0
+            for key, value in log_filter.data.items():
+                condition = (key, isinstance(value, RE_TYPE), getattr(value, 'pattern', value))
+                key_conditions.setdefault(key, {})[condition] = value
+                required |= bit_of((key,))
+                if log_filter._negated_conditions[key]:
+                    forbidden |= bit_of(condition)
+                else:
+                    required |= bit_of(condition)
+            self.plan.append((log_filter, required, forbidden))
+
+        # (key, presence bit, {value: bits}, ((length, {prefix: bits}), ...), combined regex, ((group, bit), ...),
+        #  ((regex, bit), ...)) per key
+        self.keys = []
+        for key, conditions in key_conditions.items():
+            equals, prefixes, combined, uncombined = {}, {}, [], []
+            for condition, value in conditions.items():
+                bit = bit_of(condition)
+                if not isinstance(value, RE_TYPE):
+                    equals[value] = equals.get(value, 0) | bit
+                elif not REGEX_SPECIAL_CHARS.search(value.pattern):
+                    prefix_bits = prefixes.setdefault(len(value.pattern), {})
+                    prefix_bits[value.pattern] = prefix_bits.get(value.pattern, 0) | bit
+                elif value.groups or value.flags & ~re.UNICODE:
+                    uncombined.append((value, bit))
+                else:
+                    combined.append((value, bit))
+
+            combined_regex, group_bits = None, ()
+            if combined:
+                try:
+                    combined_regex = re.compile(''.join(
+                        '(?:(?=(?P<c%d>%s)))?' % (i, value.pattern) for i, (value, _) in enumerate(combined)
+                    ))
+                except re.error:
+                    uncombined.extend(combined)
+                else:
+                    group_bits = tuple(
+                        (combined_regex.groupindex['c%d' % i], bit) for i, (_, bit) in enumerate(combined)
+                    )
+
+            self.keys.append((
+                key, bit_of((key,)), equals, tuple(prefixes.items()), combined_regex, group_bits, tuple(uncombined)
+            ))
+
+    def match(self, parsed):
+        """
+        Returns filters that match a parsed line
+
+        :param parsed: {} of parsed line
+        :return: [] of matched filters
+        """
+        mask = 0
+        for key, presence_bit, equals, prefixes, combined_regex, group_bits, uncombined in self.keys:
+            if key not in parsed:
+                continue
+            mask |= presence_bit
+            value = str(parsed[key])
+
+            if equals and value in equals:
+                mask |= equals[value]
+
+            for length, prefix_bits in prefixes:
+                prefix = value[:length]
+                if len(prefix) == length and prefix in prefix_bits:
+                    mask |= prefix_bits[prefix]
+
+            if combined_regex is not None:
+                regs = combined_regex.match(value).regs
+                for group, bit in group_bits:
+                    if regs[group][0] >= 0:
+                        mask |= bit
+
+            for regex, bit in uncombined:
+                if regex.match(value):
+                    mask |= bit
+
+        return [
+            log_filter for log_filter, required, forbidden in self.plan
+            if mask & required == required and not mask & forbidden
+        ]
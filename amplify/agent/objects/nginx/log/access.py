@@ -2,9 +2,7 @@
 import re
 
 from amplify.agent.common.context import context
-from amplify.agent.common.util.text import (
-    decompose_format, parse_line_split
-)
+from amplify.agent.common.util.text import decompose_format
 
 
 __author__ = "Mike Belov"
@@ -14,9 +12,46 @@ __maintainer__ = "Mike Belov"
 __email__ = "dedm@nginx.com"
 
 
+# kinds of values in the casting plan of a compiled format
+CAST_VALUE = 'cast'
+TIME_VALUE = 'time'
+LIST_VALUE = 'list'
+RAW_VALUE = 'raw'
+
 REQUEST_RE = re.compile(r'(?P<request_method>[A-Z]+) (?P<request_uri>/.*) (?P<server_protocol>.+)')
 
 
+def cast_value(value, kind, caster):
+    """
+    Converts a value sliced from a log line according to its kind in the casting plan
+
+    :param value: str
+    :param kind: CAST_VALUE, TIME_VALUE or LIST_VALUE
+    :param caster: type for CAST_VALUE
+    :return: converted value or None if it's empty
+    """
+    if kind is CAST_VALUE:
+        try:
+            return caster(value)
+        except ValueError:  # for example gzip ratio can be '-' and float
+            return 0
+    elif kind is TIME_VALUE:
+        # time variables should be parsed to array of float, empty vars are skipped
+        if value in ('', '-'):
+            return None
+        array_value = []
+        for x in value.replace(' ', '').split(','):
+            x = float(x)
+            # workaround for an old nginx bug with time. ask lonerr@ for details
+            if x <= 10000000:
+                array_value.append(x)
+        return array_value or None
+    elif ',' in value:
+        return value.replace(' ', '').split(',')  # remove spaces and split values into list
+    else:
+        return [value]
+
+
 class NginxAccessLogParser(object):
     """
     Nginx access log parser
@@ -61,10 +96,12 @@ class NginxAccessLogParser(object):
         'upstream_status'
     ]
 
-    def __init__(self, raw_format=None):
+    def __init__(self, raw_format=None, demanded_keys=None, lazy_keys=None):
         """
         Takes raw format and generates regex
         :param raw_format: raw log format
+        :param demanded_keys: iterable of keys to parse (None for all), see compile
+        :param lazy_keys: iterable of keys cast only in dict views, see compile
         """
         self.raw_format = self.combined_format if raw_format is None \
             else raw_format
@@ -72,82 +109,176 @@ class NginxAccessLogParser(object):
         self.keys, self.trie, self.non_key_patterns, self.first_value_is_key = \
             decompose_format(self.raw_format, full=True)
 
-    def parse(self, line):
+        self.compile(keys=demanded_keys, lazy_keys=lazy_keys)
+
+    def compile(self, keys=None, lazy_keys=None):
         """
-        Parses the line and if there are some special fields - parse them too
-        For example we can get HTTP method and HTTP version from request
+        Turns the log format into a specialized parse function once, so that
+        the per-line work is reduced to slicing and casting.
 
-        The difference between this and above is that this one uses split
-        mechanic rather than trie matching direclty.
+        Builds:
+            self.fields - names of the values in a parsed record (the last one is always 'malformed')
+            self.field_index - field name -> position in a parsed record
+            self.parse_record - function that takes a line and returns a tuple ordered as self.fields
 
-        :param line: log line
-        :return: dict with parsed info
+        :param keys: iterable of keys whose values are needed (None for all), other values are not sliced
+                     from lines and stay None in records.  "prefix_*" stands for all keys with the prefix.
+        :param lazy_keys: iterable of needed keys that are kept as strings in records and cast only when
+                          a record is converted to dict (for values that only filters read)
         """
-        result = {'malformed': False}
+        fields = []
+        for key in self.keys:
+            if key not in fields:
+                fields.append(key)
+        if 'request' in fields:
+            fields.extend(('request_method', 'request_uri', 'server_protocol'))
+        fields.append('malformed')
 
-        # parse the line
-        parsed = parse_line_split(
-            line,
-            keys=self.keys,
-            non_key_patterns=self.non_key_patterns,
-            first_value_is_key=self.first_value_is_key
-        )
+        self.fields = tuple(fields)
+        self.field_index = dict((field, i) for i, field in enumerate(self.fields))
 
-        if parsed:
-            for key in self.keys:
-                # key local vars
-                time_var = False
+        # request is always needed to detect malformed lines
+        if keys is not None:
+            keys = set(keys)
+            keys.add('request')
+            prefixes = tuple(key[:-1] for key in keys if key.endswith('*'))
+            keys.update(key for key in self.keys if prefixes and key.startswith(prefixes))
+        self.wanted_keys = keys
+        lazy_keys = set(lazy_keys or ()) - {'request'}
 
-                func = self.common_variables[key][1] \
-                    if key in self.common_variables \
-                    else self.default_variable[1]
+        # split plan: value of the n-th key is the text between the (n-1)-th and n-th non-key patterns,
+        # positions of the patterns are found first and only needed values are sliced
+        patterns = tuple(self.non_key_patterns)
+        steps = tuple((pattern, len(pattern)) for pattern in patterns)
+        segment_shift = 0 if self.first_value_is_key else 1
 
-                try:
-                    value = func(parsed[key])
-                # for example gzip ratio can be '-' and float
-                except ValueError:  # couldn't cast log value
-                    value = 0
-                except KeyError:  # something went wrong with line parsing
-                    context.default_log.warn(
-                        'failed to find expected log variable "%s" in access '
-                        'log line, skipping' % key
-                    )
-                    context.default_log.debug('additional info:')
-                    context.default_log.debug(
-                        'keys: %s\nformat: "%s"\nline:"%s"' % (
-                            self.keys,
-                            self.raw_format,
-                            line
-                        )
+        # casting plan: (start cut, start shift, end cut, slot, kind, caster) for every needed key that can be found
+        # in a line, cuts[0] is 0 and cuts[n + 1] is the position where the n-th segment ends
+        # a variable that appears in the format several times gets the value of its last occurrence (like in a dict
+        # built from keys and values), so the keys are planned from the end
+        plan = []
+        lazy_plan = []
+        seen = set()
+        for i, key in reversed(tuple(enumerate(self.keys))):
+            if key in seen:
+                continue
+
+            segment = i + segment_shift
+            if segment > len(patterns):
+                context.default_log.warn(
+                    'log variable "%s" can not be found in access log lines with format "%s", skipping' % (
+                        key, self.raw_format
                     )
+                )
+                continue
+            seen.add(key)
+
+            if keys is not None and key not in keys:
+                continue
+
+            if key.endswith('_time'):
+                kind = TIME_VALUE
+            elif key in self.comma_separated_keys:
+                kind = LIST_VALUE
+            else:
+                kind = CAST_VALUE
+
+            caster = self.common_variables[key][1] \
+                if key in self.common_variables \
+                else self.default_variable[1]
+
+            slot = self.field_index[key]
+            if key in lazy_keys:
+                lazy_plan.append((slot, kind, caster))
+                kind = RAW_VALUE
+
+            start_shift = steps[segment - 1][1] if segment else 0
+            plan.append((segment, start_shift, segment + 1, slot, kind, caster))
+
+        plan = tuple(reversed(plan))
+        self.lazy_plan = tuple(lazy_plan)
+        request_slot = self.field_index.get('request')
+        method_slot = self.field_index.get('request_method')
+        record_length = len(self.fields)
+
+        def parse_record(line):
+            # find all patterns in one pass over the line
+            find = line.find
+            cuts = [0]
+            position = 0
+            for pattern, pattern_length in steps:
+                end = find(pattern, position)
+                if end < 0:
+                    return None
+                cuts.append(end)
+                position = end + pattern_length
+            cuts.append(len(line))
 
-                # time variables should be parsed to array of float
-                if key.endswith('_time'):
-                    time_var = True
-                    # skip empty vars
-                    if value not in ('', '-'):
-                        array_value = []
-                        for x in value.replace(' ', '').split(','):
-                            x = float(x)
-                            # workaround for an old nginx bug with time. ask lonerr@ for details
-                            if x > 10000000:
-                                continue
-                            else:
-                                array_value.append(x)
-                        if array_value:
-                            result[key] = array_value
-
-                # Handle comma separated keys
-                if key in self.comma_separated_keys:
-                    if ',' in value:
-                        list_value = value.replace(' ', '').split(',')  # remove spaces and split values into list
-                        result[key] = list_value
-                    else:
-                        result[key] = [value]
-
-                if key not in result and not time_var:
-                    result[key] = value
-        else:
+            record = [None] * record_length
+            for start_cut, start_shift, end_cut, slot, kind, caster in plan:
+                value = line[cuts[start_cut] + start_shift:cuts[end_cut]]
+
+                if kind is CAST_VALUE:
+                    try:
+                        record[slot] = caster(value)
+                    except ValueError:  # for example gzip ratio can be '-' and float
+                        record[slot] = 0
+                elif kind is RAW_VALUE:
+                    record[slot] = value
+                else:
+                    record[slot] = cast_value(value, kind, caster)
+
+            malformed = False
+            if request_slot is not None:
+                try:
+                    method, uri, proto = record[request_slot].split(' ')
+                except:
+                    malformed = True
+                else:
+                    record[method_slot] = method
+                    record[method_slot + 1] = uri
+                    record[method_slot + 2] = proto
+                    malformed = len(method) < 3
+
+            record[-1] = malformed
+            return tuple(record)
+
+        self.parse_record = parse_record
+
+    def record_to_dict(self, record, fields=None):
+        """
+        Converts a record returned by self.parse_record to the dict view used by self.parse
+
+        :param record: tuple of parsed values
+        :param fields: iterable of fields to include (None for all)
+        :return: dict with parsed info
+        """
+        if self.lazy_plan:
+            record = list(record)
+            for slot, kind, caster in self.lazy_plan:
+                if record[slot] is not None:
+                    record[slot] = cast_value(record[slot], kind, caster)
+
+        if fields is None:
+            return dict((field, value) for field, value in zip(self.fields, record) if value is not None)
+
+        parsed = {}
+        for field in fields:
+            slot = self.field_index.get(field)
+            if slot is not None and record[slot] is not None:
+                parsed[field] = record[slot]
+        return parsed
+
+    def parse(self, line):
+        """
+        Parses the line and if there are some special fields - parse them too
+        For example we can get HTTP method and HTTP version from request
+
+        :param line: log line
+        :return: dict with parsed info
+        """
+        record = self.parse_record(line)
+        if record is None:
             context.default_log.debug(
                 'could not parse line "%s" with format "%s"' % (
                     line, self.raw_format
@@ -155,17 +286,4 @@ class NginxAccessLogParser(object):
             )
             return None
 
-        if 'request' in result:
-            try:
-                method, uri, proto = result['request'].split(' ')
-                result['request_method'] = method
-                result['request_uri'] = uri
-                result['server_protocol'] = proto
-            except:
-                result['malformed'] = True
-                method = ''
-
-            if not result['malformed'] and len(method) < 3:
-                result['malformed'] = True
-
-        return result
+        return self.record_to_dict(record)
@@ -36,12 +36,91 @@ error_re = {
 }
 
 
+# standard error log line: '2015/07/02 14:49:48 [error] 123#0: *4567 message, client: 10.0.0.1, server: ...'
+line_re = re.compile(
+    r'(?P<time>\d{4}/\d\d/\d\d \d\d:\d\d:\d\d) \[(?P<level>[a-z]+)\] (?P<pid>\d+)#(?P<tid>\d+): '
+    r'(?:\*(?P<connection>\d+) )?(?P<message>.*)'
+)
+
+# offset of the level in a standard line (after '2015/07/02 14:49:48 [')
+level_offset = 21
+
+# context fields that nginx adds after the message (quoted values may contain commas)
+context_re = re.compile(
+    r', (?P<key>client|server|request|subrequest|upstream|host|referrer): (?P<value>"(?:[^"\\]|\\.)*"|[^,]*)'
+)
+
+# every regexp of error_re requires one of these substrings, lines without them are not matched at all
+# (see prefilter_keywords)
+error_keywords = ('upstream', 'buffered')
+
+
+def prefilter_keywords(errors, keywords):
+    """
+    Checks that every regexp of errors can only match lines with one of the keywords, so lines without them
+    can be skipped without matching
+
+    :param errors: {} error -> [] of compiled regexps
+    :param keywords: iterable of str
+    :return: () of keywords or an empty tuple if some regexp doesn't require any of them (no prefiltering)
+    """
+    keywords = tuple(keywords)
+    for regexps in errors.values():
+        for regexp in regexps:
+            if not any(_requires(regexp.pattern, keyword) for keyword in keywords):
+                return ()
+    return keywords
+
+
+def _requires(pattern, keyword):
+    """
+    Tells if a regexp of literals and wildcards (like ".*failed.*upstream.*") requires the keyword.
+    Alternatives, groups, classes, escapes and optional parts are not analyzed, regexps with them require nothing.
+
+    :param pattern: str regexp
+    :param keyword: str
+    :return: bool
+    """
+    if any(char in pattern for char in '|()[]{}?\\'):
+        return False
+
+    start = pattern.find(keyword)
+    while start >= 0:
+        # "upstream*" would make the last letter optional
+        if pattern[start + len(keyword):start + len(keyword) + 1] != '*':
+            return True
+        start = pattern.find(keyword, start + 1)
+    return False
+
+
+def compile_classifier(errors):
+    """
+    Combines regexps of errors into one regexp.  Alternatives of an anchored regexp are tried in order,
+    so the first error (in errors order) that has a matching regexp wins like with one-by-one matching.
+
+    :param errors: {} error -> [] of compiled regexps
+    :return: (compiled regexp, {} group name -> error)
+    """
+    branches = []
+    group_errors = {}
+    for error, regexps in errors.items():
+        for regexp in regexps:
+            group = 'e%d' % len(branches)
+            group_errors[group] = error
+            branches.append('(?P<%s>%s)' % (group, regexp.pattern))
+    return re.compile('|'.join(branches)), group_errors
+
+
 class NginxErrorLogParser(object):
     """
     Nginx error log parser
     """
     keys = []  # Included for compatibility with 0 counter handling.
 
+    def __init__(self):
+        self.classifier, self.group_errors = compile_classifier(error_re)
+        self.keywords = prefilter_keywords(error_re, error_keywords)
+
     def parse(self, line):
         """
         Parses the line to find any kind of errors and return it once any first is found
@@ -49,8 +128,66 @@ class NginxErrorLogParser(object):
         :param line: log line
         :return: str or None: error
         """
-        for error, regexps in error_re.items():
-            for regexp in regexps:
-                if re.match(regexp, line):
-                    return error
-        return None
+        if self.keywords:
+            for keyword in self.keywords:
+                if keyword in line:
+                    break
+            else:
+                return None
+
+        match = self.classifier.match(line)
+        if match is None:
+            return None
+        return self.group_errors[match.lastgroup]
+
+    @staticmethod
+    def parse_level(line):
+        """
+        Returns the level of a standard error log line without parsing the rest of it:
+        the level always starts at a fixed offset, right after the timestamp
+
+        :param line: log line
+        :return: str level (like "error") or None if the line is not standard
+        """
+        if line[level_offset - 1:level_offset] != '[':
+            return None
+        end = line.find(']', level_offset, level_offset + 7)
+        if end < 0:
+            return None
+        return line[level_offset:end]
+
+    @staticmethod
+    def parse_fields(line):
+        """
+        Splits a standard error log line into its parts
+
+        :param line: log line
+        :return: {} with time, level, pid, tid, connection (or None), message and context fields
+                 (client, server, request, upstream, host...) found in the line or None if the line is not standard
+        """
+        match = line_re.match(line)
+        if match is None:
+            return None
+
+        fields = match.groupdict()
+        message = fields['message']
+        start = message.find(', client: ')
+        if start >= 0:
+            for context_match in context_re.finditer(message, start):
+                fields[context_match.group('key')] = context_match.group('value').strip('"')
+            fields['message'] = message[:start]
+        return fields
+
+
+def upstream_address(upstream):
+    """
+    Returns address of an upstream from the upstream field of an error line
+
+    :param upstream: str like "http://10.0.0.1:8080/index.php" or "fastcgi://unix:/run/php-fpm.sock:"
+    :return: str like "10.0.0.1:8080" or "unix:/run/php-fpm.sock"
+    """
+    address = upstream.split('://', 1)[-1]
+    if address.startswith('unix:'):
+        # the socket path ends with a colon before the uri
+        return 'unix:' + address[5:].split(':', 1)[0]
+    return address.split('/', 1)[0]
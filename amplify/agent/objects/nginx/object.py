@@ -1,18 +1,20 @@
 # -*- coding: utf-8 -*-
 import time
 
-from amplify.agent.collectors.nginx.accesslog import NginxAccessLogsCollector
+from amplify.agent.collectors.nginx.accesslog import NginxAccessLogsCollector, DEFAULT_BATCH_SIZE
 from amplify.agent.collectors.nginx.config import NginxConfigCollector
 from amplify.agent.collectors.nginx.errorlog import NginxErrorLogsCollector
 
 from amplify.agent.common.context import context
 from amplify.agent.common.util import http, net, plus
+from amplify.agent.common.util.configtypes import boolean
 from amplify.agent.data.eventd import INFO, WARNING
 from amplify.agent.objects.abstract import AbstractObject
 from amplify.agent.objects.nginx.binary import nginx_v
 from amplify.agent.objects.nginx.filters import Filter
+from amplify.agent.pipelines.pool import setup_log_workers
 from amplify.agent.pipelines.syslog import SyslogTail
-from amplify.agent.pipelines.file import FileTail
+from amplify.agent.pipelines.file import FileTail, CATCHUP_THRESHOLD, setup_offset_store, setup_watcher, shared_tail
 
 
 __author__ = "Mike Belov"
@@ -47,6 +49,34 @@ class NginxObject(AbstractObject):
         self.run_config_test = self.data.get('run_test') or default_config.get('run_test', False)
         self.upload_ssl = self.data.get('upload_ssl') or default_config.get('upload_ssl', False)
 
+        # log processing settings from the [nginx] section of agent.conf
+        log_config = context.app_config.get('nginx', {})
+        self.access_log_batch_size = int(log_config.get('access_log_batch_size', DEFAULT_BATCH_SIZE))
+        self.log_catchup_threshold = int(log_config.get('log_catchup_threshold', CATCHUP_THRESHOLD))
+        self.log_max_backlog = int(log_config.get('log_max_backlog', 0))
+        self.log_workers = int(log_config.get('log_workers', 0))
+        self.access_log_sample_rate = int(log_config.get('access_log_sample_rate', 1))
+        self.access_log_cpu_budget = float(log_config.get('access_log_cpu_budget', 0))
+        self.access_log_aggregate = boolean(log_config.get('access_log_aggregate', False))
+        self.log_time_budget = float(log_config.get('log_time_budget', 0.2))
+        self.error_log_max_upstreams = int(log_config.get('error_log_max_upstreams', 100))
+        self.error_log_max_clients = int(log_config.get('error_log_max_clients', 0))
+        self.error_log_burst_window = int(log_config.get('error_log_burst_window', 300))
+        self.error_log_burst_factor = float(log_config.get('error_log_burst_factor', 5))
+        self.syslog_rcvbuf = int(log_config.get('syslog_rcvbuf', 0))
+
+        # resume log tailing from offsets saved before agent restart
+        if log_config.get('offsets_file'):
+            setup_offset_store(log_config['offsets_file'])
+
+        # track changes of tailed files with inotify instead of checking every file on every collection
+        if boolean(log_config.get('log_inotify', True)):
+            setup_watcher()
+
+        # keep nginx.*.time timers in bounded memory sketches instead of all samples
+        if boolean(log_config.get('timer_sketch', False)):
+            self.statsd.sketch_accuracy = float(log_config.get('timer_sketch_accuracy', 0.01))
+
         # nginx -V data
         self.parsed_v = nginx_v(self.bin_path)
 
@@ -254,11 +284,13 @@ class NginxObject(AbstractObject):
                     context.log.debug('bad response from %s url %s' % (what, full_url))
         return None
 
-    def __setup_pipeline(self, name):
+    def __setup_pipeline(self, name, shared=False, lines_per_record=1):
         """
         Sets up a pipeline/tail object for a collector based on "filename".
 
         :param name: Str
+        :param shared: Bool share reading of the file with other tails of it
+        :param lines_per_record: Int number of lines in a log record (for log formats with newlines)
         :return: Pipeline
         """
         tail = None
@@ -272,9 +304,14 @@ class NginxObject(AbstractObject):
 
                 if address in context.listeners:
                     port = int(port)  # socket requires integer port
-                    tail = SyslogTail(address=(host, port))
+                    tail = SyslogTail(address=(host, port), rcvbuf=self.syslog_rcvbuf)
             else:
-                tail = FileTail(name)
+                tail = (shared_tail if shared else FileTail)(
+                    name,
+                    catchup_threshold=self.log_catchup_threshold,
+                    max_backlog=self.log_max_backlog,
+                    lines_per_record=lines_per_record
+                )
         except Exception as e:
             context.log.error(
                 'failed to initialize pipeline for "%s" due to %s (maybe has no rights?)' % (name, e.__class__.__name__)
@@ -283,6 +320,33 @@ class NginxObject(AbstractObject):
 
         return tail
 
+    def __setup_worker_pipeline(self, name, log_format):
+        """
+        Sets up processing of an access log file in a log worker process.
+
+        :param name: Str
+        :param log_format: Str
+        :return: PoolTail
+        """
+        tail = None
+        try:
+            tail = setup_log_workers(self.log_workers).tail(
+                name,
+                log_format=log_format,
+                filters=self.filters,
+                definition_hash=self.definition_hash,
+                catchup_threshold=self.log_catchup_threshold,
+                max_backlog=self.log_max_backlog,
+                lines_per_record=log_format.count('\n') + 1 if log_format else 1
+            )
+        except Exception as e:
+            context.log.error(
+                'failed to initialize log worker pipeline for "%s" due to %s' % (name, e.__class__.__name__)
+            )
+            context.log.debug('additional info:', exc_info=True)
+
+        return tail
+
     def _setup_meta_collector(self):
         collector_cls = self._import_collector_class('nginx', 'meta')
         self.collectors.append(
@@ -324,7 +388,13 @@ class NginxObject(AbstractObject):
         for log_description, log_data in self.config.access_logs.items():
             format_name = log_data['log_format']
             log_format = self.config.log_formats.get(format_name)
-            tail = self.__setup_pipeline(log_description)
+            if self.log_workers and not log_description.startswith('syslog'):
+                tail = self.__setup_worker_pipeline(log_description, log_format)
+            else:
+                # the same file may be tailed by other objects (e.g. during reload) or under other names
+                tail = self.__setup_pipeline(
+                    log_description, shared=True, lines_per_record=log_format.count('\n') + 1 if log_format else 1
+                )
 
             if tail:
                 self.collectors.append(
@@ -332,7 +402,12 @@ class NginxObject(AbstractObject):
                         object=self,
                         interval=self.intervals['logs'],
                         log_format=log_format,
-                        tail=tail
+                        tail=tail,
+                        batch_size=self.access_log_batch_size,
+                        sample_rate=self.access_log_sample_rate,
+                        cpu_budget=self.access_log_cpu_budget,
+                        aggregate=self.access_log_aggregate,
+                        time_budget=self.log_time_budget
                     )
                 )
 
@@ -351,7 +426,12 @@ class NginxObject(AbstractObject):
                         object=self,
                         interval=self.intervals['logs'],
                         level=log_level,
-                        tail=tail
+                        tail=tail,
+                        time_budget=self.log_time_budget,
+                        max_upstreams=self.error_log_max_upstreams,
+                        max_clients=self.error_log_max_clients,
+                        burst_window=self.error_log_burst_window,
+                        burst_factor=self.error_log_burst_factor
                     )
                 )
 
@@ -1,7 +1,17 @@
+import itertools
+import json
+import mmap
+import operator
+import os
 import time
-from os import stat
+import zlib
+from os import fstat, stat
 
 from amplify.agent.common.context import context
+from amplify.agent.common.util.inotify import (
+    Inotify, IN_MODIFY, IN_ATTRIB, IN_MOVE_SELF, IN_DELETE_SELF, IN_IGNORED, IN_Q_OVERFLOW,
+    IN_CREATE, IN_MOVED_TO, IN_MOVED_FROM, IN_DELETE
+)
 
 from amplify.agent.pipelines.abstract import Pipeline
 
@@ -16,6 +26,316 @@ __email__ = "dedm@nginx.com"
 # this one is used to store offset between objects' reloads
 OFFSET_CACHE = {}
 
+# optional on-disk copy of offsets to resume tailing after agent restarts (see setup_offset_store)
+OFFSET_STORE = None
+
+# optional shared watcher that tells which tailed files changed (see setup_watcher)
+WATCHER = None
+
+# sources of shared tails by (st_dev, st_ino) of the tailed file and lines per record (see shared_tail)
+SHARED_TAILS = {}
+
+# number of lines a shared source reads at once before passing them to subscribers
+SHARED_READ_SIZE = 10000
+
+# number of bytes from the start of a file used to recognize it after agent restarts
+FINGERPRINT_SIZE = 256
+
+# how much to read from a file at once in block mode
+BLOCK_SIZE = 1024 * 1024
+
+# backlog (bytes between the offset and EOF) after which a file is memory-mapped for catch-up reading
+CATCHUP_THRESHOLD = 64 * 1024 * 1024
+
+
+def setup_offset_store(path, save_interval=10):
+    """
+    Enables persisting of FileTail offsets to a file
+
+    :param path: str path of the offsets file
+    :param save_interval: int minimum number of seconds between writes
+    :return: OffsetStore
+    """
+    global OFFSET_STORE
+    if OFFSET_STORE is None or OFFSET_STORE.path != path:
+        OFFSET_STORE = OffsetStore(path, save_interval=save_interval)
+    return OFFSET_STORE
+
+
+def setup_watcher():
+    """
+    Enables inotify-based change tracking of tailed files, tails fall back to polling if it's not available
+
+    :return: FileWatcher or None
+    """
+    global WATCHER
+    if WATCHER is None:
+        try:
+            WATCHER = FileWatcher()
+        except Exception:
+            context.log.debug("inotify is not available, tailed files will be polled", exc_info=True)
+    return WATCHER
+
+
+def shared_tail(filename, **kwargs):
+    """
+    Returns a tail of a file that shares reading with other tails of the same file (by device and inode),
+    so a file referenced by several access_log directives or nginx objects is read and decoded only once
+
+    :param filename: str
+    :param kwargs: FileTail kwargs used if the file isn't tailed yet
+    :return: SharedFileTail
+    """
+    st = stat(filename)
+    source = SHARED_TAILS.get((st.st_dev, st.st_ino, kwargs.get("lines_per_record", 1)))
+    if source is None:
+        source = SharedFileSource(filename, **kwargs)
+        SHARED_TAILS[source.key] = source
+    return SharedFileTail(filename, source)
+
+
+def fingerprint(fd, length=FINGERPRINT_SIZE):
+    """
+    Returns length and crc32 of the first bytes of an open file (without moving its position)
+
+    :param fd: int file descriptor
+    :param length: int max number of bytes to use
+    :return: (int, int)
+    """
+    head = os.pread(fd, length, 0)
+    return len(head), zlib.crc32(head)
+
+
+class OffsetStore(object):
+    """
+    Keeps FileTail offsets on disk, so tailing can resume where it stopped after an agent restart.
+
+    Every file is stored with its inode and fingerprint (crc32 of its first bytes).  A stored offset is used
+    only if both still match, otherwise the file is treated as a new one.  Writes are atomic (temporary file
+    and rename) and happen at most once per save_interval seconds unless forced.  Entries of files that were removed
+    or replaced by another file are dropped on save.
+    """
+
+    def __init__(self, path, save_interval=10):
+        self.path = path
+        self.save_interval = save_interval
+        self.offsets = self._load()
+        self._dirty = False
+        self._last_save = time.time()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception:
+            context.log.warning(f'failed to load log offsets from "{self.path}", ignoring them')
+            context.log.debug("additional info:", exc_info=True)
+            return {}
+
+        # entries are (inode, offset, fingerprint length, fingerprint crc)
+        return dict((filename, tuple(entry)) for filename, entry in data.items())
+
+    def get(self, filename):
+        """
+        Returns stored offset of a file if it is still the same file
+
+        :param filename: str
+        :return: int offset or None
+        """
+        entry = self.offsets.get(filename)
+        if entry is None:
+            return None
+
+        inode, offset, length, crc = entry
+        try:
+            with open(filename, "rb") as f:
+                st = fstat(f.fileno())
+                if st.st_ino != inode or st.st_size < offset or fingerprint(f.fileno(), length) != (length, crc):
+                    return None
+        except OSError:
+            return None
+        return offset
+
+    def set(self, filename, inode, offset, file_fingerprint):
+        entry = (inode, offset) + tuple(file_fingerprint)
+        if self.offsets.get(filename) != entry:
+            self.offsets[filename] = entry
+            self._dirty = True
+
+    def save(self, force=False):
+        """
+        Writes offsets to disk if something changed and save_interval passed since the last write
+
+        :param force: bool write regardless of save_interval
+        """
+        now = time.time()
+        if not self._dirty or (not force and now < self._last_save + self.save_interval):
+            return
+
+        self._prune()
+        temp_path = f"{self.path}.tmp"
+        try:
+            with open(temp_path, "w") as f:
+                json.dump(self.offsets, f)
+            os.replace(temp_path, self.path)
+        except Exception:
+            context.log.error(f'failed to save log offsets to "{self.path}"')
+            context.log.debug("additional info:", exc_info=True)
+
+        self._dirty = False
+        self._last_save = now
+
+
+    def _prune(self):
+        """
+        Drops entries of files that don't exist anymore or have another inode, their offsets can't be used (see get)
+        """
+        for filename, entry in list(self.offsets.items()):
+            try:
+                if stat(filename).st_ino == entry[0]:
+                    continue
+            except OSError:
+                pass
+            del self.offsets[filename]
+
+
+class FileWatcher(object):
+    """
+    Tracks modification, rotation and truncation of all tailed files in one place using inotify.
+
+    Every file is watched itself (writes, truncation, rename, removal) and through its directory (a new file created
+    or moved in under the same name), so tails of idle files don't have to stat() and open() them on every read.
+    A file that can't be watched (it doesn't exist yet or inotify limits are reached) is always reported as changed,
+    which means it's polled as before.
+
+    Changes are counted per file (see version), so every tail of a file sees every change no matter how many other
+    tails of the same file checked it before.
+    """
+
+    FILE_EVENTS = IN_MODIFY | IN_ATTRIB | IN_MOVE_SELF | IN_DELETE_SELF
+    DIRECTORY_EVENTS = IN_CREATE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE
+
+    # events after which a file watch may follow a file that is not at the watched path anymore
+    REWATCH_EVENTS = IN_ATTRIB | IN_MOVE_SELF | IN_DELETE_SELF | IN_IGNORED
+
+    def __init__(self):
+        self.inotify = Inotify()
+        self.tails = {}  # filename -> number of tails watching it
+        self.versions = {}  # filename -> number of changes seen so far
+
+        self.file_watches = {}  # filename -> wd
+        self.watched_files = {}  # wd -> set of filenames
+
+        self.directory_watches = {}  # directory -> wd
+        self.watched_directories = {}  # wd -> {basename: filename}
+
+    def watch(self, filename):
+        if filename in self.tails:
+            self.tails[filename] += 1
+            return
+
+        self.tails[filename] = 1
+        self.versions[filename] = 0
+        self._add_file_watch(filename)
+
+        directory, name = os.path.split(filename)
+        directory = directory or "."
+        if directory not in self.directory_watches:
+            try:
+                wd = self.inotify.add_watch(directory, self.DIRECTORY_EVENTS)
+            except OSError:
+                context.log.debug(f'failed to watch directory "{directory}"', exc_info=True)
+                return
+            self.directory_watches[directory] = wd
+            self.watched_directories.setdefault(wd, {})
+        self.watched_directories[self.directory_watches[directory]][name] = filename
+
+    def unwatch(self, filename):
+        if filename not in self.tails:
+            return
+
+        self.tails[filename] -= 1
+        if self.tails[filename]:
+            return
+
+        del self.tails[filename]
+        del self.versions[filename]
+        self._remove_file_watch(filename)
+
+        directory, name = os.path.split(filename)
+        wd = self.directory_watches.get(directory or ".")
+        if wd is not None:
+            names = self.watched_directories[wd]
+            names.pop(name, None)
+            if not names:
+                del self.watched_directories[wd]
+                del self.directory_watches[directory or "."]
+                self.inotify.rm_watch(wd)
+
+    def version(self, filename):
+        """
+        Returns a number that changes whenever the file might have changed.  A tail compares it with the number
+        returned before its previous read, the same number means there is nothing new to read.
+
+        :param filename: str
+        :return: int or None if the file is not watched and has to be polled
+        """
+        self._read_events()
+
+        if filename not in self.file_watches:
+            # not watched (anymore), watch the file at its path again and poll it this time
+            if filename in self.tails:
+                self._add_file_watch(filename)
+            return None
+        return self.versions.get(filename)
+
+    def close(self):
+        self.inotify.close()
+
+    def _add_file_watch(self, filename):
+        try:
+            wd = self.inotify.add_watch(filename, self.FILE_EVENTS)
+        except OSError:
+            return
+        self.file_watches[filename] = wd
+        self.watched_files.setdefault(wd, set()).add(filename)
+
+    def _remove_file_watch(self, filename):
+        wd = self.file_watches.pop(filename, None)
+        if wd is None:
+            return
+
+        filenames = self.watched_files[wd]
+        filenames.discard(filename)
+        if not filenames:
+            del self.watched_files[wd]
+            self.inotify.rm_watch(wd)
+
+    def _read_events(self):
+        for wd, mask, name in self.inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                # events were lost
+                self._changed(self.tails)
+            elif wd in self.watched_files:
+                filenames = list(self.watched_files[wd])
+                self._changed(filenames)
+                if mask & self.REWATCH_EVENTS:
+                    for filename in filenames:
+                        self._remove_file_watch(filename)
+            elif name and wd in self.watched_directories:
+                filename = self.watched_directories[wd].get(name)
+                if filename is not None:
+                    # some other file may be at the path now
+                    self._changed((filename,))
+                    self._remove_file_watch(filename)
+
+    def _changed(self, filenames):
+        for filename in filenames:
+            if filename in self.versions:
+                self.versions[filename] += 1
+
 
 class FileTail(Pipeline):
     """
@@ -26,27 +346,74 @@ class FileTail(Pipeline):
     Copyright (C) 2011 Brad Greenlee <brad@footle.org>
 
     https://raw.githubusercontent.com/bgreenlee/pygtail/master/pygtail/core.py
+
+    The file is read in binary blocks of block_size bytes which are split into lines and decoded once per block.
+    An incomplete last line of a block is carried over to the next read, so offsets always point to a line start.
+    With block_size=0 the file is read line by line.
+
+    If the backlog is bigger than catchup_threshold when iteration starts (after an agent restart or a long stall),
+    blocks are taken from a memory map of the file instead of read() calls.  If max_backlog is set, the oldest part
+    of a bigger backlog is skipped and the number of skipped bytes is added to self.skipped_bytes.
+
+    Lines are read in passes: a pass starts with the first __next__ call after the previous pass reached the end of
+    the file (iter() of the tail doesn't do anything).  If a FileWatcher is set up, a pass over a file that didn't
+    change since the previous pass ends right away, without stat() and open() calls.
+
+    With lines_per_record > 1 (log formats with newlines) the tail returns records of that many lines joined with
+    "\n".  Blocks are cut at record boundaries, so offsets always point to a record start, and an incomplete record
+    left in a rotated or truncated file is dropped: reading of the new file starts with a whole record.
     """
 
-    def __init__(self, filename):
+    def __init__(self, filename, block_size=BLOCK_SIZE, catchup_threshold=CATCHUP_THRESHOLD, max_backlog=0,
+                 lines_per_record=1):
         super().__init__(name=f"file:{filename}")
         self.filename = filename
+        self.block_size = block_size
+        self.lines_per_record = lines_per_record
+        self.catchup_threshold = catchup_threshold
+        self.max_backlog = max_backlog
+        self.skipped_bytes = 0
         self._fh = None
 
-        # open a file and seek to the end
+        # block mode buffers: iterator over decoded lines of the current block and the undecoded partial line after them
+        self._lines = iter(())
+        self._partial = b""
+
+        # catch-up mode: memory map of the file and position of the next unread byte in it
+        self._map = None
+        self._map_position = 0
+
+        # fingerprint of the file for the offset store (computed on demand)
+        self._fingerprint = None
+
+        # resume from the offset stored before agent restart or open a file and seek to the end
         if self.filename not in OFFSET_CACHE:
-            with open(self.filename, errors="replace") as f:
-                f.seek(0, 2)
-                self._offset = OFFSET_CACHE[self.filename] = f.tell()
+            offset = OFFSET_STORE.get(self.filename) if OFFSET_STORE is not None else None
+            if offset is None:
+                with open(self.filename, "rb") as f:
+                    f.seek(0, 2)
+                    offset = f.tell()
+            else:
+                context.log.debug(f'resuming "{self.filename}" from stored offset {offset}')
+            self._offset = OFFSET_CACHE[self.filename] = offset
         else:
             self._offset = OFFSET_CACHE[self.filename]
 
         # save inode to determine rotations
         self._inode = self._st_ino()
 
+        # a pass over the file is in progress (see __next__)
+        self._reading = False
+
+        self._watcher = WATCHER
+        self._version = None  # watcher version of the file before the last pass
+        if self._watcher is not None:
+            self._watcher.watch(self.filename)
+
     def __del__(self):
         try:
-            if self._filehandle():
+            if not self._is_closed():
+                self._close_map()
                 self._fh.close()
         except Exception:
             # __del__ runs during GC / interpreter shutdown, where context.log
@@ -54,9 +421,18 @@ class FileTail(Pipeline):
             # must never raise (it surfaces as an unraisable-exception warning).
             pass
 
-    def __iter__(self):
-        self._filehandle()
-        return self
+        try:
+            self.stop()  # release the file watch
+        except Exception:
+            pass
+
+    def stop(self):
+        if self._watcher is not None:
+            self._watcher.unwatch(self.filename)
+            self._watcher = None
+
+        if OFFSET_STORE is not None:
+            OFFSET_STORE.save(force=True)
 
     def _st_ino(self):
         return stat(self.filename).st_ino
@@ -107,20 +483,71 @@ class FileTail(Pipeline):
         """
         Return the next line in the file, updating the offset.
         """
+        # fast path for lines of the current block
+        for line in self._lines:
+            return line
+
+        if not self._reading and not self._start_pass():
+            raise StopIteration
+
         try:
             line = self._get_next_line()
         except StopIteration:
             # we've reached the end of the file;
+            self._reading = False
             self._update_offset()
             raise
         return line
 
+    def _start_pass(self):
+        """
+        Opens (or reopens after rotation) the file for a new pass over its unread lines
+
+        :return: bool False if the file didn't change since the previous pass
+        """
+        version = None
+        if self._watcher is not None:
+            version = self._watcher.version(self.filename)
+            if version is not None and version == self._version and not self._is_closed():
+                if OFFSET_STORE is not None:
+                    OFFSET_STORE.save()
+                return False
+
+        self._filehandle()
+        if self.block_size:
+            self._check_backlog()
+        self._version = version
+        self._reading = True
+        return True
+
+    def __length_hint__(self):
+        # lines of the current block that were read from the file but not returned yet
+        return operator.length_hint(self._lines)
+
     def readlines(self):
         """
         Read in all unread lines and return them as a list.
         """
         return [line for line in self]
 
+    def checkpoint(self):
+        """
+        Returns the inode and the offset where the last read pass ended
+
+        :return: (int inode, int offset)
+        """
+        return self._inode, self._offset
+
+    def backlog(self):
+        """
+        Returns the number of bytes of the file that were not read yet
+
+        :return: int
+        """
+        if self._is_closed():
+            return 0
+        return max(fstat(self._fh.fileno()).st_size - self._position(), 0)
+
     def _is_closed(self):
         if not self._fh:
             return True
@@ -134,22 +561,394 @@ class FileTail(Pipeline):
         file_was_rotated = self._file_was_rotated()
 
         if not self._fh or self._is_closed() or file_was_rotated:
+            self._close_map()
             if not self._is_closed():
                 self._fh.close()
 
             if file_was_rotated:
                 self._update_inode()
                 self._offset = OFFSET_CACHE[self.filename] = 0
+                self._fingerprint = None
 
-            self._fh = open(self.filename, errors="replace")
+            self._fh = open(self.filename, "rb")
             self._fh.seek(self._offset)
+            self._lines = iter(())
+            self._partial = b""
         return self._fh
 
+    def _position(self):
+        """
+        Returns the file position of the first byte that was not split into lines yet
+        """
+        position = self._map_position if self._map is not None else self._fh.tell()
+        # bytes of an incomplete line were read but not returned yet
+        return position - len(self._partial)
+
     def _update_offset(self):
-        self._offset = OFFSET_CACHE[self.filename] = self._filehandle().tell()
+        self._filehandle()
+        self._offset = OFFSET_CACHE[self.filename] = self._position()
+
+        if OFFSET_STORE is not None:
+            # the fingerprint is recomputed only while the file is shorter than FINGERPRINT_SIZE
+            if self._fingerprint is None or self._fingerprint[0] < min(self._offset, FINGERPRINT_SIZE):
+                self._fingerprint = fingerprint(self._fh.fileno())
+            OFFSET_STORE.set(self.filename, self._inode, self._offset, self._fingerprint)
+            OFFSET_STORE.save()
+
+    def _check_backlog(self):
+        """
+        Skips the oldest part of the backlog if it exceeds self.max_backlog and switches to catch-up reading
+        from a memory map if the backlog exceeds self.catchup_threshold
+        """
+        size = fstat(self._fh.fileno()).st_size
+        position = self._position()
+        backlog = size - position
+
+        if self.max_backlog and backlog > self.max_backlog:
+            # resume from the first full line (or record) within the last max_backlog bytes
+            self._close_map()
+            if self.lines_per_record > 1:
+                self._skip_to_record(position, size - self.max_backlog)
+            else:
+                self._fh.seek(size - self.max_backlog)
+                if not self._fh.readline().endswith(b"\n"):
+                    # the last line is not complete yet, resume at its start
+                    self._fh.seek(self._line_start(position, size - self.max_backlog))
+            self._lines = iter(())
+            self._partial = b""
+
+            new_position = self._fh.tell()
+            self.skipped_bytes += new_position - position
+            backlog = size - new_position
+            context.log.debug(f'skipped {new_position - position} bytes of backlog in "{self.filename}"')
+
+        if self._map is None and self.catchup_threshold and backlog > self.catchup_threshold:
+            position = self._position()
+            self._map = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+            self._map_position = position
+            self._partial = b""
+            context.log.debug(f'catching up {backlog} bytes of backlog in "{self.filename}" using mmap')
+
+    def _line_start(self, position, target):
+        """
+        Finds the start of the line at target by looking for the last newline before it
+
+        :param position: int position of a line start before target
+        :param target: int position within the line
+        :return: int position of the line start
+        """
+        end = target
+        while end > position:
+            start = max(position, end - BLOCK_SIZE)
+            self._fh.seek(start)
+            newline = self._fh.read(end - start).rfind(b"\n")
+            if newline >= 0:
+                return start + newline + 1
+            end = start
+        return position
+
+    def _skip_to_record(self, position, target):
+        """
+        Moves the file position to the first record start after target.  Records can't be recognized by their
+        content, so newlines between the current record start and target are counted to find the record boundary.
+        If the record at target is not complete yet, the position is left at the last record start before it.
+
+        :param position: int position of a record start
+        :param target: int position to skip to
+        """
+        self._fh.seek(position)
+        boundary = position  # end of the last complete record before target
+        lines = 0
+        while position < target:
+            data = self._fh.read(min(BLOCK_SIZE, target - position))
+            if not data:
+                break
+            count = data.count(b"\n")
+            extra = (lines + count) % self.lines_per_record  # lines of an unfinished record at the block end
+            if count > extra:
+                end = len(data)
+                for _ in range(extra + 1):
+                    end = data.rfind(b"\n", 0, end)
+                boundary = position + end + 1
+            lines += count
+            position += len(data)
+
+        # the rest of the line at target and the rest of its record
+        complete = self._fh.readline().endswith(b"\n")
+        if complete:
+            lines += 1
+            for _ in range(-lines % self.lines_per_record):
+                if not self._fh.readline().endswith(b"\n"):
+                    complete = False
+                    break
+
+        if not complete:
+            self._fh.seek(boundary)
+
+    def _close_map(self):
+        if self._map is not None:
+            if not self._is_closed():
+                self._fh.seek(self._map_position)  # regular reads continue where the map ended
+            self._map.close()
+            self._map = None
+
+    def _set_lines(self, text):
+        if "\r" in text:
+            lines = [line.rstrip("\r") for line in text.split("\n")]
+        else:
+            lines = text.split("\n")
+
+        if self.lines_per_record > 1:
+            # blocks end at record boundaries, so the lines are grouped without a remainder
+            lines = iter(lines)
+            lines = list(map("\n".join, zip(*[lines] * self.lines_per_record)))
+        self._lines = iter(lines)
+
+    def _cut_records(self, data, start, end, text):
+        """
+        Cuts a block at the end of its last complete record
+
+        :param data: bytes or mmap
+        :param start: int position of the block start in data
+        :param end: int position of the last newline of the block in data
+        :param text: str decoded data[start:end]
+        :return: (int position of the newline after the last record or -1 if there is none, str text of the records)
+        """
+        cut = len(text)
+        for _ in range((text.count("\n") + 1) % self.lines_per_record):
+            end = data.rfind(b"\n", start, end)
+            cut = text.rfind("\n", 0, cut)
+        return end, text[:cut]
+
+    def _read_mapped_block(self):
+        """
+        Takes the next block from the memory map without copying it before decoding
+
+        :return: bool False if the mapped region is consumed and regular reads should continue
+        """
+        mapped = self._map
+        start = self._map_position
+
+        # a file truncated under the mapping must not be touched (it would raise SIGBUS)
+        if start >= len(mapped) or fstat(self._fh.fileno()).st_size < len(mapped):
+            self._close_map()
+            return False
+
+        limit = start + self.block_size
+        end = mapped.rfind(b"\n", start, limit)
+        if end < 0:
+            end = mapped.find(b"\n", start)
+
+        while end >= 0:
+            with memoryview(mapped) as view, view[start:end] as chunk:
+                text = str(chunk, "utf-8", "replace")
+            if self.lines_per_record == 1:
+                break
+
+            end, text = self._cut_records(mapped, start, end, text)
+            if end >= 0 or limit >= len(mapped):
+                break
+            # the block is smaller than a record
+            limit += self.block_size
+            end = mapped.rfind(b"\n", start, limit)
+
+        if end < 0:
+            # only an incomplete line (or record) is left
+            self._close_map()
+            return False
+
+        self._map_position = end + 1
+        self._set_lines(text)
+        return True
+
+    def _read_block(self):
+        """
+        Reads the next block of the file and splits it into lines
+
+        :return: bool False if there is nothing more to read
+        """
+        if self._map is not None and self._read_mapped_block():
+            return True
+
+        while True:
+            data = self._fh.read(self.block_size)
+            if not data:
+                return False
+
+            if self._partial:
+                data = self._partial + data
+
+            end = data.rfind(b"\n")
+            if end >= 0:
+                text = data[:end].decode("utf-8", errors="replace")
+                if self.lines_per_record > 1:
+                    end, text = self._cut_records(data, 0, end, text)
+            if end < 0:
+                # no complete line (or record) yet, keep reading
+                self._partial = data
+                continue
+
+            self._partial = data[end + 1:]
+            self._set_lines(text)
+            return True
 
     def _get_next_line(self):
-        line = self._fh.readline()
-        if not line:
-            raise StopIteration
-        return line.rstrip("\n\r")
+        if not self.block_size:
+            if self.lines_per_record > 1:
+                return self._read_record()
+            line = self._fh.readline()
+            if not line:
+                raise StopIteration
+            return line.decode("utf-8", errors="replace").rstrip("\n\r")
+
+        while self._read_block():
+            for line in self._lines:
+                return line
+        raise StopIteration
+
+    def _read_record(self):
+        """
+        Reads the next record line by line (with block_size=0)
+        """
+        start = self._fh.tell()
+        lines = []
+        for _ in range(self.lines_per_record):
+            line = self._fh.readline()
+            if not line.endswith(b"\n"):
+                # the record isn't complete yet
+                self._fh.seek(start)
+                raise StopIteration
+            lines.append(line.decode("utf-8", errors="replace").rstrip("\n\r"))
+        return "\n".join(lines)
+
+
+class SharedFileSource(object):
+    """
+    Reads a file with a single FileTail and passes every line to all subscribed SharedFileTails
+    """
+
+    def __init__(self, filename, **kwargs):
+        self.tail = FileTail(filename, **kwargs)
+        self.device = stat(filename).st_dev
+        self.subscribers = []
+        self._reading = False
+
+    @property
+    def key(self):
+        return self.device, self.tail._inode, self.tail.lines_per_record
+
+    def subscribe(self, subscriber):
+        self.subscribers.append(subscriber)
+
+    def unsubscribe(self, subscriber):
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+
+        if not self.subscribers:
+            self.tail.stop()
+            if SHARED_TAILS.get(self.key) is self:
+                del SHARED_TAILS[self.key]
+
+    def read(self, max_lines=None):
+        """
+        Reads up to max_lines (SHARED_READ_SIZE by default) new lines and passes them to subscribers
+
+        :param max_lines: int
+        :return: int number of lines read
+        """
+        max_lines = max_lines or SHARED_READ_SIZE
+
+        # another subscriber is reading already (the tail may yield to other greenlets)
+        if self._reading:
+            return 0
+
+        key = self.key
+        self._reading = True
+        try:
+            # the tail continues its read pass until the end of the file, it's checked for changes only once per pass
+            lines = list(itertools.islice(self.tail, max_lines))
+        finally:
+            self._reading = False
+
+            # the file was rotated, keep the source registered under the new inode
+            if self.key != key and SHARED_TAILS.get(key) is self:
+                del SHARED_TAILS[key]
+                SHARED_TAILS.setdefault(self.key, self)
+
+        if lines:
+            for subscriber in self.subscribers:
+                subscriber.buffer.extend(lines)
+        return len(lines)
+
+
+class SharedFileTail(Pipeline):
+    """
+    Returns unread lines of a SharedFileSource.  Lines read by the source while other subscribers were iterating are
+    buffered until this tail is iterated.
+    """
+
+    def __init__(self, filename, source):
+        super().__init__(name=f"file:{filename}")
+        self.filename = filename
+        self.source = source
+        self.buffer = []
+        self._lines = iter(())
+        self._read_more = True  # the read pass of the source file started by this iteration is not over yet
+        self.source.subscribe(self)
+
+    def __iter__(self):
+        self._read_more = True
+        return self
+
+    def __next__(self):
+        # fast path for lines of the current buffer
+        for line in self._lines:
+            return line
+
+        while self.buffer or self._read():
+            self._lines = iter(self.buffer)
+            self.buffer = []
+            for line in self._lines:
+                return line
+        raise StopIteration
+
+    def _read(self):
+        """
+        Makes the source read new lines, but doesn't start another read pass of the file in the same iteration
+
+        :return: int number of lines read
+        """
+        if self.source is None or not self._read_more:
+            return 0
+
+        count = self.source.read()
+        # fewer lines than requested: the read pass ended at the end of the file
+        self._read_more = count >= SHARED_READ_SIZE
+        return count
+
+    def __length_hint__(self):
+        return len(self.buffer) + operator.length_hint(self._lines)
+
+    def readlines(self):
+        return [line for line in self]
+
+    def backlog(self):
+        return self.source.tail.backlog() if self.source is not None else 0
+
+    @property
+    def lines_per_record(self):
+        return self.source.tail.lines_per_record if self.source is not None else 1
+
+    @property
+    def skipped_bytes(self):
+        return self.source.tail.skipped_bytes
+
+    @skipped_bytes.setter
+    def skipped_bytes(self, value):
+        self.source.tail.skipped_bytes = value
+
+    def stop(self):
+        if self.source is not None:
+            self.source.unsubscribe(self)
+            self.source = None
+            self.buffer = []
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import zlib
+
+from amplify.agent.common.context import context
+from amplify.agent.data.statsd import StatsdBatch
+from amplify.agent.pipelines.abstract import Pipeline
+
+
+__author__ = "GetPageSpeed"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__license__ = ""
+__maintainer__ = "GetPageSpeed"
+__email__ = "info@getpagespeed.com"
+
+
+# shared pool of log worker processes (see setup_log_workers)
+LOG_WORKER_POOL = None
+
+# how often to check for a worker response
+RESPONSE_POLL_INTERVAL = 0.01
+
+
+def setup_log_workers(workers):
+    """
+    Starts a pool of worker processes for access log parsing
+
+    :param workers: int number of worker processes
+    :return: LogWorkerPool
+    """
+    global LOG_WORKER_POOL
+    if LOG_WORKER_POOL is None or LOG_WORKER_POOL.size != workers:
+        if LOG_WORKER_POOL is not None:
+            LOG_WORKER_POOL.stop()
+        LOG_WORKER_POOL = LogWorkerPool(workers)
+    return LOG_WORKER_POOL
+
+
+class _WorkerObject(object):
+    """
+    Stand-in for NginxObject in worker processes, collected metrics go to a local batch
+    """
+    type = 'nginx'
+    in_container = False
+
+    def __init__(self, filters, definition_hash):
+        from amplify.agent.objects.nginx.filters import Filter
+
+        self.statsd = StatsdBatch()
+        self.filters = [Filter(data=data, metric=metric, filter_rule_id=rule_id) for data, metric, rule_id in filters]
+        self.definition_hash = definition_hash
+
+
+def _worker_main(connection, parent_connection):
+    """
+    Worker process loop: tails, parses and aggregates access logs on request of the main process
+
+    :param connection: multiprocessing Connection to the main process
+    :param parent_connection: multiprocessing Connection of the main process end (inherited on fork)
+    """
+    parent_connection.close()
+
+    from amplify.agent.collectors.nginx.accesslog import NginxAccessLogsCollector
+    from amplify.agent.pipelines import file as file_pipeline
+
+    # forked from the agent: start with a clean gevent hub (greenlets of the main process must not run here),
+    # don't share the inotify descriptor and don't write the offsets file of the main process
+    try:
+        import gevent
+        gevent.get_hub().destroy(destroy_loop=True)
+    except Exception:
+        pass
+
+    if context.log is None:
+        context.default_log = logging.getLogger('amplify-log-worker')
+
+    watch = file_pipeline.WATCHER is not None
+    file_pipeline.WATCHER = None
+    file_pipeline.OFFSET_STORE = None
+    if watch:
+        file_pipeline.setup_watcher()
+
+    collectors = {}
+    while True:
+        try:
+            command, key, data = connection.recv()
+        except (EOFError, OSError):
+            break
+
+        if command == 'stop':
+            break
+
+        try:
+            result = None
+            if command == 'add':
+                filename = data['filename']
+                if data.get('offset') is not None:
+                    # restarted worker: resume where the previous one was acknowledged, or from the start of a file
+                    # that replaced the acknowledged one
+                    same_file = os.stat(filename).st_ino == data['inode']
+                    file_pipeline.OFFSET_CACHE[filename] = data['offset'] if same_file else 0
+                tail = file_pipeline.FileTail(filename, **data['tail_kwargs'])
+                collectors[key] = NginxAccessLogsCollector(
+                    object=_WorkerObject(data['filters'], data['definition_hash']),
+                    log_format=data['log_format'],
+                    tail=tail,
+                    batch_size=0
+                )
+                result = tail.checkpoint()
+            elif command == 'remove':
+                collector = collectors.pop(key, None)
+                if collector is not None:
+                    collector.tail.stop()
+            elif command == 'collect':
+                collector = collectors[key]
+                collector.collect()
+                batch = collector.object.statsd
+                result = batch.counters, batch.averages, batch.timers, collector.tail.checkpoint()
+                collector.object.statsd = collector.statsd = StatsdBatch()
+            connection.send((None, result))
+        except Exception as e:
+            connection.send(('%s: %s' % (e.__class__.__name__, e), None))
+
+
+class LogWorker(object):
+    """
+    Handle of one worker process in the main process
+    """
+
+    def __init__(self):
+        self.specs = {}  # key -> add command data and the last acknowledged offset, to restore the worker after a crash
+        self.lock = threading.Lock()
+        self.connection = None
+        self.process = None
+        self.start()
+
+    def start(self):
+        mp = multiprocessing.get_context('fork')
+        self.connection, child_connection = mp.Pipe()
+        self.process = mp.Process(
+            target=_worker_main, args=(child_connection, self.connection), name='amplify-log-worker'
+        )
+        self.process.daemon = True
+        self.process.start()
+        child_connection.close()
+
+    def stop(self):
+        try:
+            self.connection.send(('stop', None, None))
+        except (EOFError, OSError):
+            pass
+        self.connection.close()
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.terminate()
+
+    def request(self, command, key, data=None):
+        """
+        Sends a command to the worker and waits for the result without blocking other greenlets
+
+        :param command: str add, remove or collect
+        :param key: int collector key
+        :param data: {} command data
+        :return: result of the command
+        """
+        with self.lock:
+            try:
+                self.connection.send((command, key, data))
+                while not self.connection.poll(0):
+                    time.sleep(RESPONSE_POLL_INTERVAL)
+                error, result = self.connection.recv()
+            except (EOFError, OSError):
+                context.log.error('log worker %s died, restarting it' % self.process.pid)
+                self.restart()
+                raise
+
+        if error:
+            raise Exception('log worker failed to %s: %s' % (command, error))
+        return result
+
+    def restart(self):
+        self.connection.close()
+        self.process.join(timeout=1)
+        self.start()
+        for key, data in self.specs.items():
+            self.connection.send(('add', key, data))
+            error, _ = self.connection.recv()
+            if error:
+                context.log.error('log worker failed to resume "%s": %s' % (data['filename'], error))
+
+
+class LogWorkerPool(object):
+    """
+    Pool of processes that tail, parse and aggregate access logs outside of the agent process.
+
+    Files are sharded between workers by their names, so one file is always processed by the same worker.
+    Collectors in the main process receive only aggregated metrics of every collection (see PoolTail).
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.workers = [LogWorker() for _ in range(size)]
+        self._keys = itertools.count()
+
+    def tail(self, filename, log_format=None, filters=None, definition_hash=None, **tail_kwargs):
+        """
+        Starts processing of a file in a worker
+
+        :param filename: str
+        :param log_format: str nginx log format
+        :param filters: [] of Filter
+        :param definition_hash: str object definition hash for logging
+        :param tail_kwargs: FileTail kwargs
+        :return: PoolTail
+        """
+        worker = self.workers[zlib.crc32(filename.encode('utf-8')) % self.size]
+        key = next(self._keys)
+        data = dict(
+            filename=filename,
+            log_format=log_format,
+            filters=[(f.original_data, f.metric, f.filter_rule_id) for f in filters or []],
+            definition_hash=definition_hash,
+            tail_kwargs=tail_kwargs,
+        )
+        data['inode'], data['offset'] = worker.request('add', key, data)
+        worker.specs[key] = data
+        return PoolTail(filename, worker, key)
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+
+class PoolTail(Pipeline):
+    """
+    Tail of a file processed by a log worker, it doesn't return lines but aggregated metrics (see collect)
+    """
+
+    def __init__(self, filename, worker, key):
+        super().__init__(name=f"file:{filename}")
+        self.worker = worker
+        self.key = key
+
+    def __next__(self):
+        raise StopIteration
+
+    def collect(self):
+        """
+        Makes the worker process new lines of the file
+
+        :return: StatsdBatch of collected metrics
+        """
+        batch = StatsdBatch()
+        batch.counters, batch.averages, batch.timers, checkpoint = self.worker.request('collect', self.key)
+
+        # the worker processed the file up to here, a restarted worker continues from this point
+        data = self.worker.specs.get(self.key)
+        if data is not None:
+            data['inode'], data['offset'] = checkpoint
+        return batch
+
+    def stop(self):
+        if self.worker is not None:
+            self.worker.specs.pop(self.key, None)
+            try:
+                self.worker.request('remove', self.key)
+            except Exception:
+                context.log.debug('failed to stop log worker tail', exc_info=True)
+            self.worker = None
@@ -9,7 +9,7 @@ messages, returning them when iterated.
 """
 
 # -*- coding: utf-8 -*-
-import copy
+import os
 import selectors
 import socket
 from collections import deque
@@ -41,47 +41,142 @@ class AmplifyAddresssAlreadyInUse(AmplifyException):
 class SyslogServer:
     """Simple UDP socket server that listens for and caches syslog packets."""
 
-    def __init__(self, cache, address, chunk_size=8192):
+    # nginx syslog messages carry the log line after this tag
+    tag = b"amplify: "
+
+    def __init__(self, cache, address, chunk_size=8192, rcvbuf=0, max_batch=1000):
         """Initialize the syslog server.
 
         Args:
             cache: Shared deque object to store received messages.
             address: Tuple of (host, port) to bind to.
-            chunk_size: Maximum size of UDP packets to receive.
+            chunk_size: Maximum size of UDP packets to receive, bigger packets are truncated.
+            rcvbuf: Size of the socket receive buffer (SO_RCVBUF), 0 keeps the system default.
+            max_batch: Maximum number of packets to receive in one read before yielding to other greenlets.
         """
         self.cache = cache
         self.chunk_size = chunk_size
+        self.max_batch = max_batch
         self._closed = False
 
+        # packets are received into one preallocated buffer, one byte bigger than a packet can be to detect truncation
+        self.buffer = bytearray(chunk_size + 1)
+        self.view = memoryview(self.buffer)
+
+        # counters since the last take_counters() call
+        self.received = 0
+        self.truncated = 0
+        self.overflowed = 0  # messages pushed out of a full cache
+        self._drops = None  # kernel drops of the socket reported by the last take_counters() call
+
         # Create and bind UDP socket
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.setblocking(False)
+        if rcvbuf:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
         self.socket.bind(address)
         self.address = self.socket.getsockname()
+        self.inode = os.fstat(self.socket.fileno()).st_ino
         SYSLOG_ADDRESSES.add(self.address)
-        context.log.debug(f"syslog server binding to {str(self.address)}")
+        context.log.debug(
+            f"syslog server binding to {str(self.address)} "
+            f"(receive buffer: {self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)})"
+        )
 
         # Create selector for non-blocking I/O
         self.selector = selectors.DefaultSelector()
         self.selector.register(self.socket, selectors.EVENT_READ, self._handle_read)
 
     def _handle_read(self):
-        """Handle incoming UDP data."""
+        """Handle incoming UDP data: drain the socket until there are no packets left (or max_batch packets)."""
+        buffer, view, chunk_size, tag = self.buffer, self.view, self.chunk_size, self.tag
+        recv_into = self.socket.recv_into
+
+        for _ in range(self.max_batch):
+            try:
+                size = recv_into(view)
+            except BlockingIOError:
+                break  # No data available
+            except Exception:
+                context.log.debug("error receiving syslog data:", exc_info=True)
+                break
+
+            self.received += 1
+            if size > chunk_size:
+                self.truncated += 1
+                size = chunk_size
+
+            # strip trailing whitespace without copying the packet
+            while size and buffer[size - 1] in b" \t\n\r\x0b\x0c":
+                size -= 1
+            if not size:
+                continue
+
+            # This implicitly relies on the nginx syslog format specifically
+            start = buffer.find(tag, 0, size)
+            if start < 0:
+                context.log.error(
+                    f'error handling syslog message (address:{self.address}, '
+                    f'message:"{str(view[:size], "utf-8", "replace").strip()}")'
+                )
+                continue
+
+            # the cache can be swapped between packets (see swap_cache), so it's looked up for every message
+            cache = self.cache
+            if len(cache) == cache.maxlen:
+                self.overflowed += 1
+            cache.append(str(view[start + len(tag):size], "utf-8", "replace"))
+
+    def swap_cache(self, cache):
+        """Replaces the cache with another one.
+
+        Args:
+            cache: Deque to store the next messages in.
+
+        Returns:
+            The previous cache, the server doesn't touch it anymore.
+        """
+        previous, self.cache = self.cache, cache
+        return previous
+
+    def take_counters(self):
+        """Returns packet counters since the previous call.
+
+        Returns:
+            Dict with numbers of received and truncated packets, of packets dropped by the kernel because the
+            socket buffer was full (dropped is None where the kernel doesn't report it) and of messages dropped
+            because the cache was full.
+        """
+        drops = self.kernel_drops()
+        dropped = None
+        if drops is not None:
+            dropped = drops - self._drops if self._drops is not None else drops
+            self._drops = drops
+
+        counters = dict(
+            received=self.received, dropped=dropped, truncated=self.truncated, overflowed=self.overflowed
+        )
+        self.received = 0
+        self.truncated = 0
+        self.overflowed = 0
+        return counters
+
+    def kernel_drops(self):
+        """Returns the number of packets that the kernel dropped for the socket (Linux only).
+
+        Returns:
+            Int or None if it's not available.
+        """
         try:
-            data = self.socket.recv(self.chunk_size).strip()
-            if data:
-                decoded = data.decode("utf-8", errors="replace")
-                try:
-                    # This implicitly relies on the nginx syslog format specifically
-                    log_record = decoded.split("amplify: ", 1)[1]
-                    self.cache.append(log_record)
-                except (IndexError, Exception):
-                    context.log.error(f'error handling syslog message (address:{self.address}, message:"{decoded}")')
-                    context.log.debug("additional info:", exc_info=True)
-        except BlockingIOError:
-            pass  # No data available
-        except Exception:
-            context.log.debug("error receiving syslog data:", exc_info=True)
+            with open("/proc/net/udp") as proc_udp:
+                next(proc_udp)  # header
+                for line in proc_udp:
+                    fields = line.split()
+                    if len(fields) > 12 and fields[9] == str(self.inode):
+                        return int(fields[12])
+        except (OSError, ValueError, StopIteration):
+            pass
+        return None
 
     def poll(self, timeout=0.1):
         """Poll for incoming data.
@@ -123,16 +218,17 @@ class SyslogListener(AbstractManager):
 
     name = "syslog_listener"
 
-    def __init__(self, cache, address, **kwargs):
+    def __init__(self, cache, address, rcvbuf=0, **kwargs):
         """Initialize the listener.
 
         Args:
             cache: Shared deque for storing messages.
             address: Tuple of (host, port) to bind to.
+            rcvbuf: Size of the socket receive buffer, 0 keeps the system default.
             **kwargs: Additional arguments passed to AbstractManager.
         """
         super().__init__(**kwargs)
-        self.server = SyslogServer(cache, address)
+        self.server = SyslogServer(cache, address, rcvbuf=rcvbuf)
 
     def start(self):
         """Start the listener loop."""
@@ -145,7 +241,7 @@ class SyslogListener(AbstractManager):
             self._wait(0.1)
             # Increment action ID every listen period
             context.inc_action_id()
-            # Poll for events with timeout
+            # Poll for events with timeout, every event drains the socket
             for _ in range(10):  # Process up to 10 events per cycle
                 if not self.server.poll(timeout=self.interval / 10):
                     break
@@ -210,11 +306,24 @@ class SyslogTail(Pipeline):
                     )
                     context.log.debug("additional info:", exc_info=True)
 
-        current_cache = copy.deepcopy(self.cache)
+        # double buffering: the listener gets an empty cache and the filled one is returned as is, without copying.
+        # The listener runs in a greenlet of the same thread, so it can't append to the old cache after the swap.
+        current_cache, self.cache = self.cache, deque(maxlen=self.maxlen)
+        if self.listener and self.listener.server:
+            current_cache = self.listener.server.swap_cache(self.cache)
         context.log.debug(f"syslog tail returned {len(current_cache)} lines captured from {self.name}")
-        self.cache.clear()
         return iter(current_cache)
 
+    def take_counters(self):
+        """Returns packet counters of the listener since the previous call (see SyslogServer.take_counters).
+
+        Returns:
+            Dict of counters, empty if there is no listener.
+        """
+        if self.listener and self.listener.server:
+            return self.listener.server.take_counters()
+        return {}
+
     def _setup_listener(self, **kwargs):
         """Set up the syslog listener."""
         if self.address in SYSLOG_ADDRESSES:
@@ -0,0 +1,243 @@
+"""
+Tests for the nginx access log collector.
+"""
+import logging
+
+import pytest
+
+from amplify.agent.collectors.nginx.accesslog import NginxAccessLogsCollector
+from amplify.agent.common.context import context
+from amplify.agent.data.statsd import StatsdBatch
+from amplify.agent.objects.nginx.filters import Filter
+from amplify.agent.pipelines import file as file_pipeline
+from amplify.agent.pipelines.file import FileTail, OFFSET_CACHE
+
+
+LINE = '10.0.0.1 - - [02/Jul/2015:14:49:48 +0000] "%s / %s" %s 10 "-" "curl/7.35.0"'
+
+
+class _Object(object):
+    in_container = False
+    definition_hash = 'test'
+
+    def __init__(self, filters=None):
+        self.statsd = StatsdBatch()
+        self.filters = [Filter(**raw_filter) for raw_filter in filters or []]
+
+
+def _collect(lines, filters=None, log_format=None, **kwargs):
+    kwargs.setdefault('batch_size', 0)
+    collector = NginxAccessLogsCollector(
+        object=_Object(filters), interval=10, log_format=log_format, tail=lines, **kwargs
+    )
+    collector.collect()
+    return collector.object.statsd
+
+
+def test_metric_names_of_common_and_rare_values(monkeypatch):
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    statsd = _collect([
+        LINE % ('GET', 'HTTP/1.1', '200'),
+        LINE % ('get', 'HTTP/3', '499'),
+        LINE % ('PATCH', 'HTTP/2.0', '504'),
+        LINE % ('Post', 'SPDY/3', '1000'),
+    ])
+    counters = statsd.counters
+    assert counters['nginx.http.method.get'] == 2
+    assert counters['nginx.http.method.other'] == 1
+    assert counters['nginx.http.method.post'] == 1
+    assert counters['nginx.http.status.2xx'] == 1
+    assert counters['nginx.http.status.4xx'] == 1
+    assert counters['nginx.http.status.discarded'] == 1
+    assert counters['nginx.http.status.504'] == 1
+    assert counters['nginx.http.status.5xx'] == 1
+    assert counters['nginx.http.status.1xx'] == 1
+    assert counters['nginx.http.v1_1'] == 1
+    assert counters['nginx.http.v3'] == 1
+    assert counters['nginx.http.v2'] == 1
+
+
+def test_custom_filter_metric_names(monkeypatch):
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    statsd = _collect(
+        [LINE % ('GET', 'HTTP/1.1', '404'), LINE % ('POST', 'HTTP/1.1', '404')],
+        filters=[dict(filter_rule_id=7, metric='nginx.http.status.404', data=[('$request_method', '~', 'GET')])]
+    )
+    assert statsd.counters['nginx.http.status.404'] == 2
+    assert statsd.counters['nginx.http.status.404||7'] == 1
+
+
+def test_timer_filters_count_under_parent_metric(monkeypatch):
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    log_format = '$remote_addr [$time_local] "$request" $status rt=$request_time ut="$upstream_response_time"'
+    line = '10.0.0.1 [02/Jul/2015:14:49:48 +0000] "GET / HTTP/1.1" %s rt=%s ut="%s"'
+    statsd = _collect(
+        [line % ('200', '0.5', '0.2, 0.1'), line % ('502', '1.5', '0.7'), line % ('200', '0.1', '-')],
+        filters=[
+            dict(filter_rule_id=1, metric='nginx.http.request.time.median', data=[('$status', '~', '200')]),
+            dict(filter_rule_id=2, metric='nginx.upstream.response.time.pctl95', data=[('$status', '~', '5..')]),
+            dict(filter_rule_id=3, metric='nginx.http.status.2xx', data=[('$status', '~', '200')]),
+        ],
+        log_format=log_format
+    )
+    assert list(statsd.timers['nginx.http.request.time||1']) == [0.5, 0.1]
+    assert list(statsd.timers['nginx.upstream.response.time||2']) == [0.7]
+    assert 'nginx.http.request.time||3' not in statsd.timers
+    assert statsd.counters['nginx.upstream.next.count'] == 1
+
+
+def test_sampling_scales_counters(monkeypatch):
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    lines = [LINE % ('GET', 'HTTP/1.1', '200')] * 96 + [LINE % ('POST', 'HTTP/1.1', '500')] * 4
+    statsd = _collect(lines, sample_rate=4, batch_size=10)
+    assert statsd.counters['nginx.http.status.2xx'] == 96
+    assert statsd.counters['nginx.http.request.body_bytes_sent'] == 1000
+    assert statsd.counters['nginx.http.status.5xx'] == 4  # one of four sampled, scaled back
+    assert list(statsd.averages['controller.agent.log.sample_rate']) == [0.25]
+
+
+def test_cpu_budget_adapts_sample_rate(monkeypatch):
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    collector = NginxAccessLogsCollector(object=_Object(), interval=10, tail=[], sample_rate=2, cpu_budget=0.1)
+    collector.update_sample_rate(1000, 500, 0.35)
+    assert collector.sample_rate == 7
+    collector.update_sample_rate(1000, 143, 0.01)
+    assert collector.sample_rate == 2  # never below the configured rate
+
+
+def test_time_budget_defers_lines_to_next_cycles(monkeypatch):
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    lines = [LINE % ('GET', 'HTTP/1.1', '200')] * 250
+    collector = NginxAccessLogsCollector(
+        object=_Object(), interval=10, tail=lines, batch_size=0, time_budget=1e-9
+    )
+    statsd = collector.object.statsd
+
+    collector.collect()
+    assert statsd.counters['nginx.http.status.2xx'] == 100
+    assert statsd.counters['controller.agent.log.deferred_lines'] == 150
+
+    collector.collect()
+    collector.collect()
+    assert statsd.counters['nginx.http.status.2xx'] == 250
+    assert statsd.counters['controller.agent.log.deferred_lines'] == 150 + 50
+    assert collector.pending is None
+
+
+def test_aggregate_mode_collects_the_same_metrics(monkeypatch):
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    log_format = '"$request" $status $bytes_sent us="$upstream_status" ut="$upstream_response_time" cs=$upstream_cache_status'
+    line = '"%s / HTTP/1.1" %s 100 us="%s" ut="%s" cs=%s'
+    lines = [
+        line % ('GET', '200', '200', '0.1', 'HIT'),
+        line % ('GET', '200', '200', '0.3', 'HIT'),
+        line % ('GET', '200', '-', '-', '-'),
+        line % ('POST', '502', '502, 200', '0.2, 0.4', 'MISS'),
+        line % ('GET', '200', '200', '0.2', 'HIT'),
+    ]
+    filters = [
+        dict(filter_rule_id=1, metric='nginx.cache.hit', data=[('$request_method', '~', 'GET')]),
+        dict(filter_rule_id=2, metric='nginx.upstream.status.2xx', data=[('$status', '~', '5..')]),
+    ]
+    expected = _collect(lines, filters=filters, log_format=log_format)
+    statsd = _collect(lines, filters=filters, log_format=log_format, aggregate=True)
+    assert statsd.counters == expected.counters
+    assert statsd.timers == expected.timers
+    assert statsd.counters['nginx.cache.hit'] == 3
+    assert statsd.counters['nginx.cache.hit||1'] == 3
+    assert statsd.counters['nginx.upstream.status.2xx||2'] == 1
+    assert statsd.counters['nginx.upstream.request.count'] == 5
+
+
+def test_multiline_format_records_from_file_tail(monkeypatch, tmp_path):
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    path = str(tmp_path / "access.log")
+    with open(path, "w") as fh:
+        fh.write("")
+
+    log_format = '"$request"\n$status $body_bytes_sent'
+    tail = FileTail(path, lines_per_record=2)
+    collector = NginxAccessLogsCollector(
+        object=_Object(), interval=10, log_format=log_format, tail=tail, batch_size=0
+    )
+    assert collector.lines_per_item == 1
+
+    with open(path, "a") as fh:
+        fh.write('"GET / HTTP/1.1"\n200 10\n"POST / HTTP/1.1"\n500 20\n"GET / HTTP/1.1"\n')
+    collector.collect()
+    with open(path, "a") as fh:
+        fh.write('404 30\n')
+    collector.collect()
+
+    counters = collector.object.statsd.counters
+    assert counters['nginx.http.method.get'] == 2
+    assert counters['nginx.http.status.404'] == 1
+    assert counters['nginx.http.request.body_bytes_sent'] == 60
+    OFFSET_CACHE.pop(path)
+
+
+def test_file_tail_collectors_with_watcher(monkeypatch, tmp_path):
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    monkeypatch.setattr(file_pipeline, "WATCHER", None)
+    watcher = file_pipeline.setup_watcher()
+    if watcher is None:
+        pytest.skip("inotify is not available")
+
+    path = str(tmp_path / "access.log")
+    with open(path, "w") as fh:
+        fh.write("")
+
+    # two collectors with their own tails of the same file
+    collectors = [
+        NginxAccessLogsCollector(object=_Object(), interval=10, tail=FileTail(path), batch_size=0, time_budget=1)
+        for _ in range(2)
+    ]
+
+    with open(path, "a") as fh:
+        fh.write("".join(LINE % ('GET', 'HTTP/1.1', '200') + "\n" for _ in range(5)))
+    for collector in collectors:
+        collector.collect()
+        collector.collect()  # nothing new
+    with open(path, "a") as fh:
+        fh.write(LINE % ('GET', 'HTTP/1.1', '200') + "\n")
+    for collector in collectors:
+        collector.collect()
+        assert collector.object.statsd.counters['nginx.http.status.2xx'] == 6
+        collector.tail.stop()
+
+    assert watcher.tails == {}
+    watcher.close()
+    OFFSET_CACHE.pop(path)
+
+
+def test_time_budget_defers_file_tail_lines_with_watcher(monkeypatch, tmp_path):
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    monkeypatch.setattr(file_pipeline, "WATCHER", None)
+    watcher = file_pipeline.setup_watcher()
+    if watcher is None:
+        pytest.skip("inotify is not available")
+
+    path = str(tmp_path / "access.log")
+    with open(path, "w") as fh:
+        fh.write("")
+
+    tail = FileTail(path)
+    collector = NginxAccessLogsCollector(object=_Object(), interval=10, tail=tail, batch_size=0, time_budget=1e-9)
+    passes = []
+    start_pass = tail._start_pass
+    monkeypatch.setattr(tail, "_start_pass", lambda: passes.append(1) or start_pass())
+
+    with open(path, "a") as fh:
+        fh.write("".join(LINE % ('GET', 'HTTP/1.1', '200') + "\n" for _ in range(250)))
+    counters = collector.object.statsd.counters
+    collector.collect()
+    assert counters['nginx.http.status.2xx'] == 100
+    collector.collect()
+    collector.collect()
+    assert counters['nginx.http.status.2xx'] == 250
+    assert collector.pending is None
+    assert len(passes) == 1  # the deferred lines were read in the same pass
+
+    tail.stop()
+    watcher.close()
+    OFFSET_CACHE.pop(path)
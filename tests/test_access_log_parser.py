@@ -0,0 +1,123 @@
+"""
+Tests for the compiled nginx access log parser.
+"""
+from amplify.agent.objects.nginx.log.access import NginxAccessLogParser
+
+
+UPSTREAM_FORMAT = (
+    '$remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent '
+    'rt=$request_time ua="$upstream_addr" us="$upstream_status" ut="$upstream_response_time" '
+    'ul=$upstream_response_length gz=$gzip_ratio'
+)
+
+
+def test_parse_combined_format():
+    parser = NginxAccessLogParser()
+    parsed = parser.parse(
+        '127.0.0.1 - - [02/Jul/2015:14:49:48 +0000] "GET /basic_status HTTP/1.1" 200 110 "-" '
+        '"python-requests/2.2.1 CPython/2.7.6 Linux/3.13.0-48-generic"'
+    )
+    assert parsed == {
+        'malformed': False,
+        'remote_addr': '127.0.0.1',
+        'remote_user': '-',
+        'time_local': '02/Jul/2015:14:49:48 +0000',
+        'request': 'GET /basic_status HTTP/1.1',
+        'request_method': 'GET',
+        'request_uri': '/basic_status',
+        'server_protocol': 'HTTP/1.1',
+        'status': '200',
+        'body_bytes_sent': 110,
+        'http_referer': '-',
+        'http_user_agent': 'python-requests/2.2.1 CPython/2.7.6 Linux/3.13.0-48-generic',
+    }
+
+
+def test_parse_record_is_positional():
+    parser = NginxAccessLogParser(UPSTREAM_FORMAT)
+    record = parser.parse_record(
+        '10.0.0.1 - - [02/Jul/2015:14:49:48 +0000] "POST /api HTTP/2.0" 502 0 '
+        'rt=0.105 ua="10.0.1.1:80, 10.0.1.2:80" us="502, 200" ut="0.050, 0.040" ul=512 gz=-'
+    )
+    assert len(record) == len(parser.fields)
+    assert parser.fields[-1] == 'malformed'
+    assert record[parser.field_index['malformed']] is False
+    assert record[parser.field_index['status']] == '502'
+    assert record[parser.field_index['request_method']] == 'POST'
+    assert record[parser.field_index['request_time']] == [0.105]
+    assert record[parser.field_index['upstream_response_time']] == [0.05, 0.04]
+    assert record[parser.field_index['upstream_status']] == ['502', '200']
+    assert record[parser.field_index['upstream_addr']] == ['10.0.1.1:80', '10.0.1.2:80']
+    assert record[parser.field_index['upstream_response_length']] == 512
+    assert record[parser.field_index['gzip_ratio']] == 0  # '-' can't be cast to float
+
+
+def test_parse_skips_empty_time_values():
+    parser = NginxAccessLogParser(UPSTREAM_FORMAT)
+    parsed = parser.parse(
+        '10.0.0.1 - - [02/Jul/2015:14:49:48 +0000] "GET / HTTP/1.1" 200 10 '
+        'rt=0.001 ua="-" us="-" ut="-" ul=- gz=1.5'
+    )
+    assert 'upstream_response_time' not in parsed
+    assert parsed['upstream_status'] == ['-']
+    assert parsed['request_time'] == [0.001]
+    assert parsed['gzip_ratio'] == 1.5
+
+
+def test_parse_malformed_request():
+    parser = NginxAccessLogParser()
+    record = parser.parse_record('127.0.0.1 - - [02/Jul/2015:14:49:48 +0000] "-" 400 0 "-" "-"')
+    assert record[parser.field_index['malformed']] is True
+    assert record[parser.field_index['request_method']] is None
+
+
+def test_parse_record_returns_none_for_unmatched_line():
+    parser = NginxAccessLogParser()
+    assert parser.parse_record('garbage') is None
+
+
+def test_compile_with_keys_skips_other_values():
+    parser = NginxAccessLogParser()
+    parser.compile(keys=['status', 'http_referer'])
+    record = parser.parse_record(
+        '127.0.0.1 - - [02/Jul/2015:14:49:48 +0000] "GET /basic_status HTTP/1.1" 200 110 "-" "curl/7.35.0"'
+    )
+    assert len(record) == len(parser.fields)
+    assert record[parser.field_index['status']] == '200'
+    assert record[parser.field_index['http_referer']] == '-'
+    assert record[parser.field_index['request_method']] == 'GET'  # request is always parsed
+    assert record[parser.field_index['http_user_agent']] is None
+    assert record[parser.field_index['body_bytes_sent']] is None
+    assert parser.parse_record('garbage') is None
+
+
+def test_lazy_keys_are_cast_in_dict_view_only():
+    parser = NginxAccessLogParser(
+        UPSTREAM_FORMAT, demanded_keys=['status', 'upstream_*', 'body_bytes_sent'], lazy_keys=['body_bytes_sent']
+    )
+    record = parser.parse_record(
+        '10.0.0.1 - - [02/Jul/2015:14:49:48 +0000] "POST /api HTTP/2.0" 502 17 '
+        'rt=0.105 ua="10.0.1.1:80, 10.0.1.2:80" us="502, 200" ut="0.050, 0.040" ul=512 gz=-'
+    )
+    assert record[parser.field_index['body_bytes_sent']] == '17'
+    assert record[parser.field_index['upstream_response_time']] == [0.05, 0.04]
+    assert record[parser.field_index['upstream_response_length']] == 512
+    assert record[parser.field_index['request_time']] is None
+    assert record[parser.field_index['remote_addr']] is None
+
+    parsed = parser.record_to_dict(record)
+    assert parsed['body_bytes_sent'] == 17
+    assert 'request_time' not in parsed
+
+
+def test_repeated_variable_takes_last_value():
+    parser = NginxAccessLogParser('$status "$request" $status $body_bytes_sent')
+    line = '200 "GET / HTTP/1.1" 502 10'
+    assert parser.parse(line)['status'] == '502'
+
+    # the same as the dict of keys and split values that the parser used to build
+    values = ['200', 'GET / HTTP/1.1', '502', '10']
+    assert parser.parse(line)['status'] == dict(zip(parser.keys, values))['status']
+
+    parser.compile(keys=['status'])
+    assert parser.parse_record(line)[parser.field_index['status']] == '502'
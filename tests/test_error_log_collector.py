@@ -0,0 +1,220 @@
+"""
+Tests for the nginx error log collector.
+"""
+import logging
+
+import pytest
+
+from amplify.agent.collectors.nginx.errorlog import NginxErrorLogsCollector
+from amplify.agent.common.context import context
+from amplify.agent.data.eventd import WARNING
+from amplify.agent.data.statsd import StatsdBatch, StatsdClient
+from amplify.agent.pipelines import file as file_pipeline
+from amplify.agent.pipelines.file import FileTail, OFFSET_CACHE
+
+
+LINE = '2015/07/02 14:49:48 [error] 123#0: *%d connect() failed (111: Connection refused) while connecting to ' \
+       'upstream, client: %s, server: x, request: "GET / HTTP/1.1", upstream: "http://%s/", host: "x"'
+
+
+class _Object(object):
+    in_container = False
+    definition_hash = 'test'
+
+    def __init__(self):
+        self.statsd = StatsdBatch()
+        self.eventd = _Eventd()
+
+
+class _Definition(object):
+    definition = {'type': 'nginx'}
+
+
+class _Eventd(object):
+    def __init__(self):
+        self.events = []
+
+    def event(self, level, message, **kwargs):
+        self.events.append((level, message))
+
+
+def test_errors_by_upstream_and_client_are_capped(monkeypatch):
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    lines = [
+        LINE % (1, '10.0.0.1', '10.0.1.1:80'),
+        LINE % (2, '10.0.0.2', '10.0.1.2:80'),
+        LINE % (3, '10.0.0.1', '10.0.1.1:80'),
+        LINE % (4, '10.0.0.3', '10.0.1.3:80'),
+    ]
+    collector = NginxErrorLogsCollector(
+        object=_Object(), interval=10, level='error', tail=lines, max_upstreams=2, max_clients=1
+    )
+    collector.collect()
+
+    counters = collector.object.statsd.counters
+    assert counters['nginx.upstream.request.failed'] == 4
+    assert counters['nginx.upstream.request.failed.upstream.10_0_1_1_80'] == 2
+    assert counters['nginx.upstream.request.failed.upstream.10_0_1_2_80'] == 1
+    assert counters['nginx.upstream.request.failed.upstream.other'] == 1
+    assert counters['nginx.upstream.request.failed.client.10_0_0_1'] == 2
+    assert counters['nginx.upstream.request.failed.client.other'] == 2
+
+    # the breakdowns are not taken for filter metrics (metric||filter_rule_id)
+    statsd = StatsdClient(object=_Definition())
+    collector.object.statsd.flush(statsd)
+    names = statsd.flush()['metrics']['counter']
+    assert 'C|nginx.upstream.request.failed.upstream.10_0_1_1_80' in names
+    assert not [name for name in names if '||' in name]
+
+    # the caps apply per statsd flush, addresses of the previous flush periods don't take places
+    collector.tail = [LINE % (5, '10.0.0.4', '10.0.1.4:80')]
+    collector.collect()
+    counters = collector.object.statsd.counters
+    assert counters['nginx.upstream.request.failed.upstream.10_0_1_4_80'] == 1
+    assert counters['nginx.upstream.request.failed.client.10_0_0_4'] == 1
+
+
+def test_address_caps_hold_across_deferred_cycles(monkeypatch):
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    lines = [LINE % (i, '10.0.%d.%d' % (i // 256, i % 256), '10.1.%d.%d:80' % (i // 256, i % 256)) for i in range(500)]
+    collector = NginxErrorLogsCollector(
+        object=_Object(), interval=10, level='error', tail=lines, max_upstreams=3, max_clients=3, time_budget=1e-9
+    )
+    collector.budget_check_lines = 10
+
+    # every slice runs out of time, the cycle takes many collects
+    slices = 0
+    while True:
+        collector.collect()
+        slices += 1
+        if collector.pending is None:
+            break
+    assert slices > 3
+
+    counters = collector.object.statsd.counters
+    assert counters['nginx.upstream.request.failed'] == 500
+    upstreams = [name for name in counters if 'failed.upstream.' in name and not name.endswith('.other')]
+    clients = [name for name in counters if 'failed.client.' in name and not name.endswith('.other')]
+    assert len(upstreams) == 3
+    assert len(clients) == 3
+    assert counters['nginx.upstream.request.failed.upstream.other'] == 497
+
+
+def test_lines_are_counted_per_level(monkeypatch):
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    lines = [
+        LINE % (1, '10.0.0.1', '10.0.1.1:80'),
+        '2015/07/02 14:49:48 [warn] 123#0: *2 an upstream response is buffered to a temporary file',
+        '2015/07/02 14:49:48 [crit] 123#0: *3 open() failed',
+        '2015/07/02 14:49:48 [notice] 123#0: signal process started',
+        'not a standard line',
+    ]
+    collector = NginxErrorLogsCollector(object=_Object(), interval=10, level='error', tail=lines)
+    collector.collect()
+
+    counters = collector.object.statsd.counters
+    assert counters['nginx.errorlog.error'] == 1
+    assert counters['nginx.errorlog.warn'] == 1
+    assert counters['nginx.errorlog.crit'] == 1
+    assert 'nginx.errorlog.notice' not in counters
+    assert counters['nginx.upstream.request.failed'] == 1
+    assert counters['nginx.upstream.response.buffered'] == 1
+
+
+def test_error_burst_sends_one_warning(monkeypatch):
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    collector = NginxErrorLogsCollector(
+        object=_Object(), interval=10, level='error', tail=[], burst_window=30, burst_factor=5
+    )
+    events = collector.object.eventd.events
+
+    # baseline of 1 error per 10 seconds
+    now = 1000
+    for _ in range(10):
+        now += 10
+        collector.detect_burst(1, now=now)
+    assert events == []
+
+    # 100 errors in the next cycles, one event for the whole burst
+    for _ in range(3):
+        now += 10
+        collector.detect_burst(100, now=now)
+    assert len(events) == 1
+    assert events[0][0] == WARNING
+    assert 'burst of' in events[0][1]
+
+    # back to normal, then a new burst
+    for _ in range(5):
+        now += 10
+        collector.detect_burst(0, now=now)
+    assert not collector.bursting
+    now += 10
+    collector.detect_burst(500, now=now)
+    assert len(events) == 2
+
+
+def test_error_burst_counts_deferred_cycle_once(monkeypatch):
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    lines = [LINE % (i, '10.0.0.1', '10.0.1.1:80') for i in range(100)]
+    collector = NginxErrorLogsCollector(
+        object=_Object(), interval=10, level='error', tail=lines, burst_window=30, burst_factor=5, time_budget=1e-9
+    )
+    collector.budget_check_lines = 10
+
+    calls = []
+    monkeypatch.setattr(collector, 'detect_burst', lambda errors, now=None: calls.append(errors))
+
+    # the slices of the cycle don't count as cycles of their own
+    collector.collect()
+    assert collector.pending is not None
+    while collector.pending is not None:
+        collector.collect()
+    assert calls == [100]
+
+    collector.tail = [LINE % (100, '10.0.0.1', '10.0.1.1:80')]
+    collector.collect()
+    assert calls == [100, 1]
+
+
+def test_error_burst_baseline_weighs_cycle_duration(monkeypatch):
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    collector = NginxErrorLogsCollector(
+        object=_Object(), interval=10, level='error', tail=[], burst_window=30, burst_factor=5
+    )
+    collector.detect_burst(10, now=1000)
+    assert collector.baseline == 1.0
+
+    # a short cycle moves the baseline less than a full interval would
+    collector.detect_burst(0, now=1001)
+    assert collector.baseline == pytest.approx(0.99)
+    collector.detect_burst(0, now=1011)
+    assert collector.baseline == pytest.approx(0.891)
+
+
+def test_file_tail_with_watcher(monkeypatch, tmp_path):
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    monkeypatch.setattr(file_pipeline, "WATCHER", None)
+    watcher = file_pipeline.setup_watcher()
+    if watcher is None:
+        pytest.skip("inotify is not available")
+
+    path = str(tmp_path / "error.log")
+    with open(path, "w") as fh:
+        fh.write("")
+
+    collector = NginxErrorLogsCollector(
+        object=_Object(), interval=10, level='error', tail=FileTail(path), time_budget=1
+    )
+    with open(path, "a") as fh:
+        fh.write("".join(LINE % (i, '10.0.0.1', '10.0.1.1:80') + "\n" for i in range(3)))
+    collector.collect()
+    collector.collect()  # nothing new
+
+    counters = collector.object.statsd.counters
+    assert counters['nginx.errorlog.error'] == 3
+    assert counters['nginx.upstream.request.failed'] == 3
+
+    collector.tail.stop()
+    assert watcher.tails == {}
+    watcher.close()
+    OFFSET_CACHE.pop(path)
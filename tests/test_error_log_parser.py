@@ -0,0 +1,98 @@
+"""
+Tests for the nginx error log parser.
+"""
+import re
+
+from amplify.agent.objects.nginx.log import error as error_log
+from amplify.agent.objects.nginx.log.error import (
+    NginxErrorLogParser, error_keywords, error_re, prefilter_keywords, upstream_address
+)
+
+
+PREFIX = '2015/07/02 14:49:48 [error] 123#0: *4567 '
+
+LINES = [
+    'connect() failed (111: Connection refused) while connecting to upstream, client: 10.0.0.1, server: x',
+    'upstream timed out (110: Connection timed out) while reading response header from upstream, client: 10.0.0.1',
+    'a client request body is buffered to a temporary file /var/cache/nginx/client_temp/0000000001, client: 10.0.0.1',
+    'an upstream response is buffered to a temporary file /var/cache/nginx/proxy_temp/1/00/0000000001 '
+    'while reading upstream, client: 10.0.0.1',
+    'no live upstreams while connecting to upstream, client: 10.0.0.1, server: x',
+    'upstream prematurely closed connection while reading response header from upstream, client: 10.0.0.1',
+    'upstream sent no valid HTTP/1.0 header while reading response header from upstream, client: 10.0.0.1',
+    'recv() failed (104: Connection reset by peer) while reading upstream, client: 10.0.0.1',
+    'upstream buffer is too small to read response, client: 10.0.0.1',
+    'upstream queue is full while connecting to upstream',
+    'open() "/usr/share/nginx/html/favicon.ico" failed (2: No such file or directory), client: 10.0.0.1',
+    'SSL_do_handshake() failed while SSL handshaking to upstream, client: 10.0.0.1',
+    'limiting requests, excess: 0.500 by zone "one", client: 10.0.0.1',
+]
+
+
+def _match_one_by_one(line):
+    for error, regexps in error_re.items():
+        for regexp in regexps:
+            if re.match(regexp, line):
+                return error
+    return None
+
+
+def test_classifier_returns_the_same_errors_as_regexps_one_by_one():
+    parser = NginxErrorLogParser()
+    for line in LINES:
+        assert parser.parse(PREFIX + line) == _match_one_by_one(PREFIX + line), line
+
+    # the first error in error_re order wins
+    assert parser.parse(LINES[3]) == 'nginx.upstream.response.buffered'
+    assert parser.parse(LINES[0]) == 'nginx.upstream.request.failed'
+    assert parser.parse(LINES[-1]) is None
+
+
+def test_every_error_regexp_requires_a_keyword():
+    # if this fails, a regexp of error_re lacks all of error_keywords and lines are not prefiltered anymore
+    assert prefilter_keywords(error_re, error_keywords) == error_keywords
+    assert NginxErrorLogParser().keywords == error_keywords
+
+
+def test_regexp_without_keyword_disables_prefilter(monkeypatch):
+    errors = dict(error_re)
+    errors['nginx.http.request.test'] = [re.compile(r'.*client sent invalid header line.*')]
+    assert prefilter_keywords(errors, error_keywords) == ()
+
+    monkeypatch.setattr(error_log, 'error_re', errors)
+    parser = NginxErrorLogParser()
+    assert parser.parse(PREFIX + 'client sent invalid header line: "x" while reading client request headers') == \
+        'nginx.http.request.test'
+    assert parser.parse(PREFIX + LINES[0]) == 'nginx.upstream.request.failed'
+
+    # keywords in optional parts or alternatives are not required
+    assert prefilter_keywords({'e': [re.compile(r'.*upstream*')]}, error_keywords) == ()
+    assert prefilter_keywords({'e': [re.compile(r'.*(upstream|x).*')]}, error_keywords) == ()
+
+
+def test_parse_fields_of_standard_line():
+    fields = NginxErrorLogParser.parse_fields(
+        PREFIX + 'connect() failed (111: Connection refused) while connecting to upstream, client: 10.0.0.1, '
+        'server: example.com, request: "GET /a, b HTTP/1.1", upstream: "http://10.0.0.2:8080/a", host: "example.com"'
+    )
+    assert fields['time'] == '2015/07/02 14:49:48'
+    assert fields['level'] == 'error'
+    assert fields['pid'] == '123'
+    assert fields['connection'] == '4567'
+    assert fields['message'] == 'connect() failed (111: Connection refused) while connecting to upstream'
+    assert fields['client'] == '10.0.0.1'
+    assert fields['request'] == 'GET /a, b HTTP/1.1'
+    assert fields['upstream'] == 'http://10.0.0.2:8080/a'
+    assert fields['host'] == 'example.com'
+
+    assert NginxErrorLogParser.parse_fields('not an error line') is None
+    assert upstream_address('http://10.0.0.2:8080/a') == '10.0.0.2:8080'
+    assert upstream_address('fastcgi://unix:/run/php-fpm.sock:') == 'unix:/run/php-fpm.sock'
+
+
+def test_parse_level_at_fixed_offset():
+    assert NginxErrorLogParser.parse_level(PREFIX + LINES[0]) == 'error'
+    assert NginxErrorLogParser.parse_level('2015/07/02 14:49:48 [notice] 123#0: signal process started') == 'notice'
+    assert NginxErrorLogParser.parse_level('2015/07/02 14:49:48 [emerg] 1#1: bind() failed') == 'emerg'
+    assert NginxErrorLogParser.parse_level('not an error line') is None
+    assert NginxErrorLogParser.parse_level('') is None
@@ -2,9 +2,15 @@
 Tests for the file pipeline (FileTail).
 """
 import itertools
+import logging
+import operator
 import os
 import tempfile
 
+import pytest
+
+from amplify.agent.common.context import context
+from amplify.agent.pipelines import file as file_pipeline
 from amplify.agent.pipelines.file import FileTail, OFFSET_CACHE
 
 
@@ -39,3 +45,433 @@ def test_filetail_tolerates_non_utf8_bytes():
             os.unlink(path)
         except OSError:
             pass
+
+
+def _new_tail(path, **kwargs):
+    OFFSET_CACHE.pop(path, None)
+    tail = FileTail(path, **kwargs)
+    OFFSET_CACHE[path] = 0
+    tail._offset = 0
+    return tail
+
+
+def test_filetail_block_mode_splits_lines_across_blocks():
+    fd, path = tempfile.mkstemp(suffix=".log")
+    os.close(fd)
+    try:
+        lines = ["line %d %s" % (i, "x" * (i % 7)) for i in range(50)]
+        with open(path, "w") as fh:
+            fh.write("\r\n".join(lines[:10]) + "\r\n" + "\n".join(lines[10:]) + "\n")
+
+        block_tail = _new_tail(path, block_size=16)
+        assert list(block_tail) == lines
+        assert OFFSET_CACHE[path] == os.path.getsize(path)
+
+        line_tail = _new_tail(path, block_size=0)
+        assert list(line_tail) == lines
+    finally:
+        OFFSET_CACHE.pop(path, None)
+        os.unlink(path)
+
+
+def test_filetail_block_mode_carries_partial_line():
+    fd, path = tempfile.mkstemp(suffix=".log")
+    os.close(fd)
+    try:
+        with open(path, "wb") as fh:
+            fh.write(b"first\nsec")
+
+        tail = _new_tail(path, block_size=4)
+        assert list(tail) == ["first"]
+        assert OFFSET_CACHE[path] == len(b"first\n")  # offset stays at the start of the partial line
+
+        with open(path, "ab") as fh:
+            fh.write(b"ond\nthird\n")
+        assert list(tail) == ["second", "third"]
+        assert OFFSET_CACHE[path] == os.path.getsize(path)
+    finally:
+        OFFSET_CACHE.pop(path, None)
+        os.unlink(path)
+
+
+def test_filetail_block_mode_handles_copytruncate():
+    fd, path = tempfile.mkstemp(suffix=".log")
+    os.close(fd)
+    try:
+        with open(path, "wb") as fh:
+            fh.write(b"old line 1\nold line 2\n")
+
+        tail = _new_tail(path)
+        assert list(tail) == ["old line 1", "old line 2"]
+
+        with open(path, "wb") as fh:  # truncate in place, inode stays the same
+            fh.write(b"new\n")
+        assert list(tail) == ["new"]
+        assert OFFSET_CACHE[path] == 4
+    finally:
+        OFFSET_CACHE.pop(path, None)
+        os.unlink(path)
+
+
+def test_filetail_catchup_mode_reads_from_mmap(monkeypatch):
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    fd, path = tempfile.mkstemp(suffix=".log")
+    os.close(fd)
+    try:
+        lines = ["request %d %s" % (i, "y" * (i % 13)) for i in range(2000)]
+        with open(path, "w") as fh:
+            fh.write("\n".join(lines) + "\npartial")
+
+        tail = _new_tail(path, block_size=100, catchup_threshold=1000)
+        iterator = iter(tail)
+        assert iterator is tail
+        first = next(iterator)  # the pass starts with the first line
+        assert tail._map is not None
+        assert [first] + list(iterator) == lines
+        assert tail._map is None  # mapped region consumed, back to regular reads
+        assert OFFSET_CACHE[path] == os.path.getsize(path) - len("partial")
+
+        with open(path, "a") as fh:
+            fh.write(" line\n")
+        assert list(tail) == ["partial line"]
+    finally:
+        OFFSET_CACHE.pop(path, None)
+        os.unlink(path)
+
+
+def test_filetail_max_backlog_skips_oldest_lines(monkeypatch):
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    fd, path = tempfile.mkstemp(suffix=".log")
+    os.close(fd)
+    try:
+        with open(path, "w") as fh:
+            fh.write("".join("line %03d\n" % i for i in range(100)))  # 9 bytes per line
+
+        tail = _new_tail(path, max_backlog=95)
+        assert list(tail) == ["line %03d" % i for i in range(90, 100)]
+        assert tail.skipped_bytes == 90 * 9
+    finally:
+        OFFSET_CACHE.pop(path, None)
+        os.unlink(path)
+
+
+def test_filetail_resumes_from_offset_store(monkeypatch, tmp_path):
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    monkeypatch.setattr(file_pipeline, "OFFSET_STORE", None)
+    path = str(tmp_path / "access.log")
+    store_path = str(tmp_path / "offsets.json")
+    with open(path, "w") as fh:
+        fh.write("seen 1\nseen 2\n")
+
+    store = file_pipeline.setup_offset_store(store_path)
+    tail = _new_tail(path)
+    assert list(tail) == ["seen 1", "seen 2"]
+    tail.stop()
+
+    # lines written while the agent was down
+    with open(path, "a") as fh:
+        fh.write("missed 1\nmissed 2\n")
+
+    # simulate restart: no in-process cache, store loaded from disk
+    OFFSET_CACHE.pop(path)
+    monkeypatch.setattr(file_pipeline, "OFFSET_STORE", None)
+    restarted_store = file_pipeline.setup_offset_store(store_path)
+    assert restarted_store is not store
+    assert list(FileTail(path)) == ["missed 1", "missed 2"]
+    OFFSET_CACHE.pop(path)
+
+
+def test_offset_store_ignores_replaced_file(monkeypatch, tmp_path):
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    path = str(tmp_path / "access.log")
+    with open(path, "w") as fh:
+        fh.write("old content\n")
+
+    store = file_pipeline.OffsetStore(str(tmp_path / "offsets.json"))
+    with open(path, "rb") as fh:
+        store.set(path, os.fstat(fh.fileno()).st_ino, 12, file_pipeline.fingerprint(fh.fileno()))
+    assert store.get(path) == 12
+
+    with open(path, "w") as fh:  # same inode, different content
+        fh.write("new content, longer\n")
+    assert store.get(path) is None
+
+
+def test_offset_store_drops_removed_and_replaced_files(monkeypatch, tmp_path):
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    store_path = str(tmp_path / "offsets.json")
+    paths = [str(tmp_path / name) for name in ("kept.log", "removed.log", "replaced.log")]
+    store = file_pipeline.OffsetStore(store_path)
+    for path in paths:
+        with open(path, "w") as fh:
+            fh.write("content\n")
+        with open(path, "rb") as fh:
+            store.set(path, os.fstat(fh.fileno()).st_ino, 8, file_pipeline.fingerprint(fh.fileno()))
+
+    os.unlink(paths[1])
+    with open(paths[2] + ".new", "w") as fh:
+        fh.write("content\n")
+    os.replace(paths[2] + ".new", paths[2])  # another file under the same name
+
+    store.save(force=True)
+    assert sorted(store.offsets) == [paths[0]]
+    assert sorted(file_pipeline.OffsetStore(store_path).offsets) == [paths[0]]
+
+
+def _watcher():
+    try:
+        return file_pipeline.FileWatcher()
+    except OSError:
+        pytest.skip("inotify is not available")
+
+
+def test_filetail_with_watcher_skips_idle_files(monkeypatch, tmp_path):
+    monkeypatch.setattr(file_pipeline, "WATCHER", _watcher())
+    path = str(tmp_path / "access.log")
+    with open(path, "w") as fh:
+        fh.write("first\n")
+
+    tail = _new_tail(path)
+    assert list(tail) == ["first"]
+
+    calls = []
+    original = tail._filehandle
+    monkeypatch.setattr(tail, "_filehandle", lambda: calls.append(1) or original())
+    assert list(tail) == []
+    assert calls == []  # no stat() and open() for an idle file
+
+    with open(path, "a") as fh:
+        fh.write("second\n")
+    assert list(tail) == ["second"]
+
+    with open(path, "w") as fh:  # copytruncate
+        fh.write("truncated\n")
+    assert list(tail) == ["truncated"]
+
+    os.rename(path, path + ".1")  # rotation
+    with open(path, "w") as fh:
+        fh.write("rotated\n")
+    assert list(tail) == ["rotated"]
+
+    with open(path, "a") as fh:
+        fh.write("after rotation\n")
+    assert list(tail) == ["after rotation"]
+    assert list(tail) == []
+
+    tail.stop()
+    assert file_pipeline.WATCHER.tails == {}
+    assert file_pipeline.WATCHER.directory_watches == {}
+    file_pipeline.WATCHER.close()
+    OFFSET_CACHE.pop(path)
+
+
+def test_shared_tail_reads_file_once_for_all_subscribers(monkeypatch, tmp_path):
+    monkeypatch.setattr(file_pipeline, "SHARED_READ_SIZE", 3)
+    path = str(tmp_path / "access.log")
+    link = str(tmp_path / "access_link.log")
+    with open(path, "w") as fh:
+        fh.write("")
+    os.symlink(path, link)
+
+    first = file_pipeline.shared_tail(path)
+    second = file_pipeline.shared_tail(link)
+    source = first.source
+    assert second.source is source
+    assert second.name == "file:%s" % link
+
+    reads = []
+    original = source.read
+    monkeypatch.setattr(source, "read", lambda *args: reads.append(1) or original(*args))
+
+    lines = ["line %d" % i for i in range(10)]
+    with open(path, "a") as fh:
+        fh.write("\n".join(lines) + "\n")
+
+    assert list(first) == lines
+    assert list(second) == lines  # buffered while the first one was reading
+    assert len(reads) == 5  # 4 chunks of up to 3 lines by the first subscriber and an empty read by the second
+
+    # an iteration reads the source once the buffer is empty, and stops at the end of the read pass
+    del reads[:]
+    assert list(first) == []
+    assert len(reads) == 1
+
+    with open(path, "a") as fh:
+        fh.write("one more\n")
+    assert list(second) == ["one more"]
+    assert list(first) == ["one more"]
+
+    first.stop()
+    assert list(file_pipeline.SHARED_TAILS.values()) == [source]
+    second.stop()
+    assert file_pipeline.SHARED_TAILS == {}
+    OFFSET_CACHE.pop(path)
+
+
+def test_filetail_reports_backlog_and_buffered_lines(tmp_path):
+    path = str(tmp_path / "access.log")
+    with open(path, "w") as fh:
+        fh.write("".join("line %03d\n" % i for i in range(10)))  # 9 bytes per line
+
+    tail = _new_tail(path, block_size=45)
+    iterator = iter(tail)
+    assert next(iterator) == "line 000"
+    assert operator.length_hint(tail) == 4  # the rest of the first block
+    assert tail.backlog() == 45
+
+    assert len(list(iterator)) == 9
+    assert tail.backlog() == 0
+    OFFSET_CACHE.pop(path)
+
+
+def test_filetail_catchup_mode_starts_at_offset(monkeypatch, tmp_path):
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    path = str(tmp_path / "access.log")
+    with open(path, "w") as fh:
+        fh.write("seen\n")
+
+    tail = _new_tail(path, catchup_threshold=10)
+    assert list(tail) == ["seen"]
+
+    with open(path, "a") as fh:
+        fh.write("".join("new %d\n" % i for i in range(5)))
+    assert list(tail) == ["new %d" % i for i in range(5)]
+    OFFSET_CACHE.pop(path)
+
+
+def test_filetail_groups_lines_of_multiline_records(monkeypatch, tmp_path):
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    path = str(tmp_path / "access.log")
+    records = ["request %d\nstatus %d\r\nbytes %s" % (i, i, "z" * (i % 5)) for i in range(40)]
+    with open(path, "w", newline="") as fh:
+        fh.write("\n".join(records) + "\nrequest 40\n")  # the last record is incomplete
+
+    expected = [record.replace("\r", "") for record in records]
+    for kwargs in (dict(block_size=7), dict(block_size=64), dict(block_size=0), dict(catchup_threshold=10)):
+        tail = _new_tail(path, lines_per_record=3, **kwargs)
+        assert list(tail) == expected, kwargs
+        assert OFFSET_CACHE[path] == os.path.getsize(path) - len("request 40\n")
+
+    with open(path, "a") as fh:
+        fh.write("status 40\nbytes 40\n")
+    assert list(tail) == ["request 40\nstatus 40\nbytes 40"]
+    OFFSET_CACHE.pop(path)
+
+
+def test_filetail_drops_record_torn_by_rotation(tmp_path):
+    path = str(tmp_path / "access.log")
+    with open(path, "w") as fh:
+        fh.write("first\nrecord\nsecond\n")
+
+    tail = _new_tail(path, lines_per_record=2)
+    assert list(tail) == ["first\nrecord"]
+
+    os.rename(path, path + ".1")
+    with open(path, "w") as fh:
+        fh.write("new\nrecord\n")
+    assert list(tail) == ["new\nrecord"]
+    OFFSET_CACHE.pop(path)
+
+
+def test_filetail_with_watcher_can_be_iterated_again(monkeypatch, tmp_path):
+    monkeypatch.setattr(file_pipeline, "WATCHER", _watcher())
+    path = str(tmp_path / "access.log")
+    with open(path, "w") as fh:
+        fh.write("first\n")
+
+    tail = _new_tail(path)
+    assert iter(tail) is tail
+    assert list(iter(iter(tail))) == ["first"]
+    assert list(tail) == []
+    other = FileTail(path)  # another tail of the same file
+
+    with open(path, "a") as fh:
+        fh.write("second\n")
+    assert list(iter(tail)) == ["second"]
+    assert list(other) == ["second"]  # the change wasn't used up by the first tail
+
+    # a tail that is garbage collected releases its watch
+    del tail, other
+    assert file_pipeline.WATCHER.tails == {}
+    file_pipeline.WATCHER.close()
+    OFFSET_CACHE.pop(path)
+
+
+def test_shared_tail_with_watcher(monkeypatch, tmp_path):
+    monkeypatch.setattr(file_pipeline, "WATCHER", _watcher())
+    monkeypatch.setattr(file_pipeline, "SHARED_READ_SIZE", 3)
+    path = str(tmp_path / "access.log")
+    with open(path, "w") as fh:
+        fh.write("")
+
+    first = file_pipeline.shared_tail(path)
+    second = file_pipeline.shared_tail(path)
+
+    lines = ["line %d" % i for i in range(5)]
+    with open(path, "a") as fh:
+        fh.write("\n".join(lines) + "\n")
+    assert list(iter(first)) == lines
+    assert list(iter(second)) == lines
+    assert list(first) == []
+
+    with open(path, "a") as fh:
+        fh.write("one more\n")
+    assert list(second) == ["one more"]
+    assert list(first) == ["one more"]
+
+    first.stop()
+    second.stop()
+    assert file_pipeline.SHARED_TAILS == {}
+    assert file_pipeline.WATCHER.tails == {}
+    file_pipeline.WATCHER.close()
+    OFFSET_CACHE.pop(path)
+
+
+def test_filetail_max_backlog_skips_to_record_start(monkeypatch, tmp_path):
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    path = str(tmp_path / "access.log")
+    with open(path, "w") as fh:
+        fh.write("".join("first %03d\nsecond %03d\nthird %03d\n" % (i, i, i) for i in range(100)))
+
+    for max_backlog in range(300, 340):  # cuts at every position within a record
+        tail = _new_tail(path, max_backlog=max_backlog, lines_per_record=3)
+        records = list(tail)
+        assert records, max_backlog
+        assert all(record.startswith("first ") for record in records), max_backlog
+        assert records[-1] == "first 099\nsecond 099\nthird 099"
+        tail.stop()
+    OFFSET_CACHE.pop(path)
+
+
+@pytest.mark.parametrize("block_size", [7, file_pipeline.BLOCK_SIZE])
+def test_filetail_max_backlog_skip_waits_for_unterminated_record(monkeypatch, tmp_path, block_size):
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    monkeypatch.setattr(file_pipeline, "BLOCK_SIZE", block_size)
+    path = str(tmp_path / "access.log")
+    records = "".join("first %03d\nsecond %03d\nthird %03d\n" % (i, i, i) for i in range(100))
+    with open(path, "w") as fh:
+        fh.write(records + "first 100\nsecond 100\nthird 1")  # the last record is being written
+
+    for max_backlog in range(1, 60):  # cuts within the last line, the last record and the record before
+        tail = _new_tail(path, max_backlog=max_backlog, lines_per_record=3)
+        assert all(record.startswith("first ") for record in tail), max_backlog
+        assert OFFSET_CACHE[path] == len(records), max_backlog
+        tail.stop()
+    OFFSET_CACHE.pop(path)
+
+
+@pytest.mark.parametrize("block_size", [4, file_pipeline.BLOCK_SIZE])
+def test_filetail_max_backlog_skip_waits_for_unterminated_line(monkeypatch, tmp_path, block_size):
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    monkeypatch.setattr(file_pipeline, "BLOCK_SIZE", block_size)
+    path = str(tmp_path / "access.log")
+    lines = "".join("line %03d\n" % i for i in range(100))
+    with open(path, "w") as fh:
+        fh.write(lines + "line 1")  # the last line is being written
+
+    for max_backlog in range(1, 30):  # cuts within the last line and the lines before
+        tail = _new_tail(path, max_backlog=max_backlog)
+        assert all(len(line) == 8 for line in tail), max_backlog
+        assert OFFSET_CACHE[path] == len(lines), max_backlog
+        tail.stop()
+    OFFSET_CACHE.pop(path)
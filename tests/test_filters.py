@@ -0,0 +1,45 @@
+"""
+Tests for custom log filters.
+"""
+import random
+
+from amplify.agent.objects.nginx.filters import Filter, FilterMatcher
+
+
+def test_filter_matcher_agrees_with_filter_match():
+    rnd = random.Random(5)
+    conditions = [
+        ('$status', '~', '200'),
+        ('$status', '~', '5..'),
+        ('$status', '!~', '4.*'),
+        ('$status', '~', '50[234]$'),
+        ('$request_method', '~', 'get'),
+        ('$request_method', '!~', 'POST|PUT'),
+        ('$request_uri', '~', '/api/'),
+        ('$request_uri', '~', '/api/(v1|v2)'),
+        ('$request_uri', '~', '.*\\.php'),
+        ('$request_uri', '~', '(?i)/STATIC'),
+        ('$request_uri', '~', '/unclosed['),
+        ('$request_uri', '~', ''),
+        ('$upstream_addr', '~', '10.0.0.1'),
+        ('$body_bytes_sent', '!~', '0'),
+    ]
+    filters = [
+        Filter(data=rnd.sample(conditions, rnd.randint(1, 3)), metric='nginx.http.status.2xx', filter_rule_id=i)
+        for i in range(60)
+    ]
+    matcher = FilterMatcher(filters)
+
+    for _ in range(2000):
+        parsed = {
+            'status': rnd.choice(['200', '204', '404', '499', '500', '502', '503']),
+            'request_method': rnd.choice(['GET', 'POST', 'PUT', 'HEAD']),
+            'request_uri': rnd.choice(['/', '/api/v1/x', '/api/v3', '/index.php', '/static/a.css', '/unclosed[']),
+            'body_bytes_sent': rnd.choice([0, 10, 1024]),
+        }
+        if rnd.random() < 0.5:
+            parsed['upstream_addr'] = rnd.choice([['10.0.0.1:80'], ['10.0.0.2:80', '10.0.0.1:80']])
+        if rnd.random() < 0.1:
+            del parsed['status']
+
+        assert matcher.match(parsed) == [f for f in filters if f.match(parsed)]
@@ -0,0 +1,84 @@
+"""
+Tests for the log worker pool.
+"""
+import logging
+
+import pytest
+
+from amplify.agent.collectors.nginx.accesslog import NginxAccessLogsCollector
+from amplify.agent.common.context import context
+from amplify.agent.objects.nginx.filters import Filter
+from amplify.agent.pipelines.file import FileTail, OFFSET_CACHE
+from amplify.agent.pipelines.pool import LogWorkerPool, _WorkerObject
+
+
+LINE = '10.0.0.%d - - [02/Jul/2015:14:49:48 +0000] "%s /page/%d HTTP/1.1" %d %d "-" "curl/7.35.0"'
+
+
+def test_worker_aggregates_match_in_process_collector(monkeypatch, tmp_path):
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    path = str(tmp_path / "access.log")
+    with open(path, "w") as fh:
+        fh.write("")
+
+    filters = [Filter(data=[('$status', '~', '5..')], metric='nginx.http.status.5xx', filter_rule_id=1)]
+    pool = LogWorkerPool(2)
+    try:
+        tail = pool.tail(path, filters=filters, definition_hash='test')
+        local = NginxAccessLogsCollector(
+            object=_WorkerObject([(f.original_data, f.metric, f.filter_rule_id) for f in filters], 'test'),
+            tail=FileTail(path),
+            batch_size=0
+        )
+
+        with open(path, "a") as fh:
+            for i in range(300):
+                method = ('GET', 'POST', 'HEAD')[i % 3]
+                fh.write(LINE % (i % 250, method, i, (200, 404, 502)[i % 3], i * 10) + "\n")
+
+        batch = tail.collect()
+        local.collect()
+        expected = local.object.statsd
+        assert batch.counters == expected.counters
+        assert batch.counters['nginx.http.status.5xx||1'] == 100
+        assert batch.averages == expected.averages
+        assert batch.timers == expected.timers
+
+        # nothing new to process
+        assert tail.collect().counters['nginx.http.status.2xx'] == 0
+
+        tail.stop()
+        assert tail.worker is None
+    finally:
+        pool.stop()
+        OFFSET_CACHE.pop(path, None)
+
+
+def test_restarted_worker_resumes_from_acknowledged_offset(monkeypatch, tmp_path):
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    path = str(tmp_path / "access.log")
+    with open(path, "w") as fh:
+        fh.write("")
+
+    pool = LogWorkerPool(1)
+    try:
+        tail = pool.tail(path, definition_hash='test')
+        with open(path, "a") as fh:
+            for i in range(10):
+                fh.write(LINE % (i, 'GET', i, 200, 100) + "\n")
+        assert tail.collect().counters['nginx.http.status.2xx'] == 10
+
+        # lines written while the worker is down are processed by the restarted worker
+        with open(path, "a") as fh:
+            for i in range(5):
+                fh.write(LINE % (i, 'GET', i, 200, 100) + "\n")
+        tail.worker.process.kill()
+        tail.worker.process.join()
+        with pytest.raises((EOFError, OSError)):
+            tail.collect()
+        assert tail.collect().counters['nginx.http.status.2xx'] == 5
+
+        tail.stop()
+    finally:
+        pool.stop()
+        OFFSET_CACHE.pop(path, None)
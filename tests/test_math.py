@@ -0,0 +1,15 @@
+"""
+Tests for math helpers.
+"""
+import random
+
+from amplify.agent.common.util.math import select
+
+
+def test_select_matches_sorted_order():
+    rnd = random.Random(42)
+    for length in (1, 2, 63, 64, 65, 1000, 5001):
+        values = [rnd.choice((rnd.random(), 0.5)) for _ in range(length)]  # with duplicates
+        ordered = sorted(values)
+        ranks = set(rnd.randrange(length) for _ in range(5)) | {0, length - 1}
+        assert select(values, ranks) == dict((rank, ordered[rank]) for rank in ranks)
@@ -0,0 +1,39 @@
+"""
+Tests for the DDSketch quantile sketch.
+"""
+import random
+
+from amplify.agent.common.util.sketch import DDSketch
+
+
+def test_sketch_quantiles_are_within_relative_accuracy():
+    rnd = random.Random(7)
+    values = [rnd.lognormvariate(-3, 1.5) for _ in range(20000)]
+    ordered = sorted(values)
+
+    sketch = DDSketch(relative_accuracy=0.01)
+    sketch.extend(values)
+
+    assert sketch.count == len(values)
+    assert sketch.max == ordered[-1]
+    assert sketch.min == ordered[0]
+    for rank in (0, 100, 5000, 10000, 19000, 19999):
+        exact = ordered[rank]
+        assert abs(sketch.value(rank) - exact) <= 0.01 * exact
+
+
+def test_sketch_memory_is_bounded():
+    sketch = DDSketch(relative_accuracy=0.01, max_buckets=64)
+    for i in range(1, 100000):
+        sketch.add(i * 0.001)
+    assert len(sketch.buckets) <= 64
+    # collapsing only hurts the lowest quantiles
+    assert abs(sketch.quantile(0.95) - 95.0) <= 0.01 * 95.0
+
+
+def test_sketch_zero_values():
+    sketch = DDSketch()
+    sketch.extend([0.0, 0.0, 0.5])
+    assert sketch.value(0) == 0.0
+    assert sketch.value(1) == 0.0
+    assert abs(sketch.value(2) - 0.5) <= 0.01 * 0.5
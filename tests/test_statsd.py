@@ -0,0 +1,98 @@
+"""
+Tests for the statsd data client.
+"""
+import random
+
+from amplify.agent.data.statsd import StatsdBatch, StatsdClient
+
+
+class _Object(object):
+    definition = {'type': 'nginx'}
+
+
+def _client():
+    return StatsdClient(object=_Object(), interval=60)
+
+
+def _values(flushed):
+    """Strip timestamps from flushed metrics."""
+    return dict(
+        (kind, dict((name, [value for _, value in points]) for name, points in metrics.items()))
+        for kind, metrics in flushed['metrics'].items()
+    )
+
+
+def test_batch_flush_matches_direct_calls():
+    direct, batched = _client(), _client()
+    batch = StatsdBatch()
+
+    for client in (direct, batch):
+        for i in range(10):
+            client.incr('nginx.http.status.2xx')
+            client.incr('nginx.http.request.bytes_sent', i * 100)
+            client.incr('nginx.upstream.next.count', 0)
+            client.average('nginx.http.request.length', i + 0.5)
+            client.timer('nginx.http.request.time', i / 10.0)
+            client.timer('nginx.http.request.time||7', i / 20.0)
+
+    batch.flush(batched)
+    assert len(batch) == 0
+    assert _values(direct.flush()) == _values(batched.flush())
+
+
+def test_batch_skips_negative_counter_values():
+    batch = StatsdBatch()
+    batch.incr('nginx.upstream.next.count', -1)
+    assert batch.counters == {}
+
+
+def test_timer_flush_statistics():
+    client = _client()
+    values = [0.5, 0.1, 0.9, 0.3] + [0.2] * 16  # 20 samples, so pctl95 drops none of them
+    for value in values:
+        client.timer('nginx.upstream.response.time||3', value)
+
+    timers = _values(client.flush())['timer']
+    ordered = sorted(values)
+    assert timers['G|nginx.upstream.response.time||3'] == [sum(values) / len(values)]
+    assert timers['C|nginx.upstream.response.time.count||3'] == [20]
+    assert timers['G|nginx.upstream.response.time.max||3'] == [0.9]
+    assert timers['G|nginx.upstream.response.time.median||3'] == [(ordered[9] + ordered[10]) / 2.0]
+    assert timers['G|nginx.upstream.response.time.pctl95||3'] == [ordered[-1]]
+
+
+def test_flush_resets_current_values():
+    client = _client()
+    client.timer('nginx.http.request.time', 1.0)
+    client.average('nginx.http.request.length', 10)
+    first = client.flush()
+    client.timer('nginx.http.request.time', 3.0)
+
+    assert first['metrics']['timer']['G|nginx.http.request.time'][0][1] == 1.0
+    assert first['metrics']['average']['G|nginx.http.request.length'][0][1] == 10.0
+    assert list(client.current['timer']['nginx.http.request.time']) == [3.0]
+
+
+def test_sketch_mode_error_compared_to_exact():
+    rnd = random.Random(3)
+    values = [rnd.expovariate(20) for _ in range(5000)]
+
+    exact, sketched = _client(), StatsdClient(object=_Object(), interval=60, sketch_accuracy=0.01)
+    for client in (exact, sketched):
+        for value in values:
+            client.timer('nginx.http.request.time', value)
+            client.timer('nginx.upstream.response.time||5', value)
+        client.timer('plus.upstream.response.time', 0.5)
+
+    assert 'nginx.http.request.time' in sketched.current['sketch']
+    assert 'nginx.upstream.response.time||5' in sketched.current['sketch']
+    assert 'plus.upstream.response.time' in sketched.current['timer']
+
+    exact_timers = _values(exact.flush())['timer']
+    sketched_timers = _values(sketched.flush())['timer']
+    assert sorted(exact_timers) == sorted(sketched_timers)
+    for name, (value,) in exact_timers.items():
+        if '.median' in name or '.pctl95' in name:
+            assert abs(sketched_timers[name][0] - value) <= 0.01 * value
+        else:
+            assert abs(sketched_timers[name][0] - value) <= 1e-9
@@ -29,3 +29,78 @@ def test_syslog_listener_class_exists():
     from amplify.agent.pipelines.syslog import SyslogListener
 
     assert SyslogListener is not None
+
+
+def test_syslog_server_drains_socket_in_one_read(monkeypatch):
+    """Test that one read receives all queued packets and counts truncated ones."""
+    import logging
+    import socket
+    from collections import deque
+
+    from amplify.agent.common.context import context
+    from amplify.agent.pipelines.syslog import SYSLOG_ADDRESSES, SyslogServer
+
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    cache = deque(maxlen=100)
+    server = SyslogServer(cache, ("127.0.0.1", 0), chunk_size=64, rcvbuf=65536)
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for i in range(20):
+            client.sendto(b"<190>Jul  2 14:49:48 host amplify: line %d\n" % i, server.address)
+        client.sendto(b"<190>Jul  2 14:49:48 host amplify: " + b"x" * 100, server.address)
+        client.sendto(b"no tag", server.address)
+
+        while server.poll(timeout=0.1):
+            pass
+
+        assert list(cache)[:20] == ["line %d" % i for i in range(20)]
+        assert cache[20] == "x" * (64 - len("<190>Jul  2 14:49:48 host amplify: "))
+        assert len(cache) == 21
+
+        counters = server.take_counters()
+        assert counters["received"] == 22
+        assert counters["truncated"] == 1
+        assert counters["dropped"] in (0, None)
+        assert server.take_counters()["received"] == 0
+    finally:
+        client.close()
+        server.close()
+        SYSLOG_ADDRESSES.discard(server.address)
+
+
+def test_syslog_server_cache_swap_and_overflow(monkeypatch):
+    """Test that messages go to the swapped in cache and that cache overflows are counted."""
+    import logging
+    import socket
+    from collections import deque
+
+    from amplify.agent.common.context import context
+    from amplify.agent.pipelines.syslog import SYSLOG_ADDRESSES, SyslogServer
+
+    monkeypatch.setattr(context, "default_log", logging.getLogger("test"))
+    cache = deque(maxlen=3)
+    server = SyslogServer(cache, ("127.0.0.1", 0))
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for i in range(5):
+            client.sendto(b"<190>host amplify: first %d" % i, server.address)
+        while server.poll(timeout=0.1):
+            pass
+
+        new_cache = deque(maxlen=3)
+        assert server.swap_cache(new_cache) is cache
+        assert list(cache) == ["first 2", "first 3", "first 4"]
+
+        client.sendto(b"<190>host amplify: second", server.address)
+        while server.poll(timeout=0.1):
+            pass
+        assert list(new_cache) == ["second"]
+        assert len(cache) == 3
+
+        counters = server.take_counters()
+        assert counters["received"] == 6
+        assert counters["overflowed"] == 2
+    finally:
+        client.close()
+        server.close()
+        SYSLOG_ADDRESSES.discard(server.address)
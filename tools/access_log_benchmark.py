@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import gc
+import json
+import logging
+import os
+import platform
+import random
+import re
+import sys
+import time
+import tracemalloc
+
+from argparse import ArgumentParser
+
+# make amplify libs available
+script_location = os.path.abspath(os.path.expanduser(__file__))
+agent_repo_path = os.path.dirname(os.path.dirname(script_location))
+sys.path.append(agent_repo_path)
+
+from amplify.agent.common.context import context
+from amplify.agent.common.util.text import parse_line, parse_line_split
+from amplify.agent.collectors.nginx.accesslog import NginxAccessLogsCollector
+from amplify.agent.data.statsd import StatsdClient
+from amplify.agent.objects.nginx.filters import Filter
+from amplify.agent.objects.nginx.log.access import NginxAccessLogParser
+
+
+__author__ = "GetPageSpeed"
+__copyright__ = "Copyright (C) Nginx, Inc. All rights reserved."
+__license__ = ""
+__maintainer__ = "GetPageSpeed"
+__email__ = "info@getpagespeed.com"
+
+
+FORMATS = {
+    'combined': NginxAccessLogParser.combined_format,
+    'upstream': '$remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent "$http_referer" '
+                '"$http_user_agent" rt=$request_time ua="$upstream_addr" us="$upstream_status" '
+                'uct="$upstream_connect_time" uht="$upstream_header_time" urt="$upstream_response_time" '
+                'ul=$upstream_response_length cs=$upstream_cache_status',
+    'wide': '$remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent "$http_referer" '
+            '"$http_user_agent" $request_time $bytes_sent $request_length $gzip_ratio "$upstream_addr" '
+            '"$upstream_status" "$upstream_response_time" "$upstream_connect_time" "$upstream_header_time" '
+            '$upstream_response_length $upstream_cache_status $host $server_name $server_port $scheme '
+            '"$http_x_forwarded_for" $connection $connection_requests $msec $pipe $ssl_protocol $ssl_cipher',
+}
+
+BENCHMARKS = ('parse', 'parse_line_split', 'parse_line', 'collect')
+
+FILTER_COUNTS = (0, 10, 50)
+
+FILTER_METRICS = (
+    'nginx.http.status.2xx', 'nginx.http.status.4xx', 'nginx.http.status.5xx', 'nginx.http.method.get',
+    'nginx.http.method.post', 'nginx.http.request.body_bytes_sent', 'nginx.http.request.time.median',
+    'nginx.upstream.response.time.pctl95', 'nginx.upstream.status.5xx', 'nginx.cache.hit',
+)
+
+
+def random_value(name, rnd):
+    """
+    Returns a plausible value of an nginx variable
+
+    :param name: str variable name
+    :param rnd: random.Random
+    :return: str
+    """
+    upstreams = rnd.choice((1, 1, 1, 2))
+    if name == 'remote_addr':
+        return '10.%d.%d.%d' % (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(1, 254))
+    elif name == 'time_local':
+        return '%02d/Oct/2020:10:%02d:%02d +0000' % (rnd.randint(1, 28), rnd.randint(0, 59), rnd.randint(0, 59))
+    elif name == 'request':
+        return '%s /%s/%d?page=%d %s' % (
+            rnd.choice(('GET', 'GET', 'GET', 'POST', 'HEAD', 'PUT')), rnd.choice(('api', 'static', 'img')),
+            rnd.randint(0, 1000), rnd.randint(0, 50), rnd.choice(('HTTP/1.1', 'HTTP/1.1', 'HTTP/2.0', 'HTTP/1.0'))
+        )
+    elif name == 'status':
+        return rnd.choice(('200', '200', '200', '200', '304', '301', '404', '403', '499', '500', '502'))
+    elif name in ('body_bytes_sent', 'bytes_sent', 'request_length', 'upstream_response_length', 'connection',
+                  'connection_requests'):
+        return str(rnd.randint(0, 100000))
+    elif name == 'http_user_agent':
+        return 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/%d.0' % rnd.randint(60, 99)
+    elif name in ('http_referer', 'http_x_forwarded_for'):
+        return rnd.choice(('-', 'https://example.com/%d' % rnd.randint(0, 100)))
+    elif name in ('request_time', 'msec'):
+        return '%.3f' % rnd.random()
+    elif name == 'gzip_ratio':
+        return rnd.choice(('-', '%.2f' % (rnd.random() * 5)))
+    elif name == 'upstream_addr':
+        return ', '.join('10.0.1.%d:8080' % rnd.randint(1, 9) for _ in range(upstreams))
+    elif name == 'upstream_status':
+        return ', '.join(rnd.choice(('200', '200', '200', '502', '504')) for _ in range(upstreams))
+    elif name.startswith('upstream_') and name.endswith('_time'):
+        return ', '.join('%.3f' % rnd.random() for _ in range(upstreams))
+    elif name == 'upstream_cache_status':
+        return rnd.choice(('-', 'HIT', 'MISS', 'EXPIRED', 'BYPASS'))
+    elif name == 'server_port':
+        return rnd.choice(('80', '443'))
+    elif name == 'scheme':
+        return rnd.choice(('http', 'https'))
+    elif name == 'pipe':
+        return rnd.choice(('.', 'p'))
+    elif name == 'ssl_protocol':
+        return rnd.choice(('TLSv1.2', 'TLSv1.3'))
+    elif name == 'ssl_cipher':
+        return 'ECDHE-RSA-AES128-GCM-SHA256'
+    elif name in ('host', 'server_name'):
+        return 'www%d.example.com' % rnd.randint(1, 3)
+    return '-'
+
+
+def generate_lines(log_format, count, seed=0):
+    """
+    Generates synthetic log lines of a log format
+
+    :param log_format: str nginx log format
+    :param count: int number of lines
+    :param seed: int random seed
+    :return: [] of str
+    """
+    rnd = random.Random(seed)
+    variable = re.compile(r'\$\{?(\w+)\}?')
+    return [variable.sub(lambda match: random_value(match.group(1), rnd), log_format) for _ in range(count)]
+
+
+def generate_filters(count, seed=0):
+    """
+    Generates custom filters on common variables
+
+    :param count: int number of filters
+    :param seed: int random seed
+    :return: [] of Filter
+    """
+    rnd = random.Random(seed)
+    conditions = (
+        ('$request_method', ('GET', 'POST', 'P.*')),
+        ('$status', ('200', '5..', '4\\d\\d', '499')),
+        ('$request_uri', ('/api/.*', '/static/', '/img/1.*')),
+        ('$server_protocol', ('HTTP/1.1', 'HTTP/2.0')),
+        ('$http_user_agent', ('.*Chrome/9.*', 'Mozilla.*')),
+    )
+    filters = []
+    for i in range(count):
+        data = []
+        for key, values in rnd.sample(conditions, rnd.randint(1, 2)):
+            data.append((key, rnd.choice(('~', '~', '!~')), rnd.choice(values)))
+        filters.append(Filter(filter_rule_id=i + 1, metric=rnd.choice(FILTER_METRICS), data=data))
+    return filters
+
+
+class BenchmarkObject(object):
+    """
+    Stand-in for NginxObject with the attributes access log collectors use
+    """
+    type = 'nginx'
+    in_container = False
+    definition_hash = 'benchmark'
+    definition = {'type': 'nginx', 'local_id': 'benchmark'}
+
+    def __init__(self, filters):
+        self.filters = filters
+        self.statsd = StatsdClient(object=self, interval=60)
+
+
+def benchmark_function(name, log_format, lines, filters_count):
+    """
+    Returns a function that processes all lines with one of the benchmarked parsers or the collector
+
+    :param name: str benchmark name
+    :param log_format: str nginx log format
+    :param lines: [] of str
+    :param filters_count: int number of custom filters (collect only)
+    :return: function
+    """
+    parser = NginxAccessLogParser(log_format)
+
+    if name == 'parse':
+        def run():
+            for line in lines:
+                parser.parse(line)
+    elif name == 'parse_line_split':
+        def run():
+            for line in lines:
+                parse_line_split(
+                    line, keys=parser.keys, non_key_patterns=parser.non_key_patterns,
+                    first_value_is_key=parser.first_value_is_key
+                )
+    elif name == 'parse_line':
+        def run():
+            for line in lines:
+                parse_line(line, keys=parser.keys, trie=parser.trie)
+    else:
+        filters = generate_filters(filters_count)
+
+        def run():
+            collector = NginxAccessLogsCollector(
+                object=BenchmarkObject(filters), interval=60, log_format=log_format, tail=lines
+            )
+            collector.collect()
+
+    return run
+
+
+def measure(run, lines, repeat):
+    """
+    Measures the best of several runs and peak memory of one more run
+
+    :param run: function
+    :param lines: [] of str processed by the function
+    :param repeat: int number of timed runs
+    :return: {} of results
+    """
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'seconds': round(best, 6),
+        'lines_per_sec': round(len(lines) / best, 1),
+        'bytes_per_sec': round(sum(len(line) + 1 for line in lines) / best, 1),
+        'peak_allocated_bytes': peak,
+    }
+
+
+def run_benchmarks(formats, benchmarks, filter_counts, lines_count, repeat, seed):
+    """
+    :return: [] of result dicts
+    """
+    results = []
+    for format_name in formats:
+        log_format = FORMATS[format_name]
+        lines = generate_lines(log_format, lines_count, seed=seed)
+        for name in benchmarks:
+            for filters_count in (filter_counts if name == 'collect' else (0,)):
+                result = dict(format=format_name, benchmark=name, filters=filters_count, lines=lines_count)
+                try:
+                    result.update(measure(benchmark_function(name, log_format, lines, filters_count), lines, repeat))
+                except Exception as e:
+                    result['error'] = '%s: %s' % (e.__class__.__name__, e)
+                results.append(result)
+                print_result(result)
+    return results
+
+
+def result_key(result):
+    return result['format'], result['benchmark'], result['filters']
+
+
+def print_result(result, previous=None):
+    name = '%-9s %-17s %2d filters' % result_key(result)
+    if 'error' in result:
+        print('%s  failed: %s' % (name, result['error']))
+        return
+
+    line = '%s  %12.0f lines/s  %10d peak bytes' % (name, result['lines_per_sec'], result['peak_allocated_bytes'])
+    if previous and 'lines_per_sec' in previous:
+        line += '  %+6.1f%%' % ((result['lines_per_sec'] / previous['lines_per_sec'] - 1) * 100)
+    print(line)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints results against a baseline and returns the number of regressions
+
+    :param results: [] of result dicts
+    :param baseline: [] of result dicts of a previous run
+    :param tolerance: float allowed relative drop of lines/sec
+    :return: int
+    """
+    previous = dict((result_key(result), result) for result in baseline)
+    regressions = 0
+    print('\ncompared to baseline:')
+    for result in results:
+        before = previous.get(result_key(result))
+        print_result(result, before)
+        if before and 'lines_per_sec' in before and 'lines_per_sec' in result:
+            if result['lines_per_sec'] < before['lines_per_sec'] * (1 - tolerance):
+                regressions += 1
+    return regressions
+
+
+# construct the CLI argparser
+parser = ArgumentParser(
+    description='Measures access log parsing and collection throughput on synthetic logs.'
+)
+parser.add_argument(
+    '-n', '--lines',
+    help='Number of lines per log format [20000]',
+    action='store',
+    type=int,
+    default=20000
+)
+parser.add_argument(
+    '-r', '--repeat',
+    help='Number of timed runs per benchmark, the best one is reported [3]',
+    action='store',
+    type=int,
+    default=3
+)
+parser.add_argument(
+    '-f', '--formats',
+    help='Comma separated log formats [%s]' % ','.join(sorted(FORMATS)),
+    action='store',
+    default=','.join(sorted(FORMATS))
+)
+parser.add_argument(
+    '-b', '--benchmarks',
+    help='Comma separated benchmarks [%s]' % ','.join(BENCHMARKS),
+    action='store',
+    default=','.join(BENCHMARKS)
+)
+parser.add_argument(
+    '--filters',
+    help='Comma separated numbers of custom filters for collect [%s]' % ','.join(map(str, FILTER_COUNTS)),
+    action='store',
+    default=','.join(map(str, FILTER_COUNTS))
+)
+parser.add_argument(
+    '--seed',
+    help='Random seed of generated logs [0]',
+    action='store',
+    type=int,
+    default=0
+)
+parser.add_argument(
+    '-o', '--output',
+    help='Write results to a JSON file',
+    action='store',
+    default=None
+)
+parser.add_argument(
+    '-c', '--compare',
+    help='Compare results with a JSON file of a previous run (exit code is 1 on regressions)',
+    action='store',
+    default=None
+)
+parser.add_argument(
+    '-t', '--tolerance',
+    help='Allowed relative drop of lines/sec when comparing [0.1]',
+    action='store',
+    type=float,
+    default=0.1
+)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    # collectors log unparsable lines
+    context.default_log = logging.getLogger('benchmark')
+
+    results = run_benchmarks(
+        formats=args.formats.split(','),
+        benchmarks=args.benchmarks.split(','),
+        filter_counts=[int(count) for count in args.filters.split(',')],
+        lines_count=args.lines,
+        repeat=args.repeat,
+        seed=args.seed
+    )
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': int(time.time()),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        exit(1 if compare(results, baseline, args.tolerance) else 0)
+    exit(0)